@@ -2,7 +2,7 @@
 
 from django.contrib import admin
 
-from .models import Post, Reply, NodeTag, Attachment
+from .models import Post, Reply, NodeTag, Attachment, OutboxMail, StoredFile, NotificationPreference
 
 # Register your models here.
 
@@ -10,3 +10,21 @@ admin.site.register(Post)
 admin.site.register(Reply)
 admin.site.register(NodeTag)
 admin.site.register(Attachment)
+
+
+@admin.register(OutboxMail)
+class OutboxMailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipient', 'status', 'attempts', 'next_attempt', 'sent_at')
+    list_filter = ('status', )
+
+
+@admin.register(StoredFile)
+class StoredFileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'size', 'ref_count', 'created')
+
+
+@admin.register(NotificationPreference)
+class NotificationPreferenceAdmin(admin.ModelAdmin):
+    list_display = ('email', 'mode', 'last_digest_at')
+    list_filter = ('mode', )
+    search_fields = ('email', )
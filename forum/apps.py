@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+class ForumConfig(AppConfig):
+    name = 'forum'
+
+    def ready(self):
+        from . import signals, db
+
+        post_migrate.connect(signals.create_search_table, sender=self, dispatch_uid='forum_create_search_table')
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+带版本号的缓存块
+
+每个缓存块(例如首页的"最新回复")有一个版本号，缓存的键中包含版本号。
+数据发生变化时只需要增加对应块的版本号(bump)，旧的缓存自然失效，不需要知道具体缓存了哪些键。
+"""
+from __future__ import unicode_literals
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Post, NodeTag
+
+KEY_PREFIX = 'forum'
+
+# 首页的缓存块
+INDEX_ADMIN_POSTS = 'index:admin_posts'  # 头条和站长发布
+INDEX_LATEST_POSTS = 'index:latest_posts'
+INDEX_LATEST_REPLIES = 'index:latest_replies'
+# 热门主题，排名随每条回复变化，只在compact_hot_threads后失效，其余时间靠超时刷新
+HOT_THREADS = 'hot_threads'
+# RSS，和"站长发布"的内容相同
+FEED = 'feed'
+# 分页用的总数，见cached_count
+POST_COUNT = 'count:posts'
+ATTACHMENT_COUNT = 'count:attachments'
+# 节点代号 -> 节点，节点被修改或主题数变化时失效
+NODES = 'nodes'
+# 所有主题页面共用的版本号，节点改名等影响所有主题页面的修改时增加
+THREAD_PAGES = 'thread_pages'
+
+
+def version_key(name):
+    return '{0}:version:{1}'.format(KEY_PREFIX, name)
+
+
+def get_version(name):
+    key = version_key(name)
+    version = cache.get(key)
+    if version is None:
+        # 版本号被淘汰后不能从1重新开始，否则可能读到还没过期的旧数据
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump(*names):
+    for name in names:
+        try:
+            cache.incr(version_key(name))
+        except ValueError:
+            # 版本号不存在时get_version()会重新生成
+            pass
+
+
+def cached(key, func, timeout=None):
+    """
+    返回缓存中key对应的值，缓存不存在时调用func()生成
+    """
+    key = '{0}:{1}'.format(KEY_PREFIX, key)
+    value = cache.get(key)
+    if value is None:
+        value = func()
+        if timeout is None:
+            timeout = getattr(settings, 'FORUM_BLOCK_CACHE_TIMEOUT', 300)
+        cache.set(key, value, timeout)
+    return value
+
+
+def cached_block(name, func, timeout=None):
+    """
+    返回缓存块name的内容，缓存不存在时调用func()生成
+    """
+    return cached('block:{0}:{1}'.format(name, get_version(name)), func, timeout)
+
+
+def cached_count(name, queryset, key=''):
+    """
+    缓存queryset.count()，name的版本号由信号在增删时增加。
+    批量修改(QuerySet.update)不发送信号，所以超时时间较短(FORUM_COUNT_CACHE_TIMEOUT)
+    """
+    return cached('{0}:{1}:{2}'.format(name, get_version(name), key), queryset.count,
+                  getattr(settings, 'FORUM_COUNT_CACHE_TIMEOUT', 60))
+
+
+def get_node(slug):
+    """
+    按代号读取节点，不存在时返回None(不缓存)
+    """
+    return cached('node:{0}:{1}'.format(get_version(NODES), slug), lambda: NodeTag.objects.filter(slug=slug).first())
+
+
+def thread_state_key(pk):
+    return '{0}:thread:{1}'.format(KEY_PREFIX, pk)
+
+
+def get_thread_state_timeout():
+    # 本地内存缓存中其它进程的bump_thread看不到，有超时才能保证过期的页面最多保留这么久
+    return getattr(settings, 'FORUM_BLOCK_CACHE_TIMEOUT', 300)
+
+
+def get_thread_state(pk):
+    """
+    返回主题的版本号，主题不存在时返回None。
+    缓存命中时不访问数据库，所以可以在条件GET中使用
+    """
+    key = thread_state_key(pk)
+    state = cache.get(key)
+    if state is None:
+        if not Post.objects.filter(pk=pk).exists():
+            return None
+        state = int(time.time() * 1000)
+        cache.add(key, state, get_thread_state_timeout())
+        state = cache.get(key) or state
+    return state
+
+
+def bump_thread(pk):
+    """
+    主题或其回复被修改后调用，版本号改为当前时间(毫秒)，并保证比原来的大
+    """
+    if pk is None:
+        return
+    key = thread_state_key(pk)
+    old = cache.get(key)
+    version = int(time.time() * 1000)
+    if old is not None:
+        version = max(version, old + 1)
+    cache.set(key, version, get_thread_state_timeout())
+
+
+def clear_thread(pk):
+    cache.delete(thread_state_key(pk))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+数据库读写分离和SQLite连接设置
+
+ForumRouter把forum应用的读取分配到FORUM_DB_REPLICAS中的某个只读副本，写入总是使用default。
+只有FORUM_DB_REPLICA_VIEWS中列出的页面(列表、详情、RSS、sitemap等，按URL名称)的GET/HEAD请求才读副本，
+由ReplicaRoutingMiddleware在process_view中标记。其它页面(例如刚提交表单之后跳转到的设置页面)、
+管理命令和POST请求都读写主库，避免副本的延迟影响计数的修复等操作。
+用户写入过数据之后FORUM_DB_PIN_SECONDS秒内(用cookie标记)的请求也读主库，这样刚发表的回复马上能看到。
+
+SQLite数据库在建立连接时执行FORUM_SQLITE_PRAGMAS，例如WAL模式下读取不会被写入阻塞，
+配合CONN_MAX_AGE保持连接，不需要每个请求重新打开数据库文件。
+"""
+from __future__ import unicode_literals
+import random
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+PIN_COOKIE = 'forum_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_local = threading.local()
+
+
+def get_replicas():
+    return tuple(getattr(settings, 'FORUM_DB_REPLICAS', ()))
+
+
+class ForumRouter(object):
+    app_labels = ('forum', )
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label not in self.app_labels:
+            return None
+        replicas = get_replicas()
+        if replicas and getattr(_local, 'use_replicas', False) and not getattr(_local, 'pinned', False):
+            return random.choice(replicas)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # 本请求之后的读取(以及之后几秒内同一用户的请求)都使用主库
+        _local.pinned = _local.wrote = True
+        if model._meta.app_label in self.app_labels:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (DEFAULT_DB_ALIAS, ) + get_replicas()
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model=None, **hints):
+        if db in get_replicas():
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware(object):
+
+    def process_request(self, request):
+        _local.use_replicas = _local.wrote = False
+        _local.pinned = request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = getattr(request, 'resolver_match', None)
+        _local.use_replicas = match is not None and match.view_name in getattr(settings, 'FORUM_DB_REPLICA_VIEWS', ())
+
+    def process_response(self, request, response):
+        if getattr(_local, 'wrote', False) and get_replicas():
+            response.set_cookie(PIN_COOKIE, '1', max_age=getattr(settings, 'FORUM_DB_PIN_SECONDS', 10),
+                                httponly=True)
+        _local.use_replicas = _local.pinned = _local.wrote = False
+        return response
+
+
+@receiver(connection_created, dispatch_uid='forum_configure_sqlite')
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    # 直接使用底层连接，不记录到queries_log
+    cursor = connection.connection.cursor()
+    try:
+        for name, value in getattr(settings, 'FORUM_SQLITE_PRAGMAS', ()):
+            cursor.execute('PRAGMA {0} = {1}'.format(name, value))
+    finally:
+        cursor.close()
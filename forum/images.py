@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+图片附件的缩略图和网页优化版本
+
+上传图片时只把对应的StoredFile标记为待处理(VARIANTS_PENDING)，
+由 `python manage.py process_images` 在进程池中生成各个宽度的版本:
+按EXIF方向旋转后去掉EXIF，重新压缩为JPEG(有透明通道时为PNG)，可选再生成一份WebP。
+版本按文件内容(digest)保存，内容相同的附件共用。模板中使用 {% attachment_image %} 选择合适的版本。
+"""
+from __future__ import unicode_literals
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+try:
+    from PIL import features
+    WEBP_SUPPORTED = features.check('webp')
+except ImportError:
+    WEBP_SUPPORTED = False
+
+VARIANTS_DIR = 'variants'
+VARIANT_WIDTHS = tuple(getattr(settings, 'FORUM_IMAGE_VARIANT_WIDTHS', (240, 640, 1280)))
+JPEG_QUALITY = getattr(settings, 'FORUM_IMAGE_JPEG_QUALITY', 82)
+WEBP_QUALITY = getattr(settings, 'FORUM_IMAGE_WEBP_QUALITY', 80)
+
+
+def webp_enabled():
+    return WEBP_SUPPORTED and getattr(settings, 'FORUM_IMAGE_WEBP', False)
+
+
+def get_variant_path(digest, width, fmt):
+    return '{0}/{1}/{2}/{3}_{4}.{5}'.format(VARIANTS_DIR, digest[:2], digest[2:4], digest, width, fmt)
+
+
+def open_image(path):
+    img = Image.open(path)
+    if getattr(img, 'is_animated', False):
+        # 动图缩放后只剩第一帧，直接使用原图
+        return None
+    if hasattr(ImageOps, 'exif_transpose'):
+        img = ImageOps.exif_transpose(img)
+    return img
+
+
+def save_variant(img, path, fmt):
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # 其它进程已经创建了目录
+            pass
+    # 不传入exif参数，保存时就不会带上原图的EXIF信息
+    if fmt == 'jpeg':
+        img.save(path, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif fmt == 'png':
+        img.save(path, 'PNG', optimize=True)
+    else:
+        img.save(path, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return os.path.getsize(path)
+
+
+def make_variants(job):
+    """
+    供进程池使用: (digest, 原图路径, 是否生成WebP) -> [(width, height, format, name, size), ...]
+    原图宽度不超过的尺寸不生成，原图比所有尺寸都窄时生成一份原尺寸的(去掉EXIF并重新压缩)；
+    打不开的图片抛出IOError
+    """
+    digest, path, webp = job
+    img = open_image(path)
+    if img is None:
+        return []
+
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    formats = ['png' if has_alpha else 'jpeg'] + (['webp'] if webp else [])
+
+    variants = []
+    for width in [w for w in sorted(VARIANT_WIDTHS) if w < img.width] or [img.width]:
+        height = max(int(round(img.height * float(width) / img.width)), 1)
+        resized = img.resize((width, height), Image.LANCZOS) if width < img.width else img
+        for fmt in formats:
+            name = get_variant_path(digest, width, fmt)
+            size = save_variant(resized, default_storage.path(name), fmt)
+            variants.append((width, height, fmt, name, size))
+    return variants
+
+
+def process_job(job):
+    """
+    出错时返回异常信息而不是抛出，避免一张坏图让整批失败
+    """
+    try:
+        return job[0], make_variants(job), None
+    except Exception as e:
+        return job[0], [], '{0}: {1}'.format(e.__class__.__name__, e)
+
+
+def delete_variants(digest):
+    from .models import ImageVariant
+
+    variants = ImageVariant.objects.filter(digest=digest)
+    for name in variants.values_list('name', flat=True):
+        default_storage.delete(name)
+    variants.delete()
+
+
+def pick_variant(variants, width, fmt=None):
+    """
+    返回宽度不小于width的最小版本。都不够宽时返回None，这时应该使用原图(原图不比各个版本窄)
+    """
+    candidates = [v for v in variants if v.width >= width and (v.format == fmt if fmt else v.format != 'webp')]
+    if candidates:
+        return min(candidates, key=lambda v: v.width)
+
+
+def prefetch_variants(attachments):
+    """
+    一次查询读取一组附件的所有版本，保存到attachment._variants
+    """
+    from .models import ImageVariant
+
+    attachments = [a for a in attachments if not hasattr(a, '_variants')]
+    digests = set(a.digest for a in attachments if a.is_image and a.digest)
+    by_digest = {}
+    if digests:
+        for variant in ImageVariant.objects.filter(digest__in=digests):
+            by_digest.setdefault(variant.digest, []).append(variant)
+    for attachment in attachments:
+        attachment._variants = by_digest.get(attachment.digest, [])
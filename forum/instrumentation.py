@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+请求的性能统计
+
+PerformanceMiddleware为每个请求记录总耗时、SQL查询数和耗时、模板渲染耗时，
+以及请求中Markdown渲染(PostBase.save)和写入发件箱(Reply.save)的耗时，
+按视图名称累计到进程内的定长直方图中，由 /forum/stats/ (仅限管理员) 以JSON输出。
+超过FORUM_SLOW_REQUEST_MS的请求会把最慢的几条SQL写入日志forum.slow。
+
+SQL耗时由TimingCursor记录，它只计时并保留最慢的几条SQL，不像force_debug_cursor那样
+格式化每条查询的参数并写入queries_log。默认只在DEBUG时启用，线上可以用FORUM_PERF_SAMPLE_RATE抽样。
+"""
+from __future__ import unicode_literals
+import bisect
+import heapq
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('forum.slow')
+
+# 直方图各个桶的上界，单位毫秒(查询数也使用同样的桶)
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+METRICS = ('total', 'sql_count', 'sql_time', 'template', 'markdown', 'mail')
+SLOWEST_QUERIES = 5
+
+_local = threading.local()
+
+
+class Histogram(object):
+    """
+    定长的直方图，只保存各个桶的计数、总和与最大值，百分位数取所在桶的上界
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': round(self.sum / self.count, 3) if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': round(self.max, 3),
+        }
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+        self.started = time.time()
+
+    def record(self, view_name, values):
+        with self.lock:
+            histograms = self.views.get(view_name)
+            if histograms is None:
+                histograms = self.views[view_name] = dict((metric, Histogram()) for metric in METRICS)
+            for metric, value in values.items():
+                histograms[metric].add(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime': round(time.time() - self.started),
+                'buckets': BUCKETS,
+                'views': dict((name, dict((metric, h.as_dict()) for metric, h in histograms.items() if h.count))
+                              for name, histograms in self.views.items()),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+            self.started = time.time()
+
+
+registry = Registry()
+
+
+def add_time(metric, milliseconds):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats[metric] = stats.get(metric, 0) + milliseconds
+
+
+@contextmanager
+def timer(metric):
+    """
+    在请求中累计一段代码的耗时；不在请求中(例如管理命令)时只多了两次time.time()
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(metric, (time.time() - start) * 1000)
+
+
+class TimingCursor(object):
+    """
+    包装connection.cursor()返回的游标，记录请求中SQL的数量、总耗时和最慢的几条
+    """
+
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.cursor.__exit__(type, value, traceback)
+
+    def record(self, sql, start):
+        elapsed = time.time() - start
+        self.queries['count'] += 1
+        self.queries['time'] += elapsed
+        slowest = self.queries['slowest']
+        if len(slowest) < SLOWEST_QUERIES:
+            heapq.heappush(slowest, (elapsed, sql))
+        elif elapsed > slowest[0][0]:
+            heapq.heapreplace(slowest, (elapsed, sql))
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.record(sql, start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.record(sql, start)
+
+
+def install_timing_cursor(connection):
+    """
+    每个线程的数据库连接对象只需要替换一次cursor()，没有在统计的请求中时直接返回原来的游标
+    """
+    if 'cursor' in connection.__dict__:
+        return
+    cursor = connection.cursor
+
+    def timing_cursor():
+        queries = getattr(_local, 'queries', None)
+        if queries is None:
+            return cursor()
+        return TimingCursor(cursor(), queries)
+    connection.cursor = timing_cursor
+
+
+def is_enabled():
+    if not getattr(settings, 'FORUM_PERF_ENABLED', settings.DEBUG):
+        return False
+    rate = getattr(settings, 'FORUM_PERF_SAMPLE_RATE', 1.0)
+    return rate >= 1 or random.random() < rate
+
+
+class PerformanceMiddleware(object):
+
+    def process_request(self, request):
+        if not is_enabled():
+            return
+        _local.stats = {}
+        _local.queries = {'count': 0, 'time': 0.0, 'slowest': []}
+        request._perf_start = time.time()
+        for connection in connections.all():
+            install_timing_cursor(connection)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = getattr(request, 'resolver_match', None)
+        request._perf_view = (match and match.view_name) or getattr(view_func, '__name__', 'unknown')
+
+    def process_template_response(self, request, response):
+        if hasattr(request, '_perf_start'):
+            # TemplateResponse在所有中间件的process_template_response之后才渲染
+            start = time.time()
+            response.add_post_render_callback(lambda r: add_time('template', (time.time() - start) * 1000))
+        return response
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_perf_start'):
+            return response
+        total = (time.time() - request._perf_start) * 1000
+        stats = getattr(_local, 'stats', None) or {}
+        queries = getattr(_local, 'queries', None) or {'count': 0, 'time': 0.0, 'slowest': []}
+        _local.stats = _local.queries = None
+
+        values = dict(stats, total=total, sql_count=queries['count'], sql_time=queries['time'] * 1000)
+        view_name = getattr(request, '_perf_view', None) or 'unresolved'
+        registry.record(view_name, values)
+
+        if total >= getattr(settings, 'FORUM_SLOW_REQUEST_MS', 1000):
+            slowest = sorted(queries['slowest'], reverse=True)
+            logger.warning("Slow request %s %s (%s): %.1fms, %d queries, %.1fms SQL\n%s",
+                           request.method, request.get_full_path(), view_name, total, queries['count'],
+                           values['sql_time'], '\n'.join('{0:.3f}s  {1}'.format(t, sql) for t, sql in slowest))
+        return response
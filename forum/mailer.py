@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+发件箱(OutboxMail)的投递逻辑，供send_outbox命令使用；
+以及把等待汇总的回复通知(PendingNotification)合并为每个收件人一封邮件，供send_digests命令使用
+"""
+from __future__ import unicode_literals
+import datetime
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import Truncator
+
+from .models import OutboxMail, NotificationPreference, PendingNotification
+
+MAIL_BACKENDS = {
+    'smtp': 'django.core.mail.backends.smtp.EmailBackend',
+    'console': 'django.core.mail.backends.console.EmailBackend',
+    'file': 'django.core.mail.backends.filebased.EmailBackend',
+}
+
+
+def get_retry_delay(attempts):
+    """
+    第n次失败后等待 base * 2^(n-1) 秒再重试，最长不超过FORUM_OUTBOX_MAX_DELAY
+    """
+    base = getattr(settings, 'FORUM_OUTBOX_RETRY_DELAY', 60)
+    max_delay = getattr(settings, 'FORUM_OUTBOX_MAX_DELAY', 6 * 3600)
+    return datetime.timedelta(seconds=min(base * 2 ** max(attempts - 1, 0), max_delay))
+
+
+def mark_failed(mail, error, max_attempts, now):
+    mail.attempts += 1
+    mail.last_error = '{0}: {1}'.format(error.__class__.__name__, error)
+    if mail.attempts >= max_attempts:
+        mail.status = OutboxMail.STATUS_FAILED
+    else:
+        mail.next_attempt = now + get_retry_delay(mail.attempts)
+    mail.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt', 'last_edited'])
+
+
+def deliver_batch(connection, batch_size=50, max_attempts=None):
+    """
+    从发件箱中取出最多batch_size封到期的邮件，通过已经打开的connection逐封发送。
+    返回(发送成功数, 发送失败数)
+    """
+    max_attempts = max_attempts or getattr(settings, 'FORUM_OUTBOX_MAX_ATTEMPTS', 5)
+    now = timezone.now()
+    sent, failed = [], 0
+
+    for mail in OutboxMail.objects.due(now)[:batch_size]:
+        message = EmailMessage(mail.subject, mail.message, mail.from_email, [mail.recipient, ],
+                               connection=connection)
+        try:
+            connection.send_messages([message])
+        except Exception as e:
+            mark_failed(mail, e, max_attempts, now)
+            failed += 1
+        else:
+            sent.append(mail.pk)
+
+    if sent:
+        OutboxMail.objects.filter(pk__in=sent).update(
+            status=OutboxMail.STATUS_SENT, sent_at=timezone.now(), last_edited=timezone.now()
+        )
+    return len(sent), failed
+
+
+def deliver_outbox(backend=None, batch_size=50, max_attempts=None, **backend_kwargs):
+    """
+    分批发送发件箱中所有到期的邮件，整个过程复用同一个连接。
+    backend可以是MAIL_BACKENDS中的简写，也可以是完整的backend路径，默认使用settings.EMAIL_BACKEND
+    """
+    if not OutboxMail.objects.due().exists():
+        return 0, 0
+
+    connection = get_connection(MAIL_BACKENDS.get(backend, backend), **backend_kwargs)
+    total_sent, total_failed = 0, 0
+    # 连不上邮件服务器时直接抛出异常，邮件仍留在发件箱中等待下一次运行
+    connection.open()
+    try:
+        while True:
+            sent, failed = deliver_batch(connection, batch_size, max_attempts)
+            total_sent += sent
+            total_failed += failed
+            if sent + failed < batch_size:
+                break
+    finally:
+        connection.close()
+    return total_sent, total_failed
+
+
+DIGEST_SUBJECT = "{0}, 您在[lcfcn.com]发表的内容有{1}条新回复"
+DIGEST_MESSAGE = """
+{0},
+
+自上次通知以来, 您在[lcfcn.com]发表的内容有{1}条新回复:
+{2}
+您在发文时同意了接收回复通知, 并选择了汇总发送. 修改通知方式请访问:
+{3}
+
+{4}
+"""
+# 每个主题最多列出几条回复
+DIGEST_REPLIES_PER_THREAD = 5
+
+
+def format_digest(recipient, notifications):
+    """
+    notifications为同一个收件人的PendingNotification(已按主题和回复排序)，按主题合并，同一条回复只列出一次
+    """
+    threads = []
+    for notification in notifications:
+        if not threads or threads[-1][0] != notification.post_node_id:
+            threads.append((notification.post_node_id, notification.post_node, []))
+        replies = threads[-1][2]
+        if not replies or replies[-1].pk != notification.reply_id:
+            replies.append(notification.reply)
+
+    sections = []
+    for post_id, post, replies in threads:
+        lines = ["", "[{0}] {1}条新回复".format(getattr(post, 'title', "已删除的主题"), len(replies))]
+        if post:
+            lines.append(post.get_full_url())
+        for reply in replies[:DIGEST_REPLIES_PER_THREAD]:
+            content = " ".join((reply.content or "").split())
+            lines.append("  - {0} ({1}): {2}".format(reply.get_author_info()[0],
+                                                     timezone.localtime(reply.created).strftime('%Y-%m-%d %H:%M'),
+                                                     Truncator(content).chars(200)))
+        if len(replies) > DIGEST_REPLIES_PER_THREAD:
+            lines.append("  ... 另有{0}条".format(len(replies) - DIGEST_REPLIES_PER_THREAD))
+        sections.append("\n".join(lines) + "\n")
+
+    count = sum(len(replies) for post_id, post, replies in threads)
+    name = notifications[-1].name or recipient
+    subject = DIGEST_SUBJECT.format(name, count)
+    message = DIGEST_MESSAGE.format(name, count, "".join(sections), NotificationPreference.get_settings_url(recipient),
+                                    datetime.date.today().isoformat())
+    return subject, message, getattr(settings, "DEFAULT_FROM_EMAIL", "root@localhost"), [recipient, ]
+
+
+def queue_digests(batch_size=100, interval=None, now=None):
+    """
+    为距上次汇总超过interval秒(默认FORUM_DIGEST_INTERVAL)的收件人各生成一封汇总邮件并写入发件箱，
+    与删除已汇总的通知在同一个事务中完成。返回生成的邮件数
+    """
+    now = now or timezone.now()
+    if interval is None:
+        interval = getattr(settings, 'FORUM_DIGEST_INTERVAL', 24 * 3600)
+    since = now - datetime.timedelta(seconds=interval)
+    recipients = sorted(PendingNotification.objects.order_by().values_list('recipient', flat=True).distinct())
+
+    queued = 0
+    for i in range(0, len(recipients), batch_size):
+        batch = recipients[i:i + batch_size]
+        with transaction.atomic():
+            recent = set(NotificationPreference.objects.filter(email__in=batch, last_digest_at__gt=since)
+                         .values_list('email', flat=True))
+            due = [recipient for recipient in batch if recipient not in recent]
+            notifications = list(PendingNotification.objects.filter(recipient__in=due).select_related(
+                'post_node', 'reply__author').order_by('recipient', 'post_node', 'reply', 'pk'))
+            if not notifications:
+                continue
+
+            mails, grouped = [], {}
+            for notification in notifications:
+                grouped.setdefault(notification.recipient, []).append(notification)
+            for recipient in sorted(grouped):
+                mails.append(format_digest(recipient, grouped[recipient]))
+            queued += OutboxMail.objects.queue_mass_mail(mails)
+
+            # 事务中读取之后新增的通知留到下一次
+            last_pk = max(n.pk for n in notifications)
+            PendingNotification.objects.filter(recipient__in=due, pk__lte=last_pk).delete()
+            NotificationPreference.objects.filter(email__in=due).update(last_digest_at=now)
+    return queued
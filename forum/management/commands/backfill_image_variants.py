@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ...models import Attachment, StoredFile
+
+
+class Command(BaseCommand):
+    help = "把已有的图片附件标记为等待生成缩略图，之后由process_images命令处理"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true', default=False,
+                            help="同时重试之前生成失败的图片")
+        parser.add_argument('--all', action='store_true', default=False,
+                            help="重新生成所有图片的版本(例如修改了FORUM_IMAGE_VARIANT_WIDTHS之后)")
+
+    def handle(self, *args, **options):
+        statuses = [StoredFile.VARIANTS_NONE]
+        if options['retry_failed'] or options['all']:
+            statuses.append(StoredFile.VARIANTS_FAILED)
+        if options['all']:
+            statuses.append(StoredFile.VARIANTS_READY)
+
+        digests = Attachment.objects.filter(is_image=True, digest__isnull=False).values('digest')
+        count = StoredFile.objects.filter(digest__in=digests, variants_status__in=statuses).update(
+            variants_status=StoredFile.VARIANTS_PENDING, variants_error=''
+        )
+        self.stdout.write("{0} images queued".format(count))
+
+        legacy = Attachment.objects.filter(is_image=True, digest__isnull=True).count()
+        if legacy:
+            self.stderr.write("{0} images are not in content-addressed storage yet, "
+                              "run dedupe_uploads first".format(legacy))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, OperationalError
+from django.test.utils import override_settings
+
+from ...models import Post, Reply
+from .bench_urls import percentile
+
+# SQLite的默认设置(回滚日志)，作为对比的基准
+BASELINE_PRAGMAS = (
+    ('journal_mode', 'DELETE'),
+    ('synchronous', 'FULL'),
+)
+
+
+class Command(BaseCommand):
+    help = ("用多个线程同时读写数据库(读取主题列表和回复，发表回复)，比较SQLite默认设置和FORUM_SQLITE_PRAGMAS的吞吐量，"
+            "以JSON输出。会写入数据库，结束时删除测试数据，请在数据库的副本上运行")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--duration', type=float, default=5, help="每种设置运行的秒数")
+        parser.add_argument('--output', default=None, help="结果保存到文件，默认输出到stdout")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("bench_db only compares SQLite settings")
+        self.post = Post.objects.create(title='bench_db', content='bench_db', need_notification=False)
+        self.post_ids = list(Post.objects.order_by('-pk').values_list('pk', flat=True)[:100])
+        try:
+            results = {}
+            for name, pragmas in (('baseline', BASELINE_PRAGMAS),
+                                  ('tuned', getattr(settings, 'FORUM_SQLITE_PRAGMAS', ()))):
+                results[name] = self.run_profile(pragmas, options)
+                if int(options['verbosity']) > 1:
+                    self.stderr.write("{0}: {1}".format(name, results[name]))
+        finally:
+            Reply.objects.filter(post_node=self.post).delete()
+            self.post.delete()
+
+        report = {
+            'readers': options['readers'],
+            'writers': options['writers'],
+            'duration': options['duration'],
+            'pragmas': dict(getattr(settings, 'FORUM_SQLITE_PRAGMAS', ())),
+            'results': results,
+        }
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run_profile(self, pragmas, options):
+        # journal_mode保存在数据库文件中，只有一个连接时才能切换，所以先关闭所有连接
+        for conn in connections.all():
+            conn.close()
+        with override_settings(FORUM_SQLITE_PRAGMAS=pragmas):
+            connection.ensure_connection()
+            connection.close()
+
+            stop = time.time() + options['duration']
+            stats = {'read': ([], [0]), 'write': ([], [0])}
+            threads = [threading.Thread(target=self.worker, args=(self.read, stop, stats['read']))
+                       for i in range(options['readers'])]
+            threads += [threading.Thread(target=self.worker, args=(self.write, stop, stats['write']))
+                        for i in range(options['writers'])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        result = {}
+        for kind, (times, errors) in stats.items():
+            result[kind] = {
+                'ops_per_second': round(len(times) / options['duration'], 1),
+                'p50_ms': round(percentile(times, 50) or 0, 3),
+                'p95_ms': round(percentile(times, 95) or 0, 3),
+                'errors': errors[0],
+            }
+        return result
+
+    def worker(self, operation, stop, stats):
+        times, errors = stats
+        rng = random.Random()
+        try:
+            while time.time() < stop:
+                start = time.time()
+                try:
+                    operation(rng)
+                except OperationalError:
+                    # database is locked
+                    errors[0] += 1
+                else:
+                    times.append((time.time() - start) * 1000)
+        finally:
+            connection.close()
+
+    def read(self, rng):
+        # 主题列表和主题页面的查询
+        list(Post.objects.select_related('author', 'node').defer('content', 'content_md')[:25])
+        list(Reply.objects.filter(post_node=rng.choice(self.post_ids)).select_related('author')
+             .defer('content').order_by('pk')[:20])
+
+    def write(self, rng):
+        Reply.objects.create(title='Re:bench_db', content='bench {0}'.format(rng.random()), post_node=self.post,
+                             need_notification=False)
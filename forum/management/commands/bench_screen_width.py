@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from ...utility import WIDTHS, get_screen_width
+
+
+def linear_char_width(char):
+    """
+    旧版本的实现: 对每个字符顺序扫描WIDTHS，作为对比的基准
+    """
+    char = ord(char)
+    if char == 0xe or char == 0xf:
+        return 0
+    for num, wid in WIDTHS:
+        if char <= num:
+            return wid
+    return 1
+
+
+def linear_truncate(input_str, max_width, tail='.', tail_length=3):
+    str_max_width = max_width - tail_length * linear_char_width(tail)
+    total_width = 0
+    for i in range(0, len(input_str)):
+        total_width += linear_char_width(input_str[i])
+        if total_width < str_max_width:
+            continue
+        elif total_width == str_max_width:
+            return input_str[0:i + 1] + tail * tail_length
+        else:
+            return input_str[0:i + 1] + tail * (tail_length - 1)
+    return input_str
+
+
+class Command(BaseCommand):
+    help = "比较get_screen_width和旧的逐项查表实现在中英文混合字符串上的速度"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        alphabet = 'abcdefghij KLMNOP 0123456789,.-' + '中文标题测试回复内容，。！？' + 'ａｂｃ①②éü'
+        samples = {
+            'ascii title': ['Django ORM select_related and prefetch_related {0}'.format(i) for i in range(20)],
+            'cjk title': ['关于网站的一些说明和使用帮助第{0}版'.format(i) for i in range(20)],
+            'mixed reply': [''.join(rnd.choice(alphabet) for _ in range(rnd.randint(20, 400))) for _ in range(20)],
+        }
+
+        for name, strings in sorted(samples.items()):
+            for string in strings:
+                assert get_screen_width(string, 42) == linear_truncate(string, 42)
+                assert get_screen_width(string) == sum(linear_char_width(c) for c in string)
+
+            timings = []
+            for func in (lambda s: linear_truncate(s, 42), lambda s: get_screen_width(s, 42),
+                         lambda s: sum(linear_char_width(c) for c in s), get_screen_width):
+                seconds = timeit.timeit(lambda: [func(s) for s in strings], number=options['number'])
+                timings.append(seconds * 1e6 / options['number'] / len(strings))
+            self.stdout.write("{0:<12} truncate: {1:8.2f}us -> {2:8.2f}us   width: {3:8.2f}us -> {4:8.2f}us".format(
+                name, *timings))
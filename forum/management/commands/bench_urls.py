@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import gc
+import json
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from ...models import Post, NodeTag, Attachment
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2没有tracemalloc，改为统计每次请求后新增的gc对象数
+    tracemalloc = None
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(int(round(percent / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = "用测试客户端依次请求forum/urls.py中的各个页面，以JSON输出p50/p95耗时、查询数和内存分配"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=2)
+        parser.add_argument('--cold', action='store_true', default=False,
+                            help="每次请求前清空缓存")
+        parser.add_argument('--only', default=None, help="只测试名称包含该字符串的页面")
+        parser.add_argument('--output', default=None, help="结果保存到文件，默认输出到stdout")
+
+    def get_cases(self):
+        cases = [
+            ('index', reverse('index')),
+            ('forum-index', reverse('forum-index')),
+            ('forum-index-active', reverse('forum-index') + '?sort=active'),
+            ('nodetag-list', reverse('nodetag-list')),
+            ('rss', '/rss/'),
+            ('sitemap-index', '/sitemap.xml'),
+            ('sitemap-threads', reverse('django.contrib.sitemaps.views.sitemap', kwargs={'section': 'threads'})),
+            ('attachment-list', reverse('attachment-list')),
+            ('attachment-list-last', reverse('attachment-list') + '?p=last'),
+            ('forum-search', reverse('forum-search') + '?q=django'),
+        ]
+
+        thread = Post.objects.annotate(n=Count('replies')).order_by('-n').values_list('pk', 'n').first()
+        if thread:
+            url = reverse('post-detail', kwargs={'pk': thread[0]})
+            cases.append(('post-detail', url))
+            pages = max((thread[1] - 1) // 20 + 1, 1)
+            cases.append(('post-detail-middle', '{0}?p={1}'.format(url, pages // 2 + 1)))
+            cases.append(('post-detail-last', url + '?p=last'))
+
+        node = NodeTag.objects.annotate(n=Count('posts')).order_by('-n').first()
+        if node:
+            cases.append(('nodetag-detail', reverse('nodetag-detail', kwargs={'slug': node.slug})))
+            cases.append(('nodetag-detail-last', reverse('nodetag-detail', kwargs={'slug': node.slug}) + '?p=last'))
+
+        attachment = Attachment.objects.filter(missing=False).first()
+        if attachment:
+            cases.append(('attachment-detail', reverse('attachment-detail', kwargs={'pk': attachment.pk})))
+        return cases
+
+    def measure(self, client, url, cold):
+        if cold:
+            cache.clear()
+        gc.collect()
+        if tracemalloc:
+            tracemalloc.start()
+        else:
+            objects = len(gc.get_objects())
+
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            response = client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.time() - start
+
+        if tracemalloc:
+            allocated = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            allocated = len(gc.get_objects()) - objects
+        return response.status_code, elapsed, len(queries), allocated
+
+    def handle(self, *args, **options):
+        client = Client()
+        results = {}
+        # 按生产环境的配置测试(DEBUG时debug toolbar会占用大部分时间)，测试客户端使用testserver作为主机名
+        with override_settings(DEBUG=False, ALLOWED_HOSTS=['*']):
+            for name, url in self.get_cases():
+                if options['only'] and options['only'] not in name:
+                    continue
+                for i in range(options['warmup']):
+                    self.measure(client, url, options['cold'])
+                samples = [self.measure(client, url, options['cold']) for i in range(options['iterations'])]
+                times = [s[1] * 1000 for s in samples]
+                results[name] = {
+                    'url': url,
+                    'status': samples[-1][0],
+                    'p50_ms': round(percentile(times, 50), 3),
+                    'p95_ms': round(percentile(times, 95), 3),
+                    'mean_ms': round(sum(times) / len(times), 3),
+                    'queries': max(s[2] for s in samples),
+                    'allocations': percentile([s[3] for s in samples], 50),
+                }
+                if int(options['verbosity']) > 1:
+                    self.stderr.write("{0}: p50 {1}ms".format(name, results[name]['p50_ms']))
+
+        report = {
+            'iterations': options['iterations'],
+            'cold': options['cold'],
+            'allocation_unit': 'peak bytes' if tracemalloc else 'new gc objects',
+            'dataset': {
+                'posts': Post.objects.count(),
+                'nodes': NodeTag.objects.count(),
+                'attachments': Attachment.objects.count(),
+            },
+            'results': results,
+        }
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
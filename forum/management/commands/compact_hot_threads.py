@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import datetime
+import math
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from ... import cache, ranking
+from ...models import Post, Reply, HotThread
+
+
+class Command(BaseCommand):
+    help = ("删除热度已经衰减到FORUM_HOT_MIN_HEAT以下的主题，只保留热度最高的FORUM_HOT_KEEP个；"
+            "--rebuild根据最近的主题和回复重新计算所有热度")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', default=False)
+        parser.add_argument('--days', type=int, default=30, help="--rebuild时统计最近多少天的活动")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.rebuild(options['days'], options['batch_size'])
+
+        min_score = ranking.time_score() + math.log(getattr(settings, 'FORUM_HOT_MIN_HEAT', 0.05), 2)
+        keep = getattr(settings, 'FORUM_HOT_KEEP', 1000)
+        with transaction.atomic():
+            HotThread.objects.filter(score__lt=min_score).delete()
+            cutoff = HotThread.objects.order_by('-score').values_list('score', flat=True)[keep:keep + 1]
+            if cutoff:
+                HotThread.objects.filter(score__lt=cutoff[0]).delete()
+        cache.bump(cache.HOT_THREADS)
+        self.stdout.write("{0} hot threads kept".format(HotThread.objects.count()))
+
+    def rebuild(self, days, batch_size):
+        since = timezone.now() - datetime.timedelta(days=days)
+        scores = {}
+        for model, field in ((Post, 'pk'), (Reply, 'post_node')):
+            queryset = model.objects.filter(created__gte=since).exclude(**{field: None})
+            last_pk = 0
+            while True:
+                rows = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', field, 'created')[:batch_size])
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+                for pk, post_id, created in rows:
+                    scores[post_id] = ranking.add_scores(scores.get(post_id), ranking.activity_score(created))
+
+        # 回复可能属于更早发表的主题，只保留还存在的主题
+        existing = set()
+        post_ids = list(scores)
+        for i in range(0, len(post_ids), batch_size):
+            existing.update(Post.objects.filter(pk__in=post_ids[i:i + batch_size]).values_list('pk', flat=True))
+        with transaction.atomic():
+            HotThread.objects.all().delete()
+            HotThread.objects.bulk_create([HotThread(post_id=pk, score=scores[pk]) for pk in existing], batch_size)
+        self.stdout.write("{0} hot threads rebuilt".format(len(existing)))
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import os
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import Attachment
+from ...storage import hash_file, store_file, guess_content_type
+
+
+class Command(BaseCommand):
+    help = "把按日期存放的旧附件迁移到按内容存储(upload/cas/)，内容相同的文件只保留一份"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="只统计可以节省的空间，不修改文件和数据库")
+        parser.add_argument('--keep-old', action='store_true', default=False,
+                            help="迁移后保留原来的文件")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        seen = set()
+        migrated = missing = duplicates = saved = 0
+
+        legacy = Attachment.objects.filter(digest__isnull=True).exclude(attachment='').order_by('pk')
+        for attachment in legacy.iterator():
+            old_name = attachment.attachment.name
+            if not default_storage.exists(old_name):
+                missing += 1
+                continue
+
+            with default_storage.open(old_name, 'rb') as f:
+                digest, size = hash_file(f)
+                if digest in seen:
+                    duplicates += 1
+                    saved += size
+                seen.add(digest)
+                if dry_run:
+                    continue
+
+                with transaction.atomic():
+                    stored = store_file(File(f, name=old_name), digest, size)
+                    # 用update()不改变last_edited
+                    Attachment.objects.filter(pk=attachment.pk).update(
+                        attachment=stored.name, digest=digest, original_name=os.path.basename(old_name),
+                        size=size, content_type=guess_content_type(old_name, attachment.image_format), missing=False
+                    )
+            migrated += 1
+
+            if not options['keep_old'] and not Attachment.objects.filter(attachment=old_name).exists():
+                default_storage.delete(old_name)
+
+        self.stdout.write("{0} {1}, {2} duplicates ({3} bytes saved), {4} missing".format(
+            migrated, "to migrate" if dry_run else "migrated", duplicates, saved, missing
+        ))
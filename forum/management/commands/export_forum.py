@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+
+from ...transfer import iter_records
+
+
+class Command(BaseCommand):
+    help = "把节点、主题、回复和附件信息逐行导出为JSONL，分批读取，内存占用固定"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', default='-', help="输出文件，默认为stdout")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        out = sys.stdout if options['output'] == '-' else open(options['output'], 'w')
+        counts = {}
+        try:
+            for record in iter_records(options['batch_size']):
+                out.write(json.dumps(record, cls=DjangoJSONEncoder))
+                out.write('\n')
+                counts[record['type']] = counts.get(record['type'], 0) + 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        self.stderr.write(", ".join("{0} {1}s".format(n, t) for t, n in sorted(counts.items())) or "Nothing exported")
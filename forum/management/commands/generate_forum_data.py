@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.six import BytesIO
+from PIL import Image
+
+from ...models import Post, Reply, NodeTag, Attachment
+
+WORDS = (u"论坛 性能 缓存 索引 查询 数据库 模板 渲染 分页 附件 图片 回复 主题 节点 "
+         u"django python sqlite markdown pygments cache index query render page").split()
+
+CODE_SAMPLES = [
+    u"def fib(n):\n    a, b = 0, 1\n    for _ in range(n):\n        a, b = b, a + b\n    return a",
+    u"SELECT id, title FROM forum_post WHERE node_id = 1 ORDER BY id DESC LIMIT 25;",
+    u"for (var i = 0; i < items.length; i++) {\n    console.log(items[i]);\n}",
+]
+
+
+class Command(BaseCommand):
+    help = "生成可重复的测试数据(节点、用户、主题、多层引用和代码块的回复、附件)，用于性能测试"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--nodes', type=int, default=10)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--posts', type=int, default=500)
+        parser.add_argument('--replies', type=int, default=5000, help="回复总数，集中在少数热门主题上")
+        parser.add_argument('--quote-depth', type=int, default=4, help="回复中引用的最大层数")
+        parser.add_argument('--attachments', type=int, default=50)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--processes', type=int, default=None, help="传给rerender_markdown")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        prefix = 'gen{0}'.format(options['seed'])
+
+        with transaction.atomic():
+            NodeTag.objects.bulk_create([
+                NodeTag(name=u"{0}节点{1}".format(prefix, i), slug='{0}n{1}'.format(prefix, i)) for i in range(options['nodes'])
+            ])
+            nodes = list(NodeTag.objects.filter(slug__startswith=prefix + 'n').order_by('pk'))
+
+            # 所有用户使用同一个密码，只计算一次哈希
+            password = make_password('password')
+            User.objects.bulk_create([
+                User(username='{0}u{1}'.format(prefix, i), email='{0}u{1}@example.com'.format(prefix, i),
+                     password=password) for i in range(options['users'])
+            ], batch_size)
+            users = list(User.objects.filter(username__startswith=prefix + 'u').order_by('pk'))
+
+            # bulk_create不调用save()，renderer_version为0，之后由rerender_markdown统一渲染
+            Post.objects.bulk_create([
+                Post(title=self.sentence(rng, 3, 8), content=self.paragraphs(rng), node=rng.choice(nodes),
+                     author=rng.choice(users + [None]), bygod=rng.random() < 0.05,
+                     ip_addr='10.0.{0}.{1}'.format(i // 250 % 250, i % 250))
+                for i in range(options['posts'])
+            ], batch_size)
+            posts = list(Post.objects.filter(node__in=nodes).order_by('pk').values_list('pk', flat=True))
+
+            # 有引用的回复引用同一主题中较新的某条回复，bulk_create之后才知道主键，先记录序号
+            replies, thread_replies, quotes = [], {}, {}
+            for i in range(options['replies']):
+                # 帕累托分布，少数主题有很多页回复
+                post_pk = posts[min(int(rng.paretovariate(1.2)) - 1, len(posts) - 1)] if posts else None
+                depth = rng.randint(0, options['quote_depth'])
+                earlier = thread_replies.setdefault(post_pk, [])
+                if depth and earlier:
+                    quotes.setdefault(rng.choice(earlier[-10:]), []).append(i)
+                earlier.append(i)
+                replies.append(Reply(title='Re', content=self.reply_content(rng, depth),
+                                     post_node_id=post_pk, author=rng.choice(users + [None]),
+                                     ip_addr='10.1.{0}.{1}'.format(i // 250 % 250, i % 250)))
+                if len(replies) >= batch_size:
+                    Reply.objects.bulk_create(replies)
+                    replies = []
+            Reply.objects.bulk_create(replies)
+
+            reply_pks = list(Reply.objects.filter(post_node__in=posts).order_by('pk').values_list('pk', flat=True))
+            for target, children in quotes.items():
+                Reply.objects.filter(pk__in=[reply_pks[i] for i in children]).update(reply_to=reply_pks[target])
+
+        for i in range(options['attachments']):
+            if i % 2:
+                data = BytesIO()
+                Image.new('RGB', (rng.randint(100, 2000), rng.randint(100, 2000)),
+                          tuple(rng.randint(0, 255) for _ in range(3))).save(data, 'PNG')
+                upload = ContentFile(data.getvalue(), name='image{0}.png'.format(i))
+            else:
+                upload = ContentFile(self.paragraphs(rng).encode('utf-8'), name='file{0}.txt'.format(i))
+            Attachment.objects.create(attachment=upload, user=rng.choice(users + [None]),
+                                      remark=self.sentence(rng, 2, 5))
+
+        verbosity = int(options['verbosity'])
+        call_command('rerender_markdown', processes=options['processes'], verbosity=verbosity,
+                     stdout=self.stdout)
+        call_command('repair_thread_counters', verbosity=verbosity, stdout=self.stdout)
+        call_command('compact_hot_threads', rebuild=True, verbosity=verbosity, stdout=self.stdout)
+        call_command('rebuild_reply_tree', verbosity=verbosity, stdout=self.stdout)
+        try:
+            call_command('rebuild_search_index', verbosity=verbosity, stdout=self.stdout)
+        except Exception as e:
+            self.stderr.write("Search index not rebuilt: {0}".format(e))
+
+        self.stdout.write("{0} nodes, {1} users, {2} posts, {3} replies, {4} attachments created".format(
+            len(nodes), len(users), len(posts), options['replies'], options['attachments']))
+
+    def sentence(self, rng, min_words, max_words):
+        return u" ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+    def paragraphs(self, rng):
+        parts = [self.sentence(rng, 10, 40) for _ in range(rng.randint(1, 4))]
+        if rng.random() < 0.5:
+            parts.insert(1, u"```python\n{0}\n```".format(rng.choice(CODE_SAMPLES)))
+        return u"\n\n".join(parts)
+
+    def reply_content(self, rng, depth):
+        lines = []
+        for level in range(depth, 0, -1):
+            quote = u"> " * level
+            lines.append(u"{0}**以下内容引用自用户{1}：**".format(quote, rng.randint(1, 100)))
+            lines.append(quote.rstrip())
+            lines.append(quote + self.sentence(rng, 5, 20))
+            lines.append(u"")
+        if rng.random() < 0.3:
+            lines.append(u"```\n{0}\n```".format(rng.choice(CODE_SAMPLES)))
+            lines.append(u"")
+        lines.append(self.sentence(rng, 5, 30))
+        return u"\n".join(lines)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Count, F, Max
+
+from ... import cache
+from ...models import NodeTag, Post, Reply, Attachment, StoredFile
+from ...transfer import RECORD_TYPES, build_instance, keep_timestamps
+
+MODELS = dict((record_type, model) for record_type, model, fields, foreign_keys in RECORD_TYPES)
+
+
+class Command(BaseCommand):
+    help = ("从export_forum导出的JSONL导入内容：分批bulk_create，重新分配主键，"
+            "不发送通知邮件，Markdown由rerender_markdown的进程池统一渲染，引用路径由rebuild_reply_tree计算")
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', nargs='?', default='-', help="输入文件，默认为stdin")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--processes', type=int, default=None, help="传给rerender_markdown")
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        # SQLite的bulk_create不返回主键，所以直接分配主键，并记录 导出时的主键 -> 新主键
+        self.next_pk = dict((t, (m.objects.aggregate(m=Max('pk'))['m'] or 0) + 1) for t, m in MODELS.items())
+        # 导入的记录主键都不小于它，之后的命令只需要处理这些记录
+        first_pk = dict(self.next_pk)
+        self.id_map = dict((t, {}) for t in MODELS)
+        self.users = {}
+        self.pending = []
+        self.buffer, self.buffer_type = [], None
+        self.counts = dict((t, 0) for t in MODELS)
+
+        stream = sys.stdin if options['input'] == '-' else open(options['input'])
+        try:
+            with transaction.atomic(), keep_timestamps(*MODELS.values()):
+                for line_no, line in enumerate(stream, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        raise CommandError("Line {0} is not valid JSON".format(line_no))
+                    self.add(record)
+                self.flush()
+                self.fix_pending()
+                self.fix_stored_files()
+                self.reset_sequences()
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.stdout.write(", ".join("{0} {1}s".format(n, t) for t, n in sorted(self.counts.items())) + " imported")
+        verbosity = int(options['verbosity'])
+        call_command('rerender_markdown', processes=options['processes'], min_post_pk=first_pk['post'],
+                     min_reply_pk=first_pk['reply'], verbosity=verbosity, stdout=self.stdout)
+        call_command('repair_thread_counters', min_post_pk=first_pk['post'], verbosity=verbosity,
+                     stdout=self.stdout)
+        call_command('compact_hot_threads', rebuild=True, verbosity=verbosity, stdout=self.stdout)
+        call_command('rebuild_reply_tree', min_pk=first_pk['reply'], verbosity=verbosity, stdout=self.stdout)
+        try:
+            call_command('rebuild_search_index', verbosity=verbosity, stdout=self.stdout)
+        except CommandError as e:
+            self.stderr.write("Search index not rebuilt: {0}".format(e))
+        cache.bump(cache.INDEX_ADMIN_POSTS, cache.INDEX_LATEST_POSTS, cache.INDEX_LATEST_REPLIES, cache.FEED,
+                   cache.POST_COUNT, cache.ATTACHMENT_COUNT, cache.NODES, cache.HOT_THREADS)
+
+    def add(self, record):
+        record_type = record.get('type')
+        if record_type not in MODELS:
+            raise CommandError("Unknown record type: {0}".format(record_type))
+        if record_type != self.buffer_type or len(self.buffer) >= self.batch_size:
+            self.flush()
+            self.buffer_type = record_type
+        self.buffer.append(record)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        record_type, records = self.buffer_type, self.buffer
+        self.buffer = []
+        self.load_users(records)
+
+        if record_type == 'node':
+            # 已经存在同名代号的节点时直接使用
+            existing = dict(NodeTag.objects.filter(slug__in=[r['slug'] for r in records]).values_list('slug', 'pk'))
+            for r in records:
+                if r['slug'] in existing:
+                    self.id_map['node'][r['id']] = existing[r['slug']]
+            records = [r for r in records if r['slug'] not in existing]
+
+        instances = []
+        for record in records:
+            pk = self.next_pk[record_type]
+            self.next_pk[record_type] += 1
+            # 先登记，同一批中引用前面记录的回复也能找到
+            self.id_map[record_type][record['id']] = pk
+            instance, pending = build_instance(record, pk, self.id_map, self.users)
+            instances.append(instance)
+            self.pending.extend((record_type, pk, fk, target_type, old_id) for fk, target_type, old_id in pending)
+        MODELS[record_type].objects.bulk_create(instances)
+        self.counts[record_type] += len(instances)
+
+    def load_users(self, records):
+        names = set()
+        for record in records:
+            names.update(record.get(field) for field in ('author', 'user') if record.get(field))
+        names -= set(self.users)
+        if names:
+            found = dict(User.objects.filter(username__in=names).values_list('username', 'pk'))
+            # 目标站点没有的用户记为游客
+            self.users.update((name, found.get(name)) for name in names)
+
+    def fix_pending(self):
+        """
+        引用了文件中更靠后的记录的外键，全部导入之后再更新
+        """
+        for record_type, pk, fk, target_type, old_id in self.pending:
+            MODELS[record_type].objects.filter(pk=pk).update(**{fk + '_id': self.id_map[target_type].get(old_id)})
+
+    def fix_stored_files(self):
+        """
+        按内容存储的附件增加引用数，文件已经复制过来但没有StoredFile记录时补上
+        """
+        imported = list(self.id_map['attachment'].values())
+        for i in range(0, len(imported), self.batch_size):
+            batch = Attachment.objects.filter(pk__in=imported[i:i + self.batch_size], digest__isnull=False)
+            for row in batch.order_by().values('digest', 'attachment', 'size').annotate(n=Count('pk')):
+                updated = StoredFile.objects.filter(digest=row['digest']).update(ref_count=F('ref_count') + row['n'])
+                if not updated and default_storage.exists(row['attachment']):
+                    StoredFile.objects.create(digest=row['digest'], name=row['attachment'], size=row['size'] or 0,
+                                              ref_count=row['n'])
+                elif not updated:
+                    batch.filter(digest=row['digest']).update(missing=True)
+
+    def reset_sequences(self):
+        # 直接写入了主键，PostgreSQL等数据库需要更新序列
+        statements = connection.ops.sequence_reset_sql(no_style(), list(MODELS.values()))
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
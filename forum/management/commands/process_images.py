@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ...images import process_job, webp_enabled
+from ...models import StoredFile, ImageVariant
+
+
+class Command(BaseCommand):
+    help = "用进程池为等待处理的图片生成缩略图和网页优化版本"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--processes', type=int, default=None,
+                            help="进程数，默认为CPU核数，设为1时不使用进程池")
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help="持续运行，每隔--interval秒检查一次")
+        parser.add_argument('--interval', type=float, default=10)
+
+    def handle(self, *args, **options):
+        processes = options['processes'] or multiprocessing.cpu_count()
+        # fork之前关闭数据库连接，子进程只处理图片，不访问数据库
+        connection.close()
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            while True:
+                done, failed = self.process_pending(pool, options['batch_size'])
+                if done or failed or int(options['verbosity']) > 1:
+                    self.stdout.write("{0} images processed, {1} failed".format(done, failed))
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def process_pending(self, pool, batch_size):
+        done = failed = 0
+        webp = webp_enabled()
+        last_pk = 0
+        while True:
+            batch = list(StoredFile.objects.filter(
+                variants_status=StoredFile.VARIANTS_PENDING, pk__gt=last_pk
+            ).order_by('pk')[:batch_size])
+            if not batch:
+                return done, failed
+            last_pk = batch[-1].pk
+
+            jobs = [(stored.digest, default_storage.path(stored.name), webp) for stored in batch]
+            results = pool.map(process_job, jobs) if pool else [process_job(job) for job in jobs]
+            for digest, variants, error in results:
+                self.save_variants(digest, variants, error)
+                if error:
+                    failed += 1
+                    self.stderr.write("{0}: {1}".format(digest, error))
+                else:
+                    done += 1
+
+    def save_variants(self, digest, variants, error):
+        names = set(v[3] for v in variants)
+        with transaction.atomic():
+            old = ImageVariant.objects.filter(digest=digest)
+            stale = [name for name in old.values_list('name', flat=True) if name not in names]
+            old.delete()
+            ImageVariant.objects.bulk_create([
+                ImageVariant(digest=digest, width=width, height=height, format=fmt, name=name, size=size)
+                for width, height, fmt, name, size in variants
+            ])
+            StoredFile.objects.filter(digest=digest).update(
+                variants_status=StoredFile.VARIANTS_FAILED if error else StoredFile.VARIANTS_READY,
+                variants_error=error or ''
+            )
+        for name in stale:
+            default_storage.delete(name)
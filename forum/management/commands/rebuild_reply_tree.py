@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import Reply, tree_segment, TREE_SEGMENT_LENGTH, TREE_MAX_DEPTH
+
+
+class Command(BaseCommand):
+    help = "按主键顺序分批重新计算所有回复的引用路径(tree_path)和层数，只更新发生变化的回复"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--min-pk', type=int, default=0,
+                            help="只处理主键不小于它的回复，它们引用的回复的路径必须是正确的")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_pk, changed = options['min_pk'] - 1, 0
+        while True:
+            rows = list(Reply.objects.filter(pk__gt=last_pk).order_by('pk')
+                        .values_list('pk', 'reply_to_id', 'tree_path')[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            # 主键更小的回复已经处理过了，它们的路径可以直接使用
+            parents = set(row[1] for row in rows if row[1] and row[1] < row[0])
+            known = dict(Reply.objects.filter(pk__in=parents).values_list('pk', 'tree_path'))
+            with transaction.atomic():
+                for pk, reply_to_id, old_path in rows:
+                    self.current = pk
+                    path = known[pk] = self.get_path(pk, reply_to_id, known, set())
+                    if path != old_path:
+                        Reply.objects.filter(pk=pk).update(tree_path=path,
+                                                           depth=len(path) // TREE_SEGMENT_LENGTH - 1)
+                        changed += 1
+
+        self.stdout.write("{0} reply paths updated".format(changed))
+
+    def get_path(self, pk, reply_to_id, known, seen):
+        if reply_to_id is None or reply_to_id in seen:
+            parent_path = ''
+        elif reply_to_id < self.current:
+            parent_path = known.get(reply_to_id)
+            if parent_path is None:
+                parent_path = Reply.objects.filter(pk=reply_to_id).values_list('tree_path', flat=True).first() or ''
+        else:
+            # 引用了主键更大的回复(编辑过引用关系)，它的路径还没有更新，沿着引用链计算
+            seen.add(pk)
+            parent_reply_to = Reply.objects.filter(pk=reply_to_id).values_list('reply_to_id', flat=True).first()
+            parent_path = self.get_path(reply_to_id, parent_reply_to, known, seen)
+        if len(parent_path) // TREE_SEGMENT_LENGTH >= TREE_MAX_DEPTH:
+            parent_path = ''
+        return parent_path + tree_segment(pk)
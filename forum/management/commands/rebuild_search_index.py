@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ... import search
+from ...models import Post, Reply
+
+
+class Command(BaseCommand):
+    help = "重建全文搜索索引(forum_search)，按主键分批读取Post和Reply"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if not search.create_table(drop=True):
+                raise CommandError("Full-text search requires SQLite with the FTS5 extension")
+            for model, fields in ((Post, ('pk', 'title', 'content')), (Reply, ('pk', 'post_node_id', 'content'))):
+                count = 0
+                for rows in self.batches(model.objects.order_by('pk').values_list(*fields), options['batch_size']):
+                    search.index_documents([search.get_document(model(**dict(zip(fields, row)))) for row in rows])
+                    count += len(rows)
+                self.stdout.write("{0}: {1} rows indexed".format(model._meta.verbose_name_plural, count))
+
+    def batches(self, queryset, batch_size):
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not rows:
+                break
+            yield rows
+            last_pk = rows[-1][0]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.encoding import force_text
+
+from ... import cache
+from ...models import Attachment
+from ...storage import guess_content_type
+
+
+class Command(BaseCommand):
+    help = "扫描一遍MEDIA_ROOT，更新附件的missing标记，并补全旧附件的文件大小和类型"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        # 传入unicode路径，os.walk返回的文件名才能和数据库中的比较
+        root = force_text(settings.MEDIA_ROOT)
+        # 只列目录，不对每个文件stat
+        existing = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel = os.path.relpath(dirpath, root)
+            for filename in filenames:
+                existing.add(os.path.normpath(os.path.join(rel, filename)))
+
+        lost, found, filled = [], [], 0
+        rows = Attachment.objects.order_by().values_list(
+            'pk', 'attachment', 'missing', 'size', 'content_type', 'image_format', 'is_image'
+        )
+        with transaction.atomic():
+            for pk, name, missing, size, content_type, image_format, is_image in rows.iterator():
+                exists = bool(name) and os.path.normpath(name) in existing
+                if exists == missing:
+                    (found if exists else lost).append(pk)
+                if exists and (size is None or not content_type) and not options['dry_run']:
+                    Attachment.objects.filter(pk=pk).update(
+                        size=os.path.getsize(os.path.join(root, name)),
+                        content_type=content_type or guess_content_type(name, image_format if is_image else None)
+                    )
+                    filled += 1
+
+            if not options['dry_run']:
+                batch_size = options['batch_size']
+                for pks, missing in ((lost, True), (found, False)):
+                    for i in range(0, len(pks), batch_size):
+                        Attachment.objects.filter(pk__in=pks[i:i + batch_size]).update(missing=missing)
+
+        cache.bump(cache.ATTACHMENT_COUNT)
+        self.stdout.write("{0} newly missing, {1} found again, {2} rows filled in".format(
+            len(lost), len(found), filled))
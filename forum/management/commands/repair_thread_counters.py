@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, Count, F, Max, Value, When
+
+from ... import cache
+from ...models import Post, Reply, NodeTag
+
+
+class Command(BaseCommand):
+    help = ("用聚合查询重新计算所有主题的reply_count、last_reply_at和last_replier，"
+            "以及所有节点的post_count、latest_post和last_active_at")
+
+    def add_arguments(self, parser):
+        # 每个主题在UPDATE中占7个参数，SQLite一条语句最多999个参数
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--min-post-pk', type=int, default=0,
+                            help="只修复主键不小于它的主题，以及这些主题所在的节点")
+
+    def handle(self, *args, **options):
+        min_pk = options['min_post_pk']
+        stats = Reply.objects.filter(post_node__gte=min_pk).order_by().values('post_node').annotate(
+            count=Count('pk'), last=Max('pk')
+        )
+        stats = dict((row['post_node'], (row['count'], row['last'])) for row in stats)
+
+        batch_size = options['batch_size']
+        post_pks = list(stats)
+        with transaction.atomic():
+            # 先把所有主题重置为没有回复的状态，再写入有回复的主题
+            Post.objects.filter(pk__gte=min_pk).update(reply_count=0, last_reply_at=F('created'), last_replier=None)
+            for i in range(0, len(post_pks), batch_size):
+                batch = post_pks[i:i + batch_size]
+                last_replies = Reply.objects.filter(pk__in=[stats[pk][1] for pk in batch]).select_related('author')
+                rows = [(reply.post_node_id, {
+                    'reply_count': stats[reply.post_node_id][0],
+                    'last_reply_at': reply.created,
+                    'last_replier': reply.get_author_info()[0],
+                }) for reply in last_replies]
+                if not rows:
+                    continue
+                # 一批主题用一条UPDATE ... CASE写入
+                Post.objects.filter(pk__in=[pk for pk, values in rows]).update(**dict(
+                    (name, self.case(rows, name)) for name in ('reply_count', 'last_reply_at', 'last_replier')
+                ))
+
+        self.stdout.write("{0} threads with replies repaired".format(len(post_pks)))
+
+        # 节点的统计依赖上面更新过的last_reply_at
+        nodes = NodeTag.objects.all()
+        if min_pk:
+            nodes = nodes.filter(pk__in=set(Post.objects.filter(pk__gte=min_pk).values_list('node', flat=True)))
+        node_stats = Post.objects.filter(node__in=nodes).order_by().values('node').annotate(
+            count=Count('pk'), latest=Max('pk'), active=Max('last_reply_at'))
+        with transaction.atomic():
+            nodes.update(post_count=0, latest_post=None, last_active_at=None)
+            for row in node_stats:
+                NodeTag.objects.filter(pk=row['node']).update(post_count=row['count'], latest_post=row['latest'],
+                                                              last_active_at=row['active'])
+        cache.bump(cache.NODES, cache.POST_COUNT)
+        self.stdout.write("{0} nodes repaired".format(len(node_stats)))
+
+    def case(self, rows, name):
+        field = Post._meta.get_field(name)
+        return Case(*[When(pk=pk, then=Value(values[name], output_field=field)) for pk, values in rows],
+                    output_field=field)
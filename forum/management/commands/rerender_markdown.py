@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ... import cache
+from ...models import Post, Reply
+from ...renderer import RENDERER_VERSION, render_rows
+
+
+class Command(BaseCommand):
+    help = "用进程池分批重新渲染renderer_version过期的Post和Reply"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False,
+                            help="忽略renderer_version，重新渲染所有内容")
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--processes', type=int, default=None,
+                            help="进程数，默认为CPU核数，设为1时不使用进程池")
+        parser.add_argument('--min-post-pk', type=int, default=0, help="只渲染主键不小于它的主题")
+        parser.add_argument('--min-reply-pk', type=int, default=0, help="只渲染主键不小于它的回复")
+
+    def handle(self, *args, **options):
+        processes = options['processes'] or multiprocessing.cpu_count()
+        # fork之前关闭数据库连接，子进程只负责渲染，不访问数据库
+        connection.close()
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            for model, min_pk in ((Post, options['min_post_pk']), (Reply, options['min_reply_pk'])):
+                count = self.rerender(model, pool, processes, options['batch_size'], options['all'], min_pk)
+                self.stdout.write("{0}: {1} rows rendered".format(model._meta.verbose_name_plural, count))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        # update()不会发送信号，需要手动让缓存的页面失效
+        cache.bump(cache.INDEX_LATEST_REPLIES, cache.THREAD_PAGES, cache.FEED)
+
+    def rerender(self, model, pool, processes, batch_size, force, min_pk=0):
+        queryset = model.objects.order_by('pk')
+        if not force:
+            queryset = queryset.filter(renderer_version__lt=RENDERER_VERSION)
+
+        def next_batch(last_pk):
+            rows = list(queryset.filter(pk__gt=last_pk).values_list('pk', 'content')[:batch_size])
+            if not rows:
+                return None, last_pk
+            if pool is None:
+                return render_rows(rows), rows[-1][0]
+            # 把一批拆成processes份并行渲染
+            size = max(len(rows) // processes, 1)
+            chunks = [rows[i:i + size] for i in range(0, len(rows), size)]
+            return pool.map_async(render_rows, chunks), rows[-1][0]
+
+        count = 0
+        pending, last_pk = next_batch(min_pk - 1)
+        while pending is not None:
+            results = pending if pool is None else [row for chunk in pending.get() for row in chunk]
+            # 写入这一批的同时，进程池已经在渲染下一批
+            pending, last_pk = next_batch(last_pk)
+            with transaction.atomic():
+                for pk, content_md, digest in results:
+                    model.objects.filter(pk=pk).update(content_md=content_md, content_hash=digest,
+                                                       renderer_version=RENDERER_VERSION)
+            count += len(results)
+        return count
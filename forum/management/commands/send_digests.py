@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ...mailer import MAIL_BACKENDS, queue_digests, deliver_outbox
+
+
+class Command(BaseCommand):
+    help = ("把等待汇总的回复通知合并为每个收件人一封邮件(每个主题只列出一次)写入发件箱，"
+            "然后用同一个连接发送发件箱中所有到期的邮件")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="每个事务处理的收件人数")
+        parser.add_argument('--interval', type=int, default=None,
+                            help="同一个收件人两次汇总的最短间隔(秒)，默认为FORUM_DIGEST_INTERVAL")
+        parser.add_argument('--backend', default=None,
+                            help="邮件backend，可以是{0}或完整路径，默认使用EMAIL_BACKEND".format(
+                                '/'.join(sorted(MAIL_BACKENDS))))
+        parser.add_argument('--no-send', action='store_true', default=False,
+                            help="只写入发件箱，由send_outbox发送")
+
+    def handle(self, *args, **options):
+        queued = queue_digests(options['batch_size'], options['interval'])
+        self.stdout.write("{0} digests queued".format(queued))
+        if not options['no_send']:
+            sent, failed = deliver_outbox(options['backend'])
+            self.stdout.write("{0} sent, {1} failed".format(sent, failed))
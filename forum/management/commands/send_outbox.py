@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...mailer import MAIL_BACKENDS, deliver_outbox
+
+
+class Command(BaseCommand):
+    help = "分批发送发件箱(OutboxMail)中到期的通知邮件"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', default=None,
+                            help="邮件backend，可以是{0}或完整路径，默认使用EMAIL_BACKEND".format(
+                                '/'.join(sorted(MAIL_BACKENDS))))
+        parser.add_argument('--file-path', default=None,
+                            help="使用file backend时邮件的保存目录")
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--max-attempts', type=int, default=None)
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help="持续运行，每隔--interval秒检查一次发件箱")
+        parser.add_argument('--interval', type=float, default=10)
+
+    def handle(self, *args, **options):
+        backend_kwargs = {}
+        if options['file_path']:
+            backend_kwargs['file_path'] = options['file_path']
+
+        while True:
+            try:
+                sent, failed = deliver_outbox(options['backend'], options['batch_size'],
+                                              options['max_attempts'], **backend_kwargs)
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                self.stderr.write("Cannot connect to mail server: {0}".format(e))
+            else:
+                if sent or failed or int(options['verbosity']) > 1:
+                    self.stdout.write("{0} sent, {1} failed".format(sent, failed))
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
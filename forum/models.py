@@ -2,13 +2,19 @@
 
 from __future__ import unicode_literals
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.core.urlresolvers import reverse
-from django.core import validators
+from django.core import signing, validators
+from django.core.files.storage import default_storage
 from django.conf import settings
-from django.core.mail import send_mass_mail
-import markdown
+from django.utils import timezone
+from django.utils.http import int_to_base36
 from .utility import get_file_path
+from .storage import store_file, release_file, guess_content_type
+from .images import prefetch_variants
+from .instrumentation import timer
+from .renderer import RENDERER_VERSION, content_hash, render as render_markdown
+from . import ranking
 from PIL import Image
 import os.path
 import datetime
@@ -35,6 +41,9 @@ class PostBase(DateTimeBase):
                                verbose_name="内容")
     author = models.ForeignKey(User, blank=True, null=True, related_name='%(class)s', on_delete=models.SET_NULL)
     content_md = models.TextField(blank=True, null=True)
+    # 渲染content_md时content的sha1和渲染器版本，见forum/renderer.py
+    content_hash = models.CharField(max_length=40, blank=True, null=True, editable=False)
+    renderer_version = models.PositiveSmallIntegerField(default=0, editable=False, db_index=True)
     bygod = models.BooleanField(blank=True, default=False,
                                 help_text="☞将这篇文章归入管理员文集",
                                 verbose_name="归档")
@@ -61,19 +70,21 @@ class PostBase(DateTimeBase):
         else:
             return self.guest_name, self.guest_email
 
+    def render_content(self, force=False):
+        """
+        content没有变化且渲染器版本相同时跳过Markdown渲染，例如管理员只修改了bygod
+        """
+        digest = content_hash(self.content)
+        if (force or self.content_md is None or digest != self.content_hash or
+                self.renderer_version != RENDERER_VERSION):
+            with timer('markdown'):
+                self.content_md = render_markdown(self.content)
+            self.content_hash = digest
+            self.renderer_version = RENDERER_VERSION
+
     def save(self, *args, **kwargs):
         self.bygod = self.bygod if getattr(self.author, 'is_superuser', False) else False
-        self.content_md = markdown.markdown(
-            self.content,
-            safe_mode='escape',
-            output_format='html5',
-            extensions=[
-                'markdown.extensions.extra',
-                'markdown.extensions.sane_lists',
-                'markdown.extensions.codehilite(noclasses=True, linenums=False)',
-                'markdown.extensions.toc'
-            ]
-        )
+        self.render_content()
         super(PostBase, self).save(*args, **kwargs)
         # ping_google() will make posting process slow if your server cannot connect with google servers
         # ie, host in china normally cannot ping google smoothly.
@@ -96,20 +107,73 @@ class NodeTag(DateTimeBase):
                                    help_text="☞关于节点讨论主题的简要描述",
                                    verbose_name="节点描述")
     slug = models.CharField(max_length=30, help_text="☞节点的英文简写", verbose_name="节点代号", unique=True)
+    # 以下字段由Post.save、主题删除时的信号和Reply.save增量更新，可以用repair_thread_counters命令重新计算
+    post_count = models.PositiveIntegerField("主题数", default=0, editable=False)
+    latest_post = models.ForeignKey('Post', blank=True, null=True, related_name='+', editable=False,
+                                    on_delete=models.SET_NULL)
+    last_active_at = models.DateTimeField("最后活跃时间", blank=True, null=True, editable=False)
 
     def get_absolute_url(self):
         return reverse('nodetag-detail', kwargs={'slug': self.slug})
 
+    @staticmethod
+    def refresh_counters(pk):
+        """
+        主题被删除或移到其它节点后重新统计，只在这种很少发生的情况下使用聚合查询
+        """
+        if pk is None:
+            return
+        stats = Post.objects.filter(node=pk).aggregate(
+            count=models.Count('pk'), latest=models.Max('pk'), active=models.Max('last_reply_at'))
+        NodeTag.objects.filter(pk=pk).update(post_count=stats['count'], latest_post=stats['latest'],
+                                             last_active_at=stats['active'])
+
     def __unicode__(self):
         return self.name
 
 
 class Post(PostBase):
     node = models.ForeignKey(NodeTag, null=True, related_name='posts', on_delete=models.SET_NULL)
+    # 以下字段由Reply.save和回复删除时的信号增量更新，可以用repair_thread_counters命令重新计算
+    reply_count = models.PositiveIntegerField("回复数", default=0, editable=False)
+    # 没有回复时为发帖时间，这样按活跃度排序时新帖不会排在最后
+    last_reply_at = models.DateTimeField("最后回复时间", blank=True, null=True, editable=False, db_index=True)
+    last_replier = models.CharField("最后回复人", max_length=30, blank=True, null=True, editable=False)
+
+    def __init__(self, *args, **kwargs):
+        super(Post, self).__init__(*args, **kwargs)
+        # 与Reply._saved_post_node_id相同，节点变化时需要更新新旧两个节点的计数
+        self._saved_node_id = self.__dict__.get('node_id')
 
     def get_absolute_url(self):
         return reverse('post-detail', kwargs={'pk': self.pk})
 
+    def save(self, *args, **kwargs):
+        is_new = self.pk is None
+        if self.last_reply_at is None:
+            self.last_reply_at = timezone.now()
+        with transaction.atomic():
+            super(Post, self).save(*args, **kwargs)
+            if is_new:
+                NodeTag.objects.filter(pk=self.node_id).update(
+                    post_count=models.F('post_count') + 1, latest_post=self.pk, last_active_at=self.created)
+                HotThread.objects.record(self.pk, self.created)
+            elif self._saved_node_id != self.node_id:
+                NodeTag.refresh_counters(self._saved_node_id)
+                NodeTag.refresh_counters(self.node_id)
+        self._saved_node_id = self.node_id
+
+    def refresh_last_reply(self):
+        """
+        删除或移动回复后重新查找最后一条回复
+        """
+        last_reply = self.replies.select_related('author').order_by('-pk').first()
+        if last_reply:
+            last_reply_at, last_replier = last_reply.created, last_reply.get_author_info()[0]
+        else:
+            last_reply_at, last_replier = self.created, None
+        Post.objects.filter(pk=self.pk).update(last_reply_at=last_reply_at, last_replier=last_replier)
+
     def get_full_url(self):
         return getattr(settings, "ABSOLUTE_URL_PREFIX", "http://localhost") + self.get_absolute_url()
 
@@ -118,11 +182,36 @@ class Post(PostBase):
 
     class Meta:
         ordering = ['-pk']
+        # keyset分页按(条件, pk)在索引上定位，见forum/paginator.py
+        index_together = [['node', 'id'], ['bygod', 'id']]
+
+
+def tree_segment(pk):
+    return int_to_base36(pk).rjust(TREE_SEGMENT_LENGTH, '0')
+
+
+def tree_range(prefix):
+    """
+    以prefix开头的路径都在[prefix, prefix + '~')之间，'~'比所有base36字符都大。
+    用范围查询而不是startswith，因为SQLite的LIKE不能使用普通索引
+    """
+    return prefix, prefix + '~'
 
 
 class Reply(PostBase):
     post_node = models.ForeignKey(Post, null=True, related_name='replies', on_delete=models.SET_NULL)
     reply_to = models.ForeignKey('self', blank=True, null=True, related_name='replies', on_delete=models.SET_NULL)
+    # 引用关系的物化路径：从最早被引用的回复到本回复，每个回复的主键转为7位base36依次连接，
+    # 一次范围查询就可以取出整个对话。超过TREE_MAX_DEPTH层时从本回复重新开始一条路径
+    tree_path = models.CharField("引用路径", max_length=255, blank=True, default='', editable=False, db_index=True)
+    depth = models.PositiveSmallIntegerField("引用层数", default=0, editable=False)
+
+    def __init__(self, *args, **kwargs):
+        super(Reply, self).__init__(*args, **kwargs)
+        # 记录读取时所属的主题，保存时如果发生变化需要同时更新新旧两个主题的计数
+        # 用__dict__是为了在post_node_id被defer时不触发额外的查询
+        self._saved_post_node_id = self.__dict__.get('post_node_id')
+        self._saved_reply_to_id = self.__dict__.get('reply_to_id')
 
     def get_absolute_url(self):
         if getattr(self.post_node, 'pk', None):
@@ -134,14 +223,117 @@ class Reply(PostBase):
         return u"#{0} reply of '{1}'".format(self.pk, getattr(self.post_node, 'title', 'A Deleted Post'))
 
     def save(self, *args, **kwargs):
-        super(Reply, self).save(*args, **kwargs)
-
-        notify_op = getattr(self.post_node, 'need_notification', False)
-        notify_cited = getattr(self.reply_to, 'need_notification', False)
-
-        if notify_op or notify_cited:
-            mails = []
-            post_url = self.post_node.get_full_url()
+        is_new = self.pk is None
+        # 通知邮件和回复在同一个事务中写入发件箱(OutboxMail)，由send_outbox命令异步发送，
+        # 这样发表回复时不需要等待邮件服务器
+        with transaction.atomic():
+            super(Reply, self).save(*args, **kwargs)
+            if is_new:
+                Post.objects.filter(pk=self.post_node_id).update(
+                    reply_count=models.F('reply_count') + 1,
+                    last_reply_at=self.created,
+                    last_replier=self.get_author_info()[0]
+                )
+                NodeTag.objects.filter(posts=self.post_node_id).update(last_active_at=self.created)
+                HotThread.objects.record(self.post_node_id, self.created)
+                with timer('mail'):
+                    self.queue_notifications()
+            elif self._saved_post_node_id != self.post_node_id:
+                self.detach_from_post(self._saved_post_node_id)
+                Post.objects.filter(pk=self.post_node_id).update(reply_count=models.F('reply_count') + 1)
+                if self.post_node:
+                    self.post_node.refresh_last_reply()
+            if is_new or self._saved_reply_to_id != self.reply_to_id:
+                self.update_tree_path()
+        self._saved_post_node_id = self.post_node_id
+        self._saved_reply_to_id = self.reply_to_id
+
+    def update_tree_path(self):
+        """
+        根据reply_to重新计算路径，原来有路径时同时更新所有引用了本回复的回复
+        """
+        old_path = self.tree_path
+        parent_path = self.reply_to.tree_path if self.reply_to_id else ''
+        if (old_path and parent_path.startswith(old_path)) or \
+                len(parent_path) // TREE_SEGMENT_LENGTH >= TREE_MAX_DEPTH:
+            # 引用了自己的后代(形成环)，或者太深了
+            parent_path = ''
+        self.tree_path = parent_path + tree_segment(self.pk)
+        self.depth = len(self.tree_path) // TREE_SEGMENT_LENGTH - 1
+        Reply.objects.filter(pk=self.pk).update(tree_path=self.tree_path, depth=self.depth)
+
+        if old_path and old_path != self.tree_path:
+            start, end = tree_range(old_path)
+            descendants = Reply.objects.filter(tree_path__gt=start, tree_path__lt=end)
+            for pk, path in descendants.values_list('pk', 'tree_path'):
+                path = self.tree_path + path[len(old_path):]
+                if len(path) > TREE_SEGMENT_LENGTH * TREE_MAX_DEPTH:
+                    path = path[-TREE_SEGMENT_LENGTH * TREE_MAX_DEPTH:]
+                Reply.objects.filter(pk=pk).update(tree_path=path, depth=len(path) // TREE_SEGMENT_LENGTH - 1)
+
+    def get_ancestor_pks(self):
+        path = self.tree_path
+        return [int(path[i:i + TREE_SEGMENT_LENGTH], 36) for i in range(0, len(path) - TREE_SEGMENT_LENGTH,
+                                                                        TREE_SEGMENT_LENGTH)]
+
+    def get_ancestors(self):
+        """
+        被本回复直接或间接引用的回复，从最早的开始
+        """
+        return Reply.objects.filter(pk__in=self.get_ancestor_pks()).order_by('tree_path')
+
+    def get_descendants(self):
+        if not self.tree_path:
+            return Reply.objects.none()
+        start, end = tree_range(self.tree_path)
+        return Reply.objects.filter(tree_path__gt=start, tree_path__lt=end).order_by('tree_path')
+
+    def get_conversation(self):
+        """
+        本回复所在的整个对话(从最早被引用的回复开始的整棵树)，按对话顺序排列。
+        还没有计算路径的旧回复(见rebuild_reply_tree命令)只返回它自己，空前缀会匹配所有回复
+        """
+        if not self.tree_path:
+            return Reply.objects.filter(pk=self.pk)
+        start, end = tree_range(self.tree_path[:TREE_SEGMENT_LENGTH])
+        return Reply.objects.filter(tree_path__gte=start, tree_path__lt=end).order_by('tree_path')
+
+    def detach_from_post(self, post_pk):
+        """
+        回复被删除或移到其它主题后，更新原主题的计数
+        """
+        post = Post.objects.filter(pk=post_pk).first()
+        if post:
+            Post.objects.filter(pk=post.pk, reply_count__gt=0).update(reply_count=models.F('reply_count') - 1)
+            post.refresh_last_reply()
+
+    def get_notification_receivers(self):
+        """
+        需要通知的(称呼, 邮箱, "文章"或"评论")，主题作者在前，同一个邮箱只通知一次
+        """
+        receivers = []
+        if getattr(self.post_node, 'need_notification', False):
+            receivers.append(self.post_node.get_author_info() + ("文章", ))
+        if getattr(self.reply_to, 'need_notification', False):
+            receivers.append(self.reply_to.get_author_info() + ("评论", ))
+
+        seen = set()
+        result = []
+        for name, email, kind in receivers:
+            if email and email.lower() not in seen:  # have a valid email address
+                seen.add(email.lower())
+                result.append((name, email, kind))
+        return result
+
+    def get_notification_mails(self, receivers=None):
+        """
+        生成需要发送给主题作者和被引用回复作者的通知邮件，返回值的格式与send_mass_mail的参数相同
+        """
+        if receivers is None:
+            receivers = self.get_notification_receivers()
+        mails = []
+        if receivers:
+            post_url = self.post_node.get_full_url() if self.post_node else ''
             from_email = getattr(settings, "DEFAULT_FROM_EMAIL", "root@localhost")
             subject_default = "{0}, {1}回应了您在[lcfcn.com]的{2}"
             date_string = datetime.date.today().isoformat()
@@ -157,36 +349,95 @@ class Reply(PostBase):
 {4}
 
 您在发文时同意了接收回复通知, 所以会收到这封邮件.
+如果希望每天只收到一封汇总邮件, 或者不再接收通知, 请访问:
+{6}
 
 {5}
 """
-
-            if notify_op:
-                receiver = self.post_node.get_author_info()
-                if receiver[1]: # have a valid email address
-                    sender = self.get_author_info()
-                    subject = subject_default.format(receiver[0], sender[0], "文章")
-                    message = message_default.format(receiver[0], sender[0], "文章",
-                                                     self.content, post_url,
-                                                     date_string)
-                    mails.append((subject, message, from_email, [self.post_node.get_author_info()[1], ]))
-
-            if notify_cited:
-                receiver = self.reply_to.get_author_info()
-                print receiver
-                if receiver[1]: # have a valid email address
-                    sender = self.get_author_info()
-                    subject = subject_default.format(receiver[0], sender[0], "评论")
-                    message = message_default.format(receiver[0], sender[0], "评论",
-                                                     self.content, post_url,
-                                                     date_string)
-                    mails.append((subject, message, from_email, [self.reply_to.get_author_info()[1], ]))
-
-            send_mass_mail(mails)
+            sender = self.get_author_info()
+            for name, email, kind in receivers:
+                subject = subject_default.format(name, sender[0], kind)
+                message = message_default.format(name, sender[0], kind, self.content, post_url, date_string,
+                                                 NotificationPreference.get_settings_url(email))
+                mails.append((subject, message, from_email, [email, ]))
+
+        return mails
+
+    def queue_notifications(self):
+        """
+        选择了汇总的收件人写入PendingNotification，由send_digests命令定期合并发送，其余的写入发件箱
+        """
+        receivers = self.get_notification_receivers()
+        if not receivers:
+            return
+        modes = NotificationPreference.objects.get_modes([email for name, email, kind in receivers])
+        instant, pending = [], []
+        for name, email, kind in receivers:
+            mode = modes.get(email.lower(), NotificationPreference.MODE_INSTANT)
+            if mode == NotificationPreference.MODE_DIGEST:
+                pending.append(PendingNotification(recipient=email.lower(), name=name, kind=kind, reply=self,
+                                                   post_node_id=self.post_node_id))
+            elif mode == NotificationPreference.MODE_INSTANT:
+                instant.append((name, email, kind))
+        if pending:
+            PendingNotification.objects.bulk_create(pending)
+        OutboxMail.objects.queue_mass_mail(self.get_notification_mails(instant))
 
     class Meta:
         verbose_name_plural = 'replies'
         ordering = ['-pk']
+        index_together = [['post_node', 'id'], ['bygod', 'id']]
+
+
+TREE_SEGMENT_LENGTH = 7
+TREE_MAX_DEPTH = Reply._meta.get_field('tree_path').max_length // TREE_SEGMENT_LENGTH
+
+
+class StoredFile(DateTimeBase):
+    """
+    按内容(sha256)存储的文件，内容相同的附件共用同一个文件，ref_count为引用它的附件数
+    """
+    digest = models.CharField("SHA256", max_length=64, unique=True)
+    name = models.CharField("存储路径", max_length=255)
+    size = models.BigIntegerField("文件大小", default=0)
+    ref_count = models.PositiveIntegerField("引用数", default=0)
+    # 图片的缩略图等版本，见forum/images.py
+    VARIANTS_NONE, VARIANTS_PENDING, VARIANTS_READY, VARIANTS_FAILED = 0, 1, 2, 3
+    VARIANTS_STATUS_CHOICES = (
+        (VARIANTS_NONE, "无"),
+        (VARIANTS_PENDING, "等待生成"),
+        (VARIANTS_READY, "已生成"),
+        (VARIANTS_FAILED, "生成失败"),
+    )
+    variants_status = models.PositiveSmallIntegerField("图片版本", choices=VARIANTS_STATUS_CHOICES,
+                                                       default=VARIANTS_NONE, db_index=True)
+    variants_error = models.TextField("错误信息", blank=True, default='')
+
+    def __unicode__(self):
+        return self.name
+
+
+class ImageVariant(models.Model):
+    """
+    图片的缩略图和网页优化版本，按原图内容(digest)保存
+    """
+    digest = models.CharField("SHA256", max_length=64, db_index=True)
+    width = models.PositiveIntegerField("宽度")
+    height = models.PositiveIntegerField("高度")
+    format = models.CharField("格式", max_length=10)
+    name = models.CharField("存储路径", max_length=255)
+    size = models.BigIntegerField("文件大小", default=0)
+
+    @property
+    def url(self):
+        return default_storage.url(self.name)
+
+    def __unicode__(self):
+        return self.name
+
+    class Meta:
+        ordering = ['width']
+        unique_together = [['digest', 'width', 'format']]
 
 
 class Attachment(DateTimeBase):
@@ -202,25 +453,61 @@ class Attachment(DateTimeBase):
                               help_text=u"文件上传后会被统一命名，建议加上备注以便查找")
     attachment = models.FileField('选择文件', null=True, upload_to=get_file_path,
                                   help_text="选择要上传的文件，请不要上传非法、危险以及涉及版权问题的文件")
+    # 文件按内容存储，见forum/storage.py
+    digest = models.CharField("SHA256", max_length=64, blank=True, null=True, editable=False, db_index=True)
+    original_name = models.CharField("原文件名", max_length=255, blank=True, null=True, editable=False)
+    # 上传时记录，列表和详情页不需要访问文件系统；missing由reconcile_attachments命令更新
+    size = models.BigIntegerField("文件大小", blank=True, null=True, editable=False)
+    content_type = models.CharField("文件类型", max_length=100, blank=True, default='', editable=False)
+    missing = models.BooleanField("文件丢失", default=False, editable=False)
+
+    def __init__(self, *args, **kwargs):
+        super(Attachment, self).__init__(*args, **kwargs)
+        self._saved_digest = self.__dict__.get('digest')
 
     def filename(self):
-        return os.path.basename(self.attachment.name)
+        return self.original_name or os.path.basename(self.attachment.name)
 
     def file_exists(self):
-        return self.attachment and os.path.isfile(self.attachment.path)
+        return bool(self.attachment) and not self.missing
 
     def save(self, *args, **kwargs):
-        try:
-            pic = Image.open(self.attachment)
-            self.is_image = True
-            self.image_format = pic.format
-            self.width, self.height = pic.size
-        except (IOError, UnicodeEncodeError):
-            # Pillow will cause UnicodeEncodeError if input filename is a unicode string
-            # and ONLY happens when input file is not a valid image format.
-            self.is_image = False
-            self.width, self.height = 0, 0
-        super(Attachment, self).save(*args, **kwargs)
+        if self.attachment and not self.attachment._committed:
+            # 新上传的文件
+            try:
+                pic = Image.open(self.attachment)
+                self.is_image = True
+                self.image_format = pic.format
+                self.width, self.height = pic.size
+            except (IOError, UnicodeEncodeError):
+                # Pillow will cause UnicodeEncodeError if input filename is a unicode string
+                # and ONLY happens when input file is not a valid image format.
+                self.is_image = False
+                self.width, self.height = 0, 0
+
+            with transaction.atomic():
+                stored = store_file(self.attachment.file)
+                if self.is_image and stored.variants_status == StoredFile.VARIANTS_NONE:
+                    # 由process_images命令在后台生成缩略图
+                    StoredFile.objects.filter(pk=stored.pk).update(variants_status=StoredFile.VARIANTS_PENDING)
+                self.original_name = os.path.basename(self.attachment.name)
+                self.digest = stored.digest
+                self.size = stored.size
+                self.content_type = guess_content_type(self.original_name, self.image_format if self.is_image else None)
+                self.missing = False
+                self.attachment.name = stored.name
+                self.attachment._committed = True
+                super(Attachment, self).save(*args, **kwargs)
+                # 替换了原来的文件
+                release_file(self._saved_digest)
+        else:
+            super(Attachment, self).save(*args, **kwargs)
+        self._saved_digest = self.digest
+
+    def get_variants(self):
+        if not hasattr(self, '_variants'):
+            prefetch_variants([self])
+        return self._variants
 
     def __unicode__(self):
         return "{0}({1})".format(self.filename(), self.remark)
@@ -229,4 +516,175 @@ class Attachment(DateTimeBase):
         return reverse('attachment-detail', kwargs={'pk': self.pk})
 
     class Meta:
-        ordering = ['-pk']
\ No newline at end of file
+        ordering = ['-pk']
+        # 附件列表按类型和上传人筛选
+        index_together = [['missing', 'is_image', 'id'], ['user', 'missing', 'id']]
+
+
+class HotThreadManager(models.Manager):
+    def record(self, post_id, when=None, weight=1):
+        """
+        主题有新的活动(发表或回复)时增加热度，见forum/ranking.py
+        """
+        if post_id is None:
+            return
+        score = ranking.activity_score(when, weight)
+        with transaction.atomic():
+            hot = self.select_for_update().filter(post=post_id).first()
+            if hot is None:
+                try:
+                    with transaction.atomic():
+                        self.create(post_id=post_id, score=score)
+                    return
+                except IntegrityError:
+                    # 另一个请求刚刚插入了这一行
+                    hot = self.select_for_update().get(post=post_id)
+            self.filter(post=post_id).update(score=ranking.add_scores(hot.score, score))
+
+    def top(self, limit):
+        return self.select_related('post__node', 'post__author').defer(
+            'post__content', 'post__content_md').order_by('-score')[:limit]
+
+
+class HotThread(models.Model):
+    """
+    有热度的主题，按score从高到低即为当前的热门主题。只保留最近活跃的主题，
+    由compact_hot_threads命令定期删除热度已经衰减到很低的行
+    """
+    post = models.OneToOneField(Post, primary_key=True, related_name='hot', on_delete=models.CASCADE)
+    score = models.FloatField("热度(对数)", db_index=True)
+
+    objects = HotThreadManager()
+
+    @property
+    def heat(self):
+        return ranking.heat(self.score)
+
+    def __unicode__(self):
+        return u"{0} ({1:.2f})".format(self.post_id, self.heat)
+
+
+class NotificationPreferenceManager(models.Manager):
+    def get_modes(self, emails):
+        """
+        {小写的邮箱: 通知方式}，没有设置过的邮箱不在结果中(即时通知)
+        """
+        emails = set(email.lower() for email in emails if email)
+        if not emails:
+            return {}
+        return dict(self.filter(email__in=emails).values_list('email', 'mode'))
+
+
+class NotificationPreference(DateTimeBase):
+    """
+    按邮箱设置的回复通知方式，登录用户和游客都适用。邮箱统一保存为小写
+    """
+    MODE_INSTANT = 0
+    MODE_DIGEST = 1
+    MODE_NONE = 2
+    MODE_CHOICES = (
+        (MODE_INSTANT, "每条回复发送一封邮件"),
+        (MODE_DIGEST, "定期汇总为一封邮件"),
+        (MODE_NONE, "不接收通知"),
+    )
+    SIGNING_SALT = 'forum.notification_preference'
+
+    email = models.EmailField("邮箱", max_length=254, unique=True)
+    mode = models.PositiveSmallIntegerField("通知方式", choices=MODE_CHOICES, default=MODE_INSTANT)
+    last_digest_at = models.DateTimeField("上次发送汇总的时间", blank=True, null=True, editable=False)
+
+    objects = NotificationPreferenceManager()
+
+    @classmethod
+    def make_token(cls, email):
+        return signing.dumps(email.lower(), salt=cls.SIGNING_SALT)
+
+    @classmethod
+    def check_token(cls, token):
+        """
+        返回token对应的邮箱，无效时返回None
+        """
+        try:
+            return signing.loads(token, salt=cls.SIGNING_SALT)
+        except signing.BadSignature:
+            return None
+
+    @classmethod
+    def get_settings_url(cls, email):
+        return getattr(settings, "ABSOLUTE_URL_PREFIX", "http://localhost") + reverse(
+            'notification-settings-token', kwargs={'token': cls.make_token(email)})
+
+    def __unicode__(self):
+        return u"{0}: {1}".format(self.email, self.get_mode_display())
+
+
+class PendingNotification(models.Model):
+    """
+    等待合并发送的回复通知，见send_digests命令
+    """
+    recipient = models.EmailField("收件人", max_length=254)
+    name = models.CharField("收件人称呼", max_length=30, blank=True, null=True)
+    kind = models.CharField("回复的对象", max_length=10)
+    post_node = models.ForeignKey(Post, null=True, related_name='+', on_delete=models.CASCADE)
+    reply = models.ForeignKey(Reply, related_name='+', on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u"{0} -> {1}".format(self.reply_id, self.recipient)
+
+    class Meta:
+        ordering = ['pk']
+        index_together = [['recipient', 'id']]
+
+
+class OutboxMailManager(models.Manager):
+    def queue_mass_mail(self, datatuple):
+        """
+        参数格式与django.core.mail.send_mass_mail相同，但只是把邮件写入发件箱，并不真正发送
+        """
+        mails = []
+        for subject, message, from_email, recipient_list in datatuple:
+            from_email = from_email or settings.DEFAULT_FROM_EMAIL
+            for recipient in recipient_list:
+                mails.append(self.model(subject=subject, message=message,
+                                        from_email=from_email, recipient=recipient))
+        if mails:
+            self.bulk_create(mails)
+        return len(mails)
+
+    def due(self, now=None):
+        return self.filter(status=self.model.STATUS_PENDING, next_attempt__lte=now or timezone.now())
+
+
+class OutboxMail(DateTimeBase):
+    """
+    待发送的通知邮件，每条记录只对应一个收件人
+    """
+    STATUS_PENDING = 0
+    STATUS_SENT = 1
+    STATUS_FAILED = 2
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "等待发送"),
+        (STATUS_SENT, "已发送"),
+        (STATUS_FAILED, "发送失败"),
+    )
+
+    subject = models.CharField("邮件标题", max_length=255)
+    message = models.TextField("邮件内容")
+    from_email = models.CharField("发件人", max_length=254)
+    recipient = models.EmailField("收件人", max_length=254)
+    status = models.PositiveSmallIntegerField("状态", choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField("尝试次数", default=0)
+    next_attempt = models.DateTimeField("下次尝试时间", default=timezone.now)
+    last_error = models.TextField("最近一次错误", blank=True, null=True)
+    sent_at = models.DateTimeField("发送时间", blank=True, null=True)
+
+    objects = OutboxMailManager()
+
+    def __unicode__(self):
+        return u"{0} -> {1}".format(self.subject, self.recipient)
+
+    class Meta:
+        ordering = ['pk']
+        # send_outbox每次按(status, next_attempt)取出到期的邮件
+        index_together = [['status', 'next_attempt']]
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+基于主键的keyset(seek)分页
+
+Django自带的Paginator用OFFSET翻页，页数越靠后越慢，?p=last还要先COUNT(*)再扫描到最后。
+这里在上一页/下一页的链接中带上当前页第一条/最后一条记录的主键，
+翻页时用 pk > cursor 或 pk < cursor 直接在索引上定位；最后一页则反向排序后取前几条。
+旧的 ?p=N 链接仍然可以使用，只是退回到OFFSET分页。
+总数由视图的get_count()提供(节点和主题的计数字段，或者forum.cache.cached_count)，不需要每次COUNT(*)。
+"""
+from django.core.paginator import Paginator, Page, InvalidPage
+from django.http import Http404
+from django.utils.http import urlencode
+
+KEYSET_ORDERINGS = {
+    ('pk', ): 'pk',
+    ('id', ): 'pk',
+    ('-pk', ): '-pk',
+    ('-id', ): '-pk',
+}
+
+
+class KeysetPage(Page):
+
+    def __init__(self, object_list, number, paginator):
+        # 需要知道第一条和最后一条记录的主键，所以直接转换成list
+        super(KeysetPage, self).__init__(list(object_list), number, paginator)
+
+    @property
+    def previous_cursor(self):
+        if self.paginator.ordering and self.object_list:
+            return self.object_list[0].pk
+
+    @property
+    def next_cursor(self):
+        if self.paginator.ordering and self.object_list:
+            return self.object_list[-1].pk
+
+    def previous_page_query(self):
+        query = [('p', self.previous_page_number())]
+        if self.previous_page_number() > 1 and self.previous_cursor:
+            query.append(('before', self.previous_cursor))
+        return urlencode(query)
+
+    def next_page_query(self):
+        query = [('p', self.next_page_number())]
+        if self.next_page_number() < self.paginator.num_pages and self.next_cursor:
+            query.append(('after', self.next_cursor))
+        return urlencode(query)
+
+
+class KeysetPaginator(Paginator):
+    """
+    object_list必须是按pk或-pk排序的QuerySet，否则所有的翻页都退回到OFFSET分页
+    """
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, count=None):
+        # orphans会让页的边界依赖于总数，keyset分页不支持
+        super(KeysetPaginator, self).__init__(object_list, per_page, 0, allow_empty_first_page)
+        if count is not None:
+            self._count = count
+        ordering = tuple(object_list.query.order_by or object_list.model._meta.ordering)
+        self.ordering = KEYSET_ORDERINGS.get(ordering)
+
+    def _get_page(self, *args, **kwargs):
+        return KeysetPage(*args, **kwargs)
+
+    def seek(self, cursor, forward):
+        """
+        从cursor开始往后(forward=True)或往前取一页，返回的记录始终按原顺序排列
+        """
+        ascending = (self.ordering == 'pk') == forward
+        lookup = 'pk__gt' if ascending else 'pk__lt'
+        rows = self.object_list.filter(**{lookup: cursor}).order_by('pk' if ascending else '-pk')
+        rows = list(rows[:self.per_page])
+        return rows if forward else rows[::-1]
+
+    def first_page(self):
+        return self._get_page(self.object_list[:self.per_page], 1, self)
+
+    def last_page(self):
+        number = self.num_pages
+        size = self.count - (number - 1) * self.per_page
+        if number == 1 or not self.ordering:
+            return self.page(number)
+        reverse = '-pk' if self.ordering == 'pk' else 'pk'
+        rows = list(self.object_list.order_by(reverse)[:size])
+        return self._get_page(rows[::-1], number, self)
+
+    def page_from_query(self, query, page_kwarg='p'):
+        """
+        根据请求参数返回对应的页: ?p=last、?p=N&after=pk、?p=N&before=pk 或者 ?p=N
+        """
+        number = query.get(page_kwarg) or 1
+        if number == 'last':
+            return self.last_page()
+
+        number = self.validate_number(number)
+        if number == 1:
+            return self.first_page()
+
+        if self.ordering:
+            for param, forward in (('after', True), ('before', False)):
+                try:
+                    cursor = int(query[param])
+                except (KeyError, ValueError):
+                    continue
+                if forward and number == self.num_pages:
+                    # 最后一页可能不满一页，用last_page()保证页边界与页码一致
+                    return self.last_page()
+                rows = self.seek(cursor, forward)
+                if not forward and len(rows) < self.per_page:
+                    # 往前翻到头了
+                    return self.first_page()
+                return self._get_page(rows, number, self)
+
+        return self.page(number)
+
+
+class KeysetPaginationMixin(object):
+    """
+    ListView的分页改用KeysetPaginator
+    """
+    paginator_class = KeysetPaginator
+
+    def get_count(self, queryset):
+        """
+        返回queryset的总数，返回None时由分页器执行COUNT(*)
+        """
+        return None
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = self.get_paginator(queryset, page_size, allow_empty_first_page=self.get_allow_empty(),
+                                       count=self.get_count(queryset))
+        try:
+            page = paginator.page_from_query(self.request.GET, self.page_kwarg)
+        except InvalidPage:
+            raise Http404("Invalid page")
+        return paginator, page, page.object_list, page.has_other_pages()
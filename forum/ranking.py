@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+热门主题的热度计算
+
+每次回复(或发表主题)给主题增加1点热度，热度每过FORUM_HOT_HALF_LIFE秒减半。
+主题在t时刻的热度为 sum(w * 2^((t_i - t) / h))，按这个值排序等价于按
+log2(sum(w * 2^(t_i / h))) 排序，后者与当前时间无关，新的回复到来时增量更新，
+可以直接保存在HotThread.score上并建索引。用对数保存是为了不溢出。
+"""
+from __future__ import unicode_literals
+import datetime
+import math
+
+from django.conf import settings
+from django.utils import timezone
+
+EPOCH = datetime.datetime(2015, 1, 1, tzinfo=timezone.utc)
+
+
+def get_half_life():
+    return getattr(settings, 'FORUM_HOT_HALF_LIFE', 24 * 3600)
+
+
+def time_score(when=None):
+    """
+    在when时刻发生的一次活动对应的分数，即log2(2^(t / h))
+    """
+    return ((when or timezone.now()) - EPOCH).total_seconds() / get_half_life()
+
+
+def add_scores(a, b):
+    """
+    log2(2^a + 2^b)，a或b为None时表示没有活动
+    """
+    if a is None or b is None:
+        return b if a is None else a
+    high, low = max(a, b), min(a, b)
+    return high + math.log(1 + 2 ** (low - high), 2)
+
+
+def activity_score(when=None, weight=1):
+    return time_score(when) + math.log(weight, 2)
+
+
+def heat(score, now=None):
+    """
+    score换算成now时刻的热度(衰减后的活动次数)
+    """
+    return 2 ** (score - time_score(now))
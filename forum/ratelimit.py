@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+发帖、回复、注册、上传的频率限制(令牌桶)
+
+游客按IP(get_client_ip)计数，登录用户按用户计数，管理员不受限制。
+每个scope的速率在FORUM_RATELIMITS中配置，格式为"次数/时间"，例如"5/m"表示每分钟5次，
+时间单位可以是s/m/h/d或者秒数，设为None表示不限制。
+FORUM_RATELIMIT_BACKEND为'memory'时令牌桶保存在进程内的LRU中(单进程部署)，
+为'cache'时保存在Django缓存中，多个worker共享(读写不是原子的，并发时可能多放过几个请求)。
+视图用ratelimit标记，由RateLimitMiddleware在process_view中检查，
+它排在CsrfViewMiddleware之前，超过限制的请求直接返回429，不会解析表单或者渲染页面。
+"""
+from __future__ import unicode_literals
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from .utility import get_client_ip, LRUCache
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """
+    "5/m" -> (5, 60)
+    """
+    count, period = rate.split('/')
+    period = PERIODS[period] if period in PERIODS else int(period)
+    return int(count), period
+
+
+def get_rate(scope):
+    rate = getattr(settings, 'FORUM_RATELIMITS', {}).get(scope)
+    return parse_rate(rate) if rate else None
+
+
+def take_token(state, capacity, period, now):
+    """
+    state为(剩余令牌数, 上次更新时间)或None，返回(新的state, 需要等待的秒数)，等待0秒表示允许
+    """
+    tokens, last = state or (capacity, now)
+    tokens = min(capacity, tokens + (now - last) * capacity / float(period))
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) * period / float(capacity)
+
+
+class MemoryBackend(object):
+
+    def __init__(self):
+        self.buckets = LRUCache(getattr(settings, 'FORUM_RATELIMIT_MAX_KEYS', 10000))
+        self.lock = threading.Lock()
+
+    def hit(self, key, capacity, period):
+        with self.lock:
+            state, wait = take_token(self.buckets.get(key), capacity, period, time.time())
+            self.buckets.set(key, state)
+        return wait
+
+    def clear(self):
+        self.buckets.clear()
+
+
+class CacheBackend(object):
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def hit(self, key, capacity, period):
+        key = 'forum:ratelimit:{0}'.format(key)
+        state, wait = take_token(self.cache.get(key), capacity, period, time.time())
+        # 令牌桶period秒后一定是满的，不需要再保存
+        self.cache.set(key, state, period)
+        return wait
+
+    def clear(self):
+        pass
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if getattr(settings, 'FORUM_RATELIMIT_BACKEND', 'memory') == 'cache':
+            _backend = CacheBackend(getattr(settings, 'FORUM_RATELIMIT_CACHE', 'default'))
+        else:
+            _backend = MemoryBackend()
+    return _backend
+
+
+def get_key(request, scope):
+    if request.user.is_authenticated():
+        return '{0}:user:{1}'.format(scope, request.user.pk)
+    return '{0}:ip:{1}'.format(scope, get_client_ip(request))
+
+
+def is_limited(request, scope):
+    """
+    返回需要等待的秒数，没有超过限制时返回0
+    """
+    rate = get_rate(scope)
+    if rate is None or request.user.is_superuser:
+        return 0
+    return get_backend().hit(get_key(request, scope), *rate)
+
+
+def ratelimit(scope, methods=('POST', )):
+    """
+    标记视图函数或者(通过method_decorator)dispatch，只限制methods中的请求。
+    和csrf_exempt一样只设置属性，检查由RateLimitMiddleware完成
+    """
+    def decorator(view_func):
+        view_func.ratelimit = (scope, methods)
+        return view_func
+    return decorator
+
+
+class RateLimitMiddleware(object):
+    """
+    需要放在CsrfViewMiddleware之前，CSRF检查会读取request.POST
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        scope, methods = getattr(view_func, 'ratelimit', (None, ()))
+        if request.method not in methods:
+            return None
+        wait = is_limited(request, scope)
+        if wait:
+            response = HttpResponse("操作太频繁，请{0}秒后再试。".format(int(wait) + 1),
+                                    content_type='text/plain; charset=utf-8', status=429)
+            response['Retry-After'] = str(int(wait) + 1)
+            return response
+        return None
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+PostBase.content的Markdown渲染
+
+markdown.markdown()每次调用都会重新解析扩展参数并创建新的Markdown实例，
+这里为每个线程保留一个配置好的实例，用完后reset()即可复用。
+修改渲染选项(扩展、codehilite参数等)后需要增加RENDERER_VERSION，
+然后运行 `python manage.py rerender_markdown` 重新渲染旧的内容。
+
+代码高亮是渲染中最慢的部分，同一段代码又经常被引用多次，所以高亮结果按
+(代码的sha1, 语言, 高亮选项)保存在进程内的LRU缓存中，主题和回复共用。
+高亮输出CSS类名，样式在forum/static/forum/pygments.css，更换Pygments样式后用
+`pygmentize -S default -f html -a .codehilite > forum/static/forum/pygments.css` 重新生成。
+"""
+from __future__ import unicode_literals
+import hashlib
+import threading
+
+import markdown
+from django.conf import settings
+from markdown.extensions.codehilite import CodeHilite, CodeHiliteExtension, HiliteTreeprocessor, parse_hl_lines
+from markdown.extensions.fenced_code import FencedBlockPreprocessor
+
+from .utility import LRUCache
+
+RENDERER_VERSION = 2
+
+_local = threading.local()
+
+highlight_cache = LRUCache(getattr(settings, 'FORUM_HIGHLIGHT_CACHE_SIZE', 512))
+
+
+class CachedCodeHilite(CodeHilite):
+
+    def hilite(self):
+        key = (hashlib.sha1(self.src.encode('utf-8')).hexdigest(), self.lang, self.linenums, self.guess_lang,
+               self.css_class, self.style, self.noclasses, tuple(self.hl_lines), self.tab_length, self.use_pygments)
+        html = highlight_cache.get(key)
+        if html is None:
+            html = super(CachedCodeHilite, self).hilite()
+            highlight_cache.set(key, html)
+        return html
+
+
+class CachedHiliteTreeprocessor(HiliteTreeprocessor):
+    """
+    与HiliteTreeprocessor相同，只是使用CachedCodeHilite(缩进的代码块)
+    """
+
+    def run(self, root):
+        for block in root.iter('pre'):
+            if len(block) == 1 and block[0].tag == 'code':
+                code = CachedCodeHilite(
+                    block[0].text,
+                    linenums=self.config['linenums'],
+                    guess_lang=self.config['guess_lang'],
+                    css_class=self.config['css_class'],
+                    style=self.config['pygments_style'],
+                    noclasses=self.config['noclasses'],
+                    tab_length=self.markdown.tab_length,
+                    use_pygments=self.config['use_pygments']
+                )
+                placeholder = self.markdown.htmlStash.store(code.hilite(), safe=True)
+                block.clear()
+                block.tag = 'p'
+                block.text = placeholder
+
+
+class CachedFencedBlockPreprocessor(FencedBlockPreprocessor):
+    """
+    与FencedBlockPreprocessor相同，只是使用CachedCodeHilite(```包围的代码块)
+    """
+
+    def run(self, lines):
+        config = self.codehilite_conf
+        text = "\n".join(lines)
+        while True:
+            m = self.FENCED_BLOCK_RE.search(text)
+            if not m:
+                break
+            code = CachedCodeHilite(
+                m.group('code'),
+                linenums=config['linenums'][0],
+                guess_lang=config['guess_lang'][0],
+                css_class=config['css_class'][0],
+                style=config['pygments_style'][0],
+                use_pygments=config['use_pygments'][0],
+                lang=(m.group('lang') or None),
+                noclasses=config['noclasses'][0],
+                hl_lines=parse_hl_lines(m.group('hl_lines'))
+            ).hilite()
+            placeholder = self.markdown.htmlStash.store(code, safe=True)
+            text = '%s\n%s\n%s' % (text[:m.start()], placeholder, text[m.end():])
+        return text.split("\n")
+
+
+class CachedCodeHiliteExtension(CodeHiliteExtension):
+    """
+    代替markdown.extensions.codehilite，需要放在extra(fenced_code)之后
+    """
+
+    def extendMarkdown(self, md, md_globals):
+        hiliter = CachedHiliteTreeprocessor(md)
+        hiliter.config = self.getConfigs()
+        md.treeprocessors.add('hilite', hiliter, '<inline')
+        if 'fenced_code_block' in md.preprocessors:
+            fenced = CachedFencedBlockPreprocessor(md)
+            fenced.codehilite_conf = self.config
+            md.preprocessors['fenced_code_block'] = fenced
+        md.registerExtension(self)
+
+
+MARKDOWN_OPTIONS = {
+    'safe_mode': 'escape',
+    'output_format': 'html5',
+    'extensions': [
+        'markdown.extensions.extra',
+        'markdown.extensions.sane_lists',
+        CachedCodeHiliteExtension(noclasses=False, linenums=False),
+        'markdown.extensions.toc',
+    ],
+}
+
+
+def get_markdown():
+    md = getattr(_local, 'md', None)
+    if md is None:
+        md = _local.md = markdown.Markdown(**MARKDOWN_OPTIONS)
+    return md
+
+
+def render(text):
+    md = get_markdown()
+    try:
+        return md.convert(text or '')
+    finally:
+        md.reset()
+
+
+def content_hash(text):
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
+
+
+def render_row(row):
+    """
+    供进程池使用: (pk, content) -> (pk, content_md, content_hash)
+    """
+    pk, text = row
+    return pk, render(text), content_hash(text)
+
+
+def render_rows(rows):
+    return [render_row(row) for row in rows]
@@ -1,6 +1,13 @@
 # -*- coding:utf-8 -*-
+import datetime
+import hashlib
 
 from django.contrib.syndication.views import Feed
+from django.http import HttpResponse
+from django.utils.http import parse_http_date_safe
+from django.views.decorators.http import condition
+
+from . import cache
 from .models import Post
 
 class PostsByAdminFeed(Feed):
@@ -8,11 +15,38 @@ class PostsByAdminFeed(Feed):
     link = "/rss/"
     description = u"Lcf的个人网站上发布的最新内容。"
 
+    def __call__(self, request, *args, **kwargs):
+        # 阅读器会频繁地轮询，生成好的文档缓存起来，站长发布的文章变化时由forum/signals.py失效
+        key = 'feed:{0}:{1}'.format(request.get_host(), cache.get_version(cache.FEED))
+        document = cache.cached(key, lambda: self.build_document(request, *args, **kwargs))
+
+        @condition(etag_func=lambda request: document['etag'],
+                   last_modified_func=lambda request: document['last_modified'])
+        def serve(request):
+            return HttpResponse(document['content'], content_type=document['content_type'])
+        return serve(request)
+
+    def build_document(self, request, *args, **kwargs):
+        response = super(PostsByAdminFeed, self).__call__(request, *args, **kwargs)
+        last_modified = parse_http_date_safe(response.get('Last-Modified', ''))
+        return {
+            'content': response.content,
+            'content_type': response['Content-Type'],
+            'etag': hashlib.md5(response.content).hexdigest(),
+            'last_modified': datetime.datetime.utcfromtimestamp(last_modified) if last_modified else None,
+        }
+
     def items(self):
-        return Post.objects.filter(bygod=1)[:20]
+        return Post.objects.filter(bygod=1).defer('content')[:20]
 
     def item_title(self, item):
         return item.title
 
     def item_description(self, item):
         return item.content_md
+
+    def item_pubdate(self, item):
+        return item.created
+
+    def item_updateddate(self, item):
+        return item.last_edited
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+基于SQLite FTS5的全文搜索
+
+FTS5自带的unicode61分词器会把一整段中文当成一个词，所以写入和查询前都先用tokenize()分词:
+中日韩文字按相邻两个字切分(bigram)，其它文字按单词切分并转为小写，再用空格连接后交给FTS5。
+写入索引时每段中日韩文字的最后一个字还会单独作为一个词，查询单个汉字时用前缀查询，
+这样每个字都能匹配到以它开头的bigram或者段尾的单字。
+索引表forum_search由post_migrate信号创建，Post和Reply保存/删除时由forum/signals.py增量更新，
+也可以用 `python manage.py rebuild_search_index` 重建。
+"""
+from __future__ import unicode_literals
+import re
+
+from django.db import connection, DatabaseError
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import Post, Reply
+
+FTS_TABLE = 'forum_search'
+# 每条记录的rowid为 pk * 2 + KIND，这样不需要额外的映射表
+KIND_POST = 0
+KIND_REPLY = 1
+
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+TOKEN_RE = re.compile('([{0}]+)|([^\\W_{0}]+)'.format(CJK_CHARS), re.UNICODE)
+
+_table_ready = False
+
+
+def tokenize(text, index=False):
+    """
+    index为True时用于写入索引，多个字的中日韩文字段后面加上最后一个字
+    """
+    tokens = []
+    for cjk, word in TOKEN_RE.findall(text or ''):
+        if word:
+            tokens.append(word.lower())
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            if index:
+                tokens.append(cjk[-1])
+    return tokens
+
+
+def build_match_query(query):
+    """
+    把用户输入转换成FTS5的查询表达式，所有词都必须出现(AND)。
+    单个汉字用前缀查询，匹配以它开头的bigram，或者(在一段文字末尾时)索引中单独的这个字
+    """
+    terms = []
+    for token in tokenize(query):
+        term = '"{0}"'.format(token.replace('"', '""'))
+        if len(token) == 1 and re.match('[{0}]'.format(CJK_CHARS), token):
+            term += '*'
+        terms.append(term)
+    return ' '.join(terms)
+
+
+def is_enabled():
+    global _table_ready
+    if connection.vendor != 'sqlite':
+        return False
+    if not _table_ready:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=%s", [FTS_TABLE])
+            _table_ready = cursor.fetchone() is not None
+    return _table_ready
+
+
+def create_table(drop=False):
+    global _table_ready
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        if drop:
+            cursor.execute("DROP TABLE IF EXISTS {0}".format(FTS_TABLE))
+        try:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5("
+                "title, body, post_id UNINDEXED, tokenize='unicode61')".format(FTS_TABLE)
+            )
+        except DatabaseError:
+            # SQLite编译时没有启用FTS5
+            return False
+    _table_ready = True
+    return True
+
+
+def get_rowid(instance):
+    return instance.pk * 2 + (KIND_REPLY if isinstance(instance, Reply) else KIND_POST)
+
+
+def get_document(instance):
+    """
+    返回(rowid, title, body, post_id)。回复的标题都是"Re:主题标题"，不参与索引
+    """
+    if isinstance(instance, Reply):
+        return get_rowid(instance), '', ' '.join(tokenize(instance.content, True)), instance.post_node_id
+    text = ' '.join(tokenize(instance.content, True))
+    return get_rowid(instance), ' '.join(tokenize(instance.title, True)), text, instance.pk
+
+
+def index_documents(documents):
+    """
+    documents为get_document()返回值的列表，已有的同一rowid的记录会被替换
+    """
+    if not documents or not is_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany("DELETE FROM {0} WHERE rowid = %s".format(FTS_TABLE),
+                           [(doc[0], ) for doc in documents])
+        cursor.executemany(
+            "INSERT INTO {0} (rowid, title, body, post_id) VALUES (%s, %s, %s, %s)".format(FTS_TABLE), documents
+        )
+
+
+def index_object(instance):
+    index_documents([get_document(instance)])
+
+
+def unindex_object(instance):
+    if not is_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM {0} WHERE rowid = %s".format(FTS_TABLE), [get_rowid(instance)])
+
+
+def make_snippet(text, terms, width=120):
+    """
+    在原文中找到第一个命中的词，截取前后共width个字符，并用<mark>标出所有命中的词
+    """
+    text = text or ''
+    pattern = re.compile('|'.join(re.escape(t) for t in sorted(set(terms), key=len, reverse=True)),
+                         re.IGNORECASE | re.UNICODE) if terms else None
+    match = pattern.search(text) if pattern else None
+    start = max(match.start() - width // 3, 0) if match else 0
+    fragment = text[start:start + width]
+
+    result, last = [], 0
+    for m in (pattern.finditer(fragment) if pattern else []):
+        result.append(escape(fragment[last:m.start()]))
+        result.append('<mark>{0}</mark>'.format(escape(m.group())))
+        last = m.end()
+    result.append(escape(fragment[last:]))
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if start + width < len(text) else ''
+    return mark_safe(prefix + ''.join(result) + suffix)
+
+
+class SearchResults(object):
+    """
+    支持count()和切片，可以直接交给Paginator。切片时才执行查询，并批量读取对应的Post和Reply
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.match = build_match_query(query)
+        self.terms = query.split() + tokenize(query)
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            if not self.match or not is_enabled():
+                self._count = 0
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT COUNT(*) FROM {0} WHERE {0} MATCH %s".format(FTS_TABLE), [self.match])
+                    self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        if not self.count():
+            return []
+        offset = index.start or 0
+        limit = (index.stop - offset) if index.stop is not None else -1
+        with connection.cursor() as cursor:
+            # bm25()越小越相关，标题的权重是正文的5倍
+            cursor.execute(
+                "SELECT rowid, bm25({0}, 5.0, 1.0, 0.0) AS score FROM {0} WHERE {0} MATCH %s "
+                "ORDER BY score LIMIT %s OFFSET %s".format(FTS_TABLE),
+                [self.match, limit, offset]
+            )
+            rows = cursor.fetchall()
+        return self.load_objects([rowid for rowid, score in rows])
+
+    def load_objects(self, rowids):
+        posts = Post.objects.defer('content_md').in_bulk([r // 2 for r in rowids if r % 2 == KIND_POST])
+        replies = Reply.objects.defer('content_md').select_related('post_node').in_bulk(
+            [r // 2 for r in rowids if r % 2 == KIND_REPLY]
+        )
+
+        results = []
+        for rowid in rowids:
+            if rowid % 2 == KIND_POST:
+                obj = posts.get(rowid // 2)
+                post = obj
+            else:
+                obj = replies.get(rowid // 2)
+                post = getattr(obj, 'post_node', None)
+            if obj is None:
+                continue
+            results.append({
+                'object': obj,
+                'is_reply': obj is not post,
+                'title': getattr(post, 'title', obj.title),
+                'url': obj.get_absolute_url(),
+                'snippet': make_snippet(obj.content, self.terms),
+            })
+        return results
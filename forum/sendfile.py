@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+附件下载
+
+支持单个区间的Range请求(断点续传)、强ETag以及If-None-Match/If-Range。
+FORUM_ATTACHMENT_SERVE设置文件由谁发送:
+    'django' - 用固定大小的缓冲区分块读取，以StreamingHttpResponse返回(默认)
+    'sendfile' - 返回X-Sendfile头，由Apache(mod_xsendfile)/lighttpd发送文件
+    'accel' - 返回X-Accel-Redirect头，由nginx发送文件，
+              需要把FORUM_ATTACHMENT_ACCEL_PREFIX配置为指向MEDIA_ROOT的internal location
+后两种方式下Range请求由前端服务器处理。
+"""
+from __future__ import unicode_literals
+import os
+import re
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, urlquote
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_serve_mode():
+    return getattr(settings, 'FORUM_ATTACHMENT_SERVE', 'django')
+
+
+def get_etag(attachment):
+    if attachment.digest:
+        # 按内容存储的文件，内容变化时digest一定变化
+        return '"{0}"'.format(attachment.digest)
+    return '"{0}-{1}"'.format(attachment.pk, int(os.path.getmtime(attachment.attachment.path)))
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    return header.strip() == '*' or etag in [tag.strip() for tag in header.split(',')]
+
+
+def parse_range(header, size):
+    """
+    返回(start, end)，end包含在内；不是单个区间或者格式不对时返回None(发送整个文件)，
+    区间超出文件大小时返回False(416)
+    """
+    match = RANGE_RE.match(header.replace(' ', '')) if header else None
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        # bytes=-500 表示最后500个字节
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def file_iterator(path, start, length, chunk_size):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def get_disposition(attachment):
+    disposition = 'inline' if attachment.is_image else 'attachment'
+    # RFC 5987，旧浏览器使用ASCII的filename
+    filename = attachment.filename()
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'download'
+    return '{0}; filename="{1}"; filename*=UTF-8\'\'{2}'.format(disposition, ascii_name, urlquote(filename))
+
+
+def serve_attachment(request, attachment):
+    """
+    返回附件的下载响应，文件不存在时抛出IOError/OSError
+    """
+    path = attachment.attachment.path
+    size = os.path.getsize(path)
+    etag = get_etag(attachment)
+    last_modified = http_date(os.path.getmtime(path))
+
+    if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    mode = get_serve_mode()
+    if mode in ('sendfile', 'accel'):
+        response = HttpResponse(content_type=attachment.content_type or 'application/octet-stream')
+        if mode == 'sendfile':
+            response['X-Sendfile'] = path
+        else:
+            prefix = getattr(settings, 'FORUM_ATTACHMENT_ACCEL_PREFIX', '/protected/')
+            response['X-Accel-Redirect'] = urlquote(prefix.rstrip('/') + '/' + attachment.attachment.name)
+    else:
+        byte_range = None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if not if_range or if_range == etag or (
+                parse_http_date_safe(if_range) and parse_http_date_safe(if_range) >= int(os.path.getmtime(path))):
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{0}'.format(size)
+            return response
+
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1 if size else 0
+        chunk_size = getattr(settings, 'FORUM_ATTACHMENT_CHUNK_SIZE', 64 * 1024)
+        body = [] if request.method == 'HEAD' else file_iterator(path, start, length, chunk_size)
+        response = StreamingHttpResponse(body, content_type=attachment.content_type or 'application/octet-stream')
+        response['Content-Length'] = str(length)
+        if byte_range:
+            response.status_code = 206
+            response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, size)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    response['Content-Disposition'] = get_disposition(attachment)
+    return response
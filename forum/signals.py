@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+模型之间的联动更新。批量删除(QuerySet.delete)不会调用Model.delete，所以删除相关的逻辑都放在信号里
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import cache, search
+from .models import Post, Reply, NodeTag, Attachment
+from .storage import release_file
+
+
+@receiver(post_delete, sender=Reply, dispatch_uid='forum_reply_deleted')
+def reply_deleted(sender, instance, **kwargs):
+    if instance.post_node_id:
+        instance.detach_from_post(instance.post_node_id)
+
+
+@receiver(post_save, sender=Post, dispatch_uid='forum_search_index_post')
+@receiver(post_save, sender=Reply, dispatch_uid='forum_search_index_reply')
+def update_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_object(instance)
+
+
+@receiver(post_delete, sender=Post, dispatch_uid='forum_search_unindex_post')
+@receiver(post_delete, sender=Reply, dispatch_uid='forum_search_unindex_reply')
+def remove_from_search_index(sender, instance, **kwargs):
+    search.unindex_object(instance)
+
+
+def create_search_table(sender, **kwargs):
+    search.create_table()
+
+
+@receiver(post_save, sender=Post, dispatch_uid='forum_index_cache_post_saved')
+def post_saved(sender, instance, created, **kwargs):
+    cache.bump(cache.INDEX_LATEST_POSTS)
+    # 节点的主题数变化了，post_save在Post.save更新_saved_node_id之前发送
+    if created or instance._saved_node_id != instance.node_id:
+        cache.bump(cache.NODES)
+    if created:
+        cache.bump(cache.POST_COUNT)
+    # 新发表的普通文章不会影响站长发布，修改文章时无法知道修改前是否归档，所以都失效
+    if instance.bygod or not created:
+        cache.bump(cache.INDEX_ADMIN_POSTS, cache.FEED)
+
+
+@receiver(post_delete, sender=Post, dispatch_uid='forum_index_cache_post_deleted')
+def post_deleted(sender, instance, **kwargs):
+    NodeTag.refresh_counters(instance.node_id)
+    # 回复的post_node会被置为NULL，最新回复的链接也会变化
+    cache.bump(cache.INDEX_LATEST_POSTS, cache.INDEX_LATEST_REPLIES, cache.NODES, cache.POST_COUNT)
+    if instance.bygod:
+        cache.bump(cache.INDEX_ADMIN_POSTS, cache.FEED)
+
+
+@receiver(post_save, sender=Reply, dispatch_uid='forum_index_cache_reply_saved')
+@receiver(post_delete, sender=Reply, dispatch_uid='forum_index_cache_reply_deleted')
+def reply_changed(sender, instance, **kwargs):
+    cache.bump(cache.INDEX_LATEST_REPLIES)
+    # post_save在Reply.save更新_saved_post_node_id之前发送，回复被移动时两个主题都要失效
+    cache.bump_thread(instance.post_node_id)
+    if instance._saved_post_node_id != instance.post_node_id:
+        cache.bump_thread(instance._saved_post_node_id)
+
+
+@receiver(post_save, sender=Post, dispatch_uid='forum_thread_cache_post_saved')
+def thread_changed(sender, instance, **kwargs):
+    cache.bump_thread(instance.pk)
+
+
+@receiver(post_delete, sender=Post, dispatch_uid='forum_thread_cache_post_deleted')
+def thread_deleted(sender, instance, **kwargs):
+    cache.clear_thread(instance.pk)
+
+
+@receiver(post_save, sender=NodeTag, dispatch_uid='forum_index_cache_node_saved')
+@receiver(post_delete, sender=NodeTag, dispatch_uid='forum_index_cache_node_deleted')
+def node_changed(sender, instance, **kwargs):
+    # 首页的文章列表和主题页面都显示了节点名称
+    cache.bump(cache.INDEX_ADMIN_POSTS, cache.INDEX_LATEST_POSTS, cache.THREAD_PAGES, cache.NODES)
+
+
+@receiver(post_delete, sender=Attachment, dispatch_uid='forum_attachment_deleted')
+def attachment_deleted(sender, instance, **kwargs):
+    release_file(instance.digest)
+
+
+@receiver(post_save, sender=Attachment, dispatch_uid='forum_attachment_count_saved')
+@receiver(post_delete, sender=Attachment, dispatch_uid='forum_attachment_count_deleted')
+def attachment_changed(sender, instance, **kwargs):
+    cache.bump(cache.ATTACHMENT_COUNT)
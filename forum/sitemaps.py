@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+分段的sitemap
+
+/sitemap.xml 是sitemap索引，每一段(sitemap-<section>.xml?p=N)对应一段固定的主键区间，
+而不是用OFFSET分页，所以每一段都只需要在索引上按主键范围查询，生成时间和内存占用与主题总数无关。
+删除过主题的区间里记录会少于limit条，这不影响搜索引擎。
+"""
+from django.conf import settings
+from django.contrib.sitemaps import Sitemap
+from django.core.paginator import Paginator, Page
+from django.db.models import Min, Max
+
+from .models import Post
+
+
+class PkRangePaginator(Paginator):
+    """
+    第N页为主键在 (first_pk - 1 + (N - 1) * per_page, first_pk - 1 + N * per_page] 之间的记录
+    """
+
+    def __init__(self, object_list, per_page):
+        super(PkRangePaginator, self).__init__(object_list, per_page)
+        self._bounds = None
+
+    def get_bounds(self):
+        if self._bounds is None:
+            bounds = self.object_list.order_by().aggregate(first=Min('pk'), last=Max('pk'))
+            self._bounds = bounds['first'], bounds['last']
+        return self._bounds
+
+    def _get_num_pages(self):
+        first, last = self.get_bounds()
+        if first is None:
+            return 1 if self.allow_empty_first_page else 0
+        return (last - first) // self.per_page + 1
+    num_pages = property(_get_num_pages)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        first, last = self.get_bounds()
+        if first is None:
+            return Page([], number, self)
+        start = first - 1 + (number - 1) * self.per_page
+        rows = self.object_list.filter(pk__gt=start, pk__lte=start + self.per_page).order_by('pk')
+        return Page(list(rows), number, self)
+
+
+class PostSitemap(Sitemap):
+    limit = getattr(settings, 'FORUM_SITEMAP_SECTION_SIZE', 5000)
+
+    def __init__(self, bygod, priority):
+        self.bygod = bygod
+        self.priority = priority
+
+    def items(self):
+        # 只需要生成链接和lastmod
+        return Post.objects.filter(bygod=self.bygod).only('pk', 'last_edited')
+
+    @property
+    def paginator(self):
+        return PkRangePaginator(self.items(), self.limit)
+
+    def lastmod(self, item):
+        return item.last_edited
+
+
+sitemaps = {
+    'thread_by_admin': PostSitemap(True, 0.7),
+    'threads': PostSitemap(False, 0.5),
+}
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+按内容寻址的附件存储
+
+上传的文件边读边计算sha256(每次只读一个chunk，不会整个读进内存)，
+然后保存到 cas/ab/cd/<sha256><扩展名>。内容相同的文件只保存一份，
+StoredFile.ref_count记录引用它的附件数，减到0时删除文件。
+已有的按日期存放的附件可以用 `python manage.py dedupe_uploads` 迁移。
+"""
+from __future__ import unicode_literals
+import hashlib
+import mimetypes
+import os
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from PIL import Image
+
+from .images import delete_variants
+
+CAS_DIR = 'cas'
+
+
+def hash_file(f):
+    """
+    返回(sha256, 文件大小)，f可以是UploadedFile或普通的文件对象
+    """
+    sha = hashlib.sha256()
+    size = 0
+    if hasattr(f, 'seek'):
+        f.seek(0)
+    chunks = f.chunks() if hasattr(f, 'chunks') else iter(lambda: f.read(64 * 1024), b'')
+    for chunk in chunks:
+        sha.update(chunk)
+        size += len(chunk)
+    if hasattr(f, 'seek'):
+        f.seek(0)
+    return sha.hexdigest(), size
+
+
+def guess_content_type(filename, image_format=None):
+    """
+    图片使用Pillow识别出的格式，其它文件按扩展名判断
+    """
+    if image_format and image_format in Image.MIME:
+        return Image.MIME[image_format]
+    return mimetypes.guess_type(filename or '')[0] or 'application/octet-stream'
+
+
+def get_digest_path(digest, filename=''):
+    ext = os.path.splitext(filename)[1].lower()
+    return '{0}/{1}/{2}/{3}{4}'.format(CAS_DIR, digest[:2], digest[2:4], digest, ext)
+
+
+def store_file(f, digest=None, size=None):
+    """
+    保存文件并增加引用数，返回对应的StoredFile。需要在事务中调用。
+    SQLite不支持select_for_update，同时上传相同的新文件时只有一个能创建记录，
+    另一个删除自己保存的文件，改为增加已有记录的引用数
+    """
+    from .models import StoredFile
+
+    if digest is None:
+        digest, size = hash_file(f)
+    stored = StoredFile.objects.select_for_update().filter(digest=digest).first()
+    if stored is not None and default_storage.exists(stored.name):
+        # 重复的文件，只增加引用数
+        StoredFile.objects.filter(pk=stored.pk).update(ref_count=F('ref_count') + 1)
+        stored.ref_count += 1
+        return stored
+
+    name = default_storage.save(get_digest_path(digest, getattr(f, 'name', None) or ''), f)
+    if stored is None:
+        try:
+            with transaction.atomic():
+                return StoredFile.objects.create(digest=digest, name=name, size=size, ref_count=1)
+        except IntegrityError:
+            stored = StoredFile.objects.get(digest=digest)
+            if name != stored.name:
+                default_storage.delete(name)
+            StoredFile.objects.filter(pk=stored.pk).update(ref_count=F('ref_count') + 1)
+            stored.ref_count += 1
+    else:
+        # 记录存在但文件丢失了
+        stored.name, stored.size = name, size
+        stored.ref_count += 1
+        stored.save()
+    return stored
+
+
+def release_file(digest):
+    """
+    减少引用数，没有附件引用时删除文件
+    """
+    from .models import StoredFile
+
+    if not digest:
+        return
+    StoredFile.objects.filter(digest=digest, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+    stored = StoredFile.objects.filter(digest=digest, ref_count__lte=0).first()
+    if stored is not None:
+        delete_variants(digest)
+        default_storage.delete(stored.name)
+        stored.delete()
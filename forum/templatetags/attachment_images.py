@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from django import template
+
+from ..images import pick_variant
+
+register = template.Library()
+
+
+@register.filter(name='variant_url')
+def variant_url(attachment, width):
+    """
+    {{ attachment|variant_url:240 }}，没有合适的版本时返回原图地址
+    """
+    variant = pick_variant(attachment.get_variants(), int(width))
+    return variant.url if variant else attachment.attachment.url
+
+
+@register.inclusion_tag('forum/attachment_image.html')
+def attachment_image(attachment, width=640):
+    """
+    {% attachment_image attachment 640 %}，输出宽度合适的<picture>，有WebP版本时优先使用
+    """
+    variants = attachment.get_variants()
+    image = pick_variant(variants, int(width))
+    webp = pick_variant(variants, int(width), 'webp')
+    return {
+        'attachment': attachment,
+        'src': image.url if image else attachment.attachment.url,
+        'width': image.width if image else attachment.width,
+        'height': image.height if image else attachment.height,
+        'webp': webp if webp and image and webp.width == image.width else None,
+    }
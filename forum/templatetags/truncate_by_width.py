@@ -1,11 +1,61 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import re
 
 from django import template
-from ..utility import get_screen_width
+from django.conf import settings
+from ..utility import get_screen_width, LRUCache
 
 register = template.Library()
 
+# 首页上的标题和回复摘要每次都一样，缓存截取的结果。键里只保存摘要，不保存整个字符串
+_truncated = LRUCache(getattr(settings, 'FORUM_TRUNCATE_CACHE_SIZE', 2048))
+
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+def get_digest(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
 
 @register.filter(name='truncate_by_width')
 def truncate_by_width(value, max_width):
-    return get_screen_width(value, max_width)
\ No newline at end of file
+    key = (get_digest(value), max_width)
+    result = _truncated.get(key)
+    if result is None:
+        result = get_screen_width(value, max_width)
+        _truncated.set(key, result)
+    return result
+
+
+def strip_tags_prefix(html, max_width):
+    """
+    依次取出标签之间的文字，宽度超过max_width后就不再往下处理，
+    对结果截取max_width与对整段HTML去掉标签后再截取相同
+    """
+    text, width, last = [], 0, 0
+    for match in TAG_RE.finditer(html):
+        piece = html[last:match.start()]
+        text.append(piece)
+        last = match.end()
+        width += get_screen_width(piece)
+        if width > max_width:
+            return u''.join(text)
+    text.append(html[last:])
+    return u''.join(text)
+
+
+@register.filter(name='content_preview')
+def content_preview(post, max_width):
+    """
+    主题或回复的摘要：去掉content_md中的标签后按宽度截取，只处理开头够用的部分。
+    按(主键, 内容的sha1, 渲染器版本)缓存
+    """
+    content_md = post.content_md or u''
+    key = ('preview', post._meta.concrete_model.__name__, post.pk, post.content_hash or get_digest(content_md),
+           post.renderer_version, max_width)
+    result = _truncated.get(key)
+    if result is None:
+        result = get_screen_width(strip_tags_prefix(content_md, max_width), max_width)
+        _truncated.set(key, result)
+    return result
@@ -1,3 +1,1005 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import os
+import shutil
+import smtplib
+import tempfile
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import six
+from PIL import Image
+
+from .models import Post, Reply, NodeTag, Attachment
+
+
+class ForumTestData(object):
+    """
+    填充测试数据: 管理员和普通用户、若干节点、主题(含管理员文集)和多页回复
+    """
+
+    def setUp(self):
+        # 测试之间数据库会回滚，但缓存不会
+        cache.clear()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.users = [User.objects.create_user('user{0}'.format(i), 'user{0}@example.com'.format(i), 'password')
+                     for i in range(3)]
+        cls.nodes = [NodeTag.objects.create(name='Node {0}'.format(i), slug='node{0}'.format(i))
+                     for i in range(3)]
+
+        cls.posts = []
+        for i in range(30):
+            author = [cls.admin, None, cls.users[i % 3]][i % 3]
+            cls.posts.append(Post.objects.create(
+                title='Post {0}'.format(i), content='**content** of post {0}'.format(i),
+                node=cls.nodes[i % 3], author=author, bygod=author is cls.admin,
+                guest_name='guest{0}'.format(i), need_notification=False
+            ))
+
+        cls.thread = cls.posts[-1]
+        previous = None
+        for i in range(45):
+            author = [cls.admin, None, cls.users[i % 3]][i % 3]
+            previous = Reply.objects.create(
+                title='Re:' + cls.thread.title, content='reply {0}\n\n```python\nprint {0}\n```'.format(i),
+                post_node=cls.thread, reply_to=previous if i % 5 else None, author=author,
+                guest_name='guest{0}'.format(i), need_notification=False
+            )
+
+        for i in range(20):
+            Attachment.objects.create(remark='file {0}'.format(i), user=cls.users[i % 3],
+                                      attachment='2015/01/01/file{0}.txt'.format(i))
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """
+    记录打开连接的次数，发给fail@开头地址的邮件抛出SMTPException
+    """
+    opened = 0
+
+    def open(self):
+        FlakyEmailBackend.opened += 1
+
+    def send_messages(self, messages):
+        for message in messages:
+            if any(to.startswith('fail@') for to in message.to):
+                raise smtplib.SMTPException("Recipient refused")
+        return super(FlakyEmailBackend, self).send_messages(messages)
+
+
+@override_settings(FORUM_OUTBOX_RETRY_DELAY=60, FORUM_OUTBOX_MAX_DELAY=100)
+class OutboxTest(TestCase):
+    backend = 'forum.tests.FlakyEmailBackend'
+
+    def setUp(self):
+        FlakyEmailBackend.opened = 0
+
+    def queue(self, *recipients):
+        from .models import OutboxMail
+        OutboxMail.objects.queue_mass_mail([('Subject', 'Body', None, recipients)])
+
+    def test_batches_reuse_one_connection(self):
+        from django.core import mail
+        from django.core.management import call_command
+        from .models import OutboxMail
+        self.queue(*['user{0}@example.com'.format(i) for i in range(7)])
+        out = six.StringIO()
+        call_command('send_outbox', backend=self.backend, batch_size=3, stdout=out)
+        self.assertIn('7 sent, 0 failed', out.getvalue())
+        self.assertEqual(FlakyEmailBackend.opened, 1)
+        self.assertEqual(len(mail.outbox), 7)
+        self.assertFalse(OutboxMail.objects.exclude(status=OutboxMail.STATUS_SENT).exists())
+
+    def test_retry_backoff(self):
+        from django.utils import timezone
+        from .mailer import deliver_outbox
+        from .models import OutboxMail
+        self.queue('fail@example.com', 'ok@example.com')
+        self.assertEqual(deliver_outbox(self.backend, max_attempts=3), (1, 1))
+        failed = OutboxMail.objects.get(recipient='fail@example.com')
+        self.assertEqual((failed.status, failed.attempts), (OutboxMail.STATUS_PENDING, 1))
+        self.assertTrue(failed.last_error.startswith('SMTPException'))
+        self.assertAlmostEqual((failed.next_attempt - timezone.now()).total_seconds(), 60, delta=5)
+        # 还没有到重试时间
+        self.assertEqual(deliver_outbox(self.backend, max_attempts=3), (0, 0))
+
+        # 等待时间翻倍，但不超过FORUM_OUTBOX_MAX_DELAY
+        OutboxMail.objects.filter(pk=failed.pk).update(next_attempt=timezone.now())
+        self.assertEqual(deliver_outbox(self.backend, max_attempts=3), (0, 1))
+        failed = OutboxMail.objects.get(pk=failed.pk)
+        self.assertEqual(failed.attempts, 2)
+        self.assertAlmostEqual((failed.next_attempt - timezone.now()).total_seconds(), 100, delta=5)
+
+        OutboxMail.objects.filter(pk=failed.pk).update(next_attempt=timezone.now())
+        deliver_outbox(self.backend, max_attempts=3)
+        self.assertEqual(OutboxMail.objects.get(pk=failed.pk).status, OutboxMail.STATUS_FAILED)
+        self.assertEqual(deliver_outbox(self.backend, max_attempts=3), (0, 0))
+
+
+class ThreadCounterTest(ForumTestData, TestCase):
+
+    def counters(self, post):
+        post = Post.objects.get(pk=post.pk)
+        return post.reply_count, post.last_reply_at, post.last_replier
+
+    def test_add_delete_move(self):
+        other = self.posts[0]
+        reply = Reply.objects.create(title='Re', content='new', post_node=self.thread, author=self.users[0])
+        self.assertEqual(self.counters(self.thread), (46, reply.created, 'user0'))
+
+        # 移到其它主题，原主题的最后回复变回之前的那条
+        reply.post_node = other
+        reply.save()
+        previous = Reply.objects.filter(post_node=self.thread).order_by('-pk').first()
+        self.assertEqual(self.counters(self.thread), (45, previous.created, previous.get_author_info()[0]))
+        self.assertEqual(self.counters(other), (1, reply.created, 'user0'))
+
+        reply.delete()
+        self.assertEqual(self.counters(other), (0, other.created, None))
+
+    def test_repair_command(self):
+        from django.core.management import call_command
+        for post in self.posts[:10]:
+            Reply.objects.create(title='Re', content='new', post_node=post, guest_name='g')
+        threads = self.posts[:10] + [self.thread]
+        expected = [self.counters(post) for post in threads]
+        Post.objects.update(reply_count=99, last_reply_at=None, last_replier='nobody')
+        NodeTag.objects.update(post_count=0, latest_post=None)
+        call_command('repair_thread_counters', batch_size=3, stdout=six.StringIO())
+        self.assertEqual([self.counters(post) for post in threads], expected)
+        # 没有回复的主题
+        self.assertEqual(self.counters(self.posts[10]), (0, self.posts[10].created, None))
+        self.assertEqual(list(NodeTag.objects.order_by('pk').values_list('post_count', flat=True)), [10, 10, 10])
+
+
+class QueryBudgetTest(ForumTestData, TestCase):
+    """
+    每个页面允许的最大查询数。列表中每多一行都不应该增加查询，
+    超出预算说明模板中又出现了逐行读取关联对象的情况
+    """
+
+    def assertMaxQueries(self, budget, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(queries), budget,
+            "{0} ran {1} queries (budget {2}):\n{3}".format(
+                url, len(queries), budget, '\n'.join(q['sql'] for q in queries.captured_queries))
+        )
+        return response
+
+    def test_index(self):
+        # 站长发布、新贴、最近回复、热门主题各一次
+        self.assertMaxQueries(4, '/')
+        self.assertMaxQueries(0, '/')
+
+    def test_forum_index(self):
+        self.assertMaxQueries(2, '/forum/')
+        self.assertMaxQueries(2, '/forum/?sort=active')
+        self.assertMaxQueries(2, '/forum/?p=last')
+
+    def test_nodetag_list(self):
+        self.assertMaxQueries(1, '/forum/node/')
+
+    def test_nodetag_detail(self):
+        self.assertMaxQueries(4, '/forum/node/node0/')
+
+    def test_thread_detail(self):
+        self.assertMaxQueries(3, '/forum/thread/{0}/'.format(self.thread.pk))
+        self.assertMaxQueries(3, '/forum/thread/{0}/?p=last'.format(self.thread.pk))
+        self.assertMaxQueries(0, '/forum/thread/{0}/'.format(self.thread.pk))
+
+    def test_attachments(self):
+        self.assertMaxQueries(2, '/attachments/')
+        self.assertMaxQueries(1, '/attachment/{0}/'.format(Attachment.objects.first().pk))
+
+
+class IndexCacheTest(ForumTestData, TestCase):
+
+    def test_blocks_are_invalidated(self):
+        response = self.client.get('/')
+        self.assertEqual(response.context['headline'], self.posts[27])
+        self.assertEqual(len(response.context['admin_post_latest']), 6)
+
+        reply = Reply.objects.create(title='Re', content='new reply', post_node=self.posts[0])
+        with self.assertNumQueries(1):
+            response = self.client.get('/')
+        self.assertEqual(response.context['reply_latest'][0], reply)
+
+        post = Post.objects.create(title='admin post', author=self.admin, bygod=True, node=self.nodes[0])
+        response = self.client.get('/')
+        self.assertEqual(response.context['headline'], post)
+        self.assertEqual(response.context['post_latest'][0], post)
+
+
+class FeedAndSitemapTest(ForumTestData, TestCase):
+
+    def test_feed_is_cached(self):
+        response = self.client.get('/rss/')
+        self.assertContains(response, self.posts[27].title)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/rss/', HTTP_IF_NONE_MATCH='"{0}"'.format(
+                response['ETag'].strip('"'))).status_code, 304)
+
+        Post.objects.create(title='new admin post', author=self.admin, bygod=True, node=self.nodes[0])
+        self.assertContains(self.client.get('/rss/'), 'new admin post')
+
+    def test_sitemap_sections(self):
+        from .sitemaps import PkRangePaginator
+        paginator = PkRangePaginator(Post.objects.filter(bygod=False).only('pk', 'last_edited'), 10)
+        pages = [paginator.page(n).object_list for n in paginator.page_range]
+        self.assertEqual(sum(len(p) for p in pages), Post.objects.filter(bygod=False).count())
+
+        response = self.client.get('/sitemap.xml')
+        self.assertContains(response, 'sitemap-threads.xml')
+        with self.assertNumQueries(2):
+            response = self.client.get('/sitemap-threads.xml')
+        self.assertContains(response, self.thread.get_absolute_url())
+
+
+class ThreadCacheTest(ForumTestData, TestCase):
+
+    def test_conditional_get(self):
+        url = '/forum/thread/{0}/'.format(self.thread.pk)
+        response = self.client.get(url)
+        # If-Modified-Since无法区分登录状态，只用ETag
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT').status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertNotEqual(self.client.get(url + '?p=2')['ETag'], response['ETag'])
+
+    def test_new_reply_invalidates_page(self):
+        url = '/forum/thread/{0}/?p=last'.format(self.thread.pk)
+        etag = self.client.get(url)['ETag']
+        Reply.objects.create(title='Re', content='brand new reply', post_node=self.thread)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'brand new reply')
+
+    def test_deleted_thread(self):
+        url = '/forum/thread/{0}/'.format(self.thread.pk)
+        self.client.get(url)
+        Post.objects.filter(pk=self.thread.pk).delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class KeysetPaginationTest(ForumTestData, TestCase):
+
+    def get_page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.context['page_obj']
+
+    def test_cursor_pages_match_offset_pages(self):
+        for url in ['/forum/thread/{0}/'.format(self.thread.pk), '/forum/']:
+            first = self.get_page(url)
+            second = self.get_page(url + '?p=2')
+            self.assertEqual(list(self.get_page(url + '?' + first.next_page_query())), list(second))
+            self.assertEqual(list(self.get_page(url + '?' + second.previous_page_query())), list(first))
+
+            last = self.get_page(url + '?p=last')
+            self.assertEqual(list(last), list(self.get_page(url + '?p={0}'.format(last.number))))
+
+    def test_thread_last_page(self):
+        page = self.get_page('/forum/thread/{0}/?p=last'.format(self.thread.pk))
+        self.assertEqual(page.number, 3)
+        self.assertEqual(page.start_index(), 41)
+        self.assertEqual([reply.pk for reply in page], list(self.thread.replies.order_by('pk')[40:]
+                                                          .values_list('pk', flat=True)))
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        node = NodeTag.objects.create(name='Node', slug='node')
+        self.post = Post.objects.create(title='中文全文搜索', content='这是一个关于Django的帖子', node=node)
+        self.reply = Reply.objects.create(title='Re', content='我也喜欢全文检索', post_node=self.post)
+
+    def search(self, query):
+        response = self.client.get('/forum/search/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [result['object'] for result in response.context['results']]
+
+    def test_tokenize(self):
+        from .search import tokenize
+        self.assertEqual(tokenize('中文全文 Django的帖子'), ['中文', '文全', '全文', 'django', '的帖', '帖子'])
+        self.assertEqual(tokenize('我爱你', index=True), ['我爱', '爱你', '你'])
+
+    def test_single_character(self):
+        reply = Reply.objects.create(title='Re', content='她爱你', post_node=self.post)
+        # 段首、段中、段尾的字都能搜到
+        for char in '她爱你':
+            self.assertEqual(self.search(char), [reply])
+        self.assertEqual(self.search('帖'), [self.post])
+
+    def test_search_is_updated_incrementally(self):
+        self.assertEqual(self.search('django'), [self.post])
+        self.assertEqual(set(self.search('全文')), set([self.post, self.reply]))
+        self.reply.delete()
+        self.assertEqual(self.search('检索'), [])
+        self.post.content = '已修改'
+        self.post.save()
+        self.assertEqual(self.search('django'), [])
+
+
+class ScreenWidthTest(TestCase):
+
+    def test_table_matches_widths(self):
+        from .management.commands.bench_screen_width import linear_char_width
+        from .utility import get_char_width
+        for code in range(0, 0x110000, 7):
+            self.assertEqual(get_char_width(unichr(code)), linear_char_width(unichr(code)), hex(code))
+
+    def test_truncate(self):
+        from .utility import get_screen_width
+        self.assertEqual(get_screen_width('测试字符串'), 10)
+        self.assertEqual(get_screen_width('测试字符串', 3), '...')
+        self.assertEqual(get_screen_width('测试字符串', 4), '测..')
+        self.assertEqual(get_screen_width('测试字符串', 5), '测...')
+        self.assertEqual(get_screen_width('abcdef', 6), 'abc...')
+        self.assertEqual(get_screen_width('abc', 10), 'abc')
+
+    def test_content_preview(self):
+        from django.utils.html import strip_tags
+        from .templatetags.truncate_by_width import content_preview, strip_tags_prefix
+        from .utility import get_screen_width
+        html = '<blockquote><p><strong>引用</strong> 中文 quote</p></blockquote>' + '<p>很长的回复</p>' * 1000
+        for width in (3, 5, 10, 11, 42):
+            self.assertEqual(get_screen_width(strip_tags_prefix(html, width), width),
+                             get_screen_width(strip_tags(html), width))
+        self.assertTrue(len(strip_tags_prefix(html, 42)) < 100)
+        reply = Reply(pk=1, content='short', content_md='<p>short</p>', content_hash='1')
+        self.assertEqual(content_preview(reply, 42), 'short')
+        # 内容变化后缓存的键也变了
+        reply.content_md, reply.content_hash = '<p>changed</p>', '2'
+        self.assertEqual(content_preview(reply, 42), 'changed')
+
+
+class AttachmentStorageTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def upload(self, name, content):
+        return Attachment.objects.create(attachment=SimpleUploadedFile(name, content))
+
+    def test_duplicates_share_one_file(self):
+        from .models import StoredFile
+        a = self.upload('a.txt', b'same content')
+        b = self.upload('b.TXT', b'same content')
+        self.assertEqual(a.attachment.name, b.attachment.name)
+        self.assertEqual(a.attachment.name, 'cas/{0}/{1}/{2}.txt'.format(a.digest[:2], a.digest[2:4], a.digest))
+        self.assertEqual((a.filename(), b.filename()), ('a.txt', 'b.TXT'))
+        self.assertEqual(StoredFile.objects.get().ref_count, 2)
+
+        path = a.attachment.path
+        a.delete()
+        self.assertTrue(os.path.isfile(path))
+        b.delete()
+        self.assertFalse(os.path.isfile(path))
+        self.assertFalse(StoredFile.objects.exists())
+
+    def test_concurrent_upload_of_new_file(self):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        from .models import StoredFile
+        from .storage import store_file, hash_file, get_digest_path
+        digest, size = hash_file(ContentFile(b'race'))
+        other = []
+
+        class RacingFile(ContentFile):
+            # 另一个请求在这个请求查询之后、保存文件的同时保存了同一个文件并创建了记录
+            def chunks(self, chunk_size=None):
+                if not other:
+                    other.append(default_storage.save(get_digest_path(digest, 'a.txt'), ContentFile(b'race')))
+                    StoredFile.objects.create(digest=digest, name=other[0], size=size, ref_count=1)
+                return super(RacingFile, self).chunks(chunk_size)
+
+        stored = store_file(RacingFile(b'race', name='a.txt'), digest, size)
+        self.assertEqual((stored.name, stored.ref_count), (other[0], 2))
+        self.assertEqual(StoredFile.objects.get().ref_count, 2)
+        # 这个请求保存的文件被删除了
+        self.assertEqual(os.listdir(os.path.dirname(default_storage.path(other[0]))), [os.path.basename(other[0])])
+
+    def test_dedupe_legacy_uploads(self):
+        from django.core.management import call_command
+        os.makedirs(os.path.join(self.media_root, '2015/01/01'))
+        for i in range(3):
+            with open(os.path.join(self.media_root, '2015/01/01/file{0}.txt'.format(i)), 'wb') as f:
+                f.write(b'legacy' if i < 2 else b'other')
+            Attachment.objects.create(attachment='2015/01/01/file{0}.txt'.format(i))
+
+        call_command('dedupe_uploads', stdout=six.StringIO())
+        names = set(Attachment.objects.values_list('attachment', flat=True))
+        self.assertEqual(len(names), 2)
+        self.assertFalse(os.listdir(os.path.join(self.media_root, '2015/01/01')))
+        self.assertEqual(Attachment.objects.order_by('pk').first().filename(), 'file0.txt')
+
+    def test_image_variants(self):
+        from django.core.management import call_command
+        from django.template import Context, Template
+        from .models import StoredFile
+        buf = six.BytesIO()
+        Image.new('RGB', (800, 400), (255, 0, 0)).save(buf, 'JPEG')
+        a = self.upload('photo.jpg', buf.getvalue())
+        self.assertEqual(StoredFile.objects.get().variants_status, StoredFile.VARIANTS_PENDING)
+
+        call_command('process_images', processes=1, stdout=six.StringIO())
+        self.assertEqual(StoredFile.objects.get().variants_status, StoredFile.VARIANTS_READY)
+        a = Attachment.objects.get(pk=a.pk)
+        self.assertEqual([(v.width, v.height) for v in a.get_variants()], [(240, 120), (640, 320)])
+
+        html = Template('{% load attachment_images %}{{ a|variant_url:200 }} {% attachment_image a 700 %}').render(
+            Context({'a': a}))
+        self.assertIn('{0}_240.jpeg '.format(a.digest), html)
+        self.assertIn('src="/upload/cas/', html)
+        self.assertIn('width="800"', html)
+
+        a.delete()
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'variants', a.digest[:2], a.digest[2:4])), [])
+
+    def test_small_image_gets_one_variant(self):
+        from django.core.management import call_command
+        buf = six.BytesIO()
+        Image.new('RGB', (100, 50), (0, 0, 255)).save(buf, 'JPEG')
+        a = self.upload('small.jpg', buf.getvalue())
+        call_command('process_images', processes=1, stdout=six.StringIO())
+        variants = Attachment.objects.get(pk=a.pk).get_variants()
+        self.assertEqual([(v.width, v.height, v.format) for v in variants], [(100, 50, 'jpeg')])
+
+    def test_reconcile_and_filter(self):
+        from django.contrib.auth.models import User
+        from django.core.management import call_command
+        user = User.objects.create_user('uploader', 'uploader@example.com', 'password')
+        text = self.upload('a.txt', b'text')
+        self.assertEqual((text.size, text.content_type), (4, 'text/plain'))
+        buf = six.BytesIO()
+        Image.new('RGB', (10, 10)).save(buf, 'PNG')
+        image = Attachment.objects.create(attachment=SimpleUploadedFile('b.png', buf.getvalue()), user=user)
+        self.assertEqual(image.content_type, 'image/png')
+        lost = Attachment.objects.create(attachment='2015/01/01/lost.txt')
+
+        call_command('reconcile_attachments', stdout=six.StringIO())
+        self.assertEqual(list(Attachment.objects.filter(missing=True)), [lost])
+
+        def listed(query):
+            return list(self.client.get('/attachments/' + query).context['object_list'])
+        self.assertEqual(listed(''), [image, text])
+        self.assertEqual(listed('?type=image'), [image])
+        self.assertEqual(listed('?type=file'), [text])
+        self.assertEqual(listed('?user=uploader&type=file'), [])
+
+    def test_download(self):
+        a = self.upload('a.bin', b'0123456789')
+        url = '/attachment/{0}/download/'.format(a.pk)
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertIn("filename*=UTF-8''a.bin", response['Content-Disposition'])
+        etag = response['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.client.get(url, HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+        response = self.client.get(url, HTTP_RANGE='bytes=-3', HTTP_IF_RANGE=etag)
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+        response = self.client.get(url, HTTP_RANGE='bytes=-3', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=10-').status_code, 416)
+
+        with self.settings(FORUM_ATTACHMENT_SERVE='accel'):
+            response = self.client.get(url)
+            self.assertEqual(response['X-Accel-Redirect'], '/protected/' + a.attachment.name)
+            self.assertEqual(response.content, b'')
+
+        os.remove(a.attachment.path)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertTrue(Attachment.objects.get(pk=a.pk).missing)
+
+
+class RateLimitTest(ForumTestData, TestCase):
+
+    def setUp(self):
+        super(RateLimitTest, self).setUp()
+        from .ratelimit import get_backend
+        get_backend().clear()
+
+    @override_settings(FORUM_RATELIMITS={'reply': '2/m'})
+    def test_guest_replies_are_limited_per_ip(self):
+        url = '/forum/thread/{0}/reply/'.format(self.thread.pk)
+        for i in range(2):
+            self.assertNotEqual(self.client.post(url, {}, REMOTE_ADDR='10.0.0.1').status_code, 429)
+        response = self.client.post(url, {}, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response['Retry-After']) > 0)
+        # 其它IP和GET请求不受影响
+        self.assertNotEqual(self.client.post(url, {}, REMOTE_ADDR='10.0.0.2').status_code, 429)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+    @override_settings(FORUM_RATELIMITS={'reply': '1/m'})
+    def test_limit_checked_before_csrf(self):
+        from django.test import Client
+        client = Client(enforce_csrf_checks=True)
+        url = '/forum/thread/{0}/reply/'.format(self.thread.pk)
+        self.assertEqual(client.post(url, {}, REMOTE_ADDR='10.0.0.3').status_code, 403)
+        self.assertEqual(client.post(url, {}, REMOTE_ADDR='10.0.0.3').status_code, 429)
+
+    def test_token_bucket_refills(self):
+        from .ratelimit import take_token
+        state, wait = take_token(None, 2, 60, 1000)
+        state, wait = take_token(state, 2, 60, 1000)
+        self.assertEqual(wait, 0)
+        state, wait = take_token(state, 2, 60, 1000)
+        self.assertEqual(wait, 30)
+        self.assertEqual(take_token(state, 2, 60, 1030)[1], 0)
+
+
+class BenchmarkCommandTest(TestCase):
+
+    def test_generate_and_bench(self):
+        from django.core.management import call_command
+        call_command('generate_forum_data', nodes=2, users=3, posts=10, replies=50, attachments=0,
+                     processes=1, stdout=six.StringIO())
+        self.assertEqual(Post.objects.count(), 10)
+        self.assertEqual(sum(Post.objects.values_list('reply_count', flat=True)), 50)
+        self.assertFalse(Reply.objects.filter(content_md__isnull=True).exists())
+        quoting = Reply.objects.filter(reply_to__isnull=False).select_related('reply_to')
+        self.assertTrue(quoting.exists())
+        for reply in quoting:
+            self.assertEqual(reply.post_node_id, reply.reply_to.post_node_id)
+            self.assertTrue(reply.tree_path.startswith(reply.reply_to.tree_path))
+        # 不同的seed可以生成到同一个数据库
+        call_command('generate_forum_data', seed=7, nodes=2, users=1, posts=1, replies=0, attachments=0,
+                     processes=1, stdout=six.StringIO())
+        self.assertEqual(Post.objects.count(), 11)
+
+        out = six.StringIO()
+        call_command('bench_urls', iterations=2, warmup=0, stdout=out)
+        results = json.loads(out.getvalue())['results']
+        self.assertIn('post-detail-last', results)
+        self.assertEqual(set(r['status'] for r in results.values()), set([200]))
+
+
+@override_settings(FORUM_PERF_ENABLED=True)
+class InstrumentationTest(ForumTestData, TestCase):
+
+    def test_stats_are_recorded(self):
+        from .instrumentation import registry
+        registry.reset()
+        self.client.get('/forum/thread/{0}/'.format(self.thread.pk))
+        self.client.post('/forum/thread/{0}/reply/'.format(self.thread.pk), {'content': '**hi**', 'guest_name': 'g',
+                                                                           'guest_email': 'g@example.com'})
+        stats = registry.snapshot()['views']
+        self.assertEqual(stats['post-detail']['sql_count']['count'], 1)
+        self.assertIn('template', stats['post-detail'])
+        self.assertIn('markdown', stats['post-reply'])
+        self.assertIn('mail', stats['post-reply'])
+
+        self.assertEqual(self.client.get('/forum/stats/').status_code, 302)
+        self.client.login(username='admin', password='password')
+        response = self.client.get('/forum/stats/')
+        self.assertIn('post-detail', json.loads(response.content.decode('utf-8'))['views'])
+
+    def test_sampling(self):
+        from .instrumentation import registry
+        registry.reset()
+        with self.settings(FORUM_PERF_SAMPLE_RATE=0):
+            self.client.get('/forum/')
+        self.assertEqual(registry.snapshot()['views'], {})
+
+    def test_slow_requests_are_logged(self):
+        from django.test.utils import patch_logger
+        with self.settings(FORUM_SLOW_REQUEST_MS=0), patch_logger('forum.slow', 'warning') as logged:
+            self.client.get('/forum/')
+        self.assertEqual(len(logged), 1)
+        self.assertIn('SELECT', logged[0])
+
+
+class TransferTest(ForumTestData, TestCase):
+
+    def test_export_import_round_trip(self):
+        from django.core.management import call_command
+        from .models import OutboxMail
+        path = os.path.join(tempfile.mkdtemp(), 'forum.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        call_command('export_forum', path, batch_size=7, stderr=six.StringIO())
+        with open(path) as f:
+            self.assertEqual(sum(1 for line in f), 3 + 30 + 45 + 20)
+
+        last_reply = Reply.objects.order_by('-pk').first()
+        # 已有的数据不会被之后的修复命令处理
+        Post.objects.filter(pk=self.thread.pk).update(reply_count=0)
+        from . import cache as forum_cache
+        nodes_version = forum_cache.get_version(forum_cache.NODES)
+        call_command('import_forum', path, batch_size=7, processes=1, stdout=six.StringIO())
+        self.assertEqual(Post.objects.get(pk=self.thread.pk).reply_count, 0)
+        self.assertNotEqual(forum_cache.get_version(forum_cache.NODES), nodes_version)
+        # 节点代号已存在，不会重复导入
+        self.assertEqual(NodeTag.objects.count(), 3)
+        self.assertEqual(Post.objects.count(), 60)
+        self.assertFalse(OutboxMail.objects.exists())
+
+        imported = Reply.objects.filter(pk__gt=last_reply.pk).order_by('pk')
+        copy = Post.objects.get(pk=imported[0].post_node_id)
+        self.assertNotEqual(copy.pk, self.thread.pk)
+        self.assertEqual((copy.title, copy.created, copy.reply_count), (self.thread.title, self.thread.created, 45))
+        self.assertEqual(copy.node_id, self.thread.node_id)
+        self.assertEqual(imported[1].reply_to_id, imported[0].pk)
+        self.assertEqual([r.author for r in imported[:3]], [self.admin, None, self.users[2]])
+        self.assertIn('<strong>', copy.content_md)
+        self.assertEqual(imported[1].tree_path, imported[0].tree_path + imported[1].tree_path[-7:])
+
+
+class ReplyTreeTest(ForumTestData, TestCase):
+
+    def setUp(self):
+        super(ReplyTreeTest, self).setUp()
+        # 测试数据中每5个回复组成一条引用链
+        self.chain = list(Reply.objects.filter(post_node=self.thread).order_by('pk')[5:10])
+
+    def test_paths(self):
+        root, last = self.chain[0], self.chain[-1]
+        self.assertEqual(len(root.tree_path), 7)
+        self.assertEqual(last.depth, 4)
+        self.assertTrue(last.tree_path.startswith(root.tree_path))
+        with self.assertNumQueries(1):
+            self.assertEqual(list(last.get_ancestors()), self.chain[:-1])
+        with self.assertNumQueries(1):
+            self.assertEqual(list(last.get_conversation()), self.chain)
+        self.assertEqual(list(root.get_descendants()), self.chain[1:])
+
+        # 分支：引用链中间的回复
+        branch = Reply.objects.create(title='Re', content='branch', post_node=self.thread, reply_to=self.chain[1])
+        self.assertEqual(branch.depth, 2)
+        # 深度优先：先引用的回复的整个分支在前
+        self.assertEqual(list(last.get_conversation()), self.chain + [branch])
+
+    def test_move_subtree(self):
+        other = Reply.objects.filter(post_node=self.thread).order_by('pk')[0]
+        moved = self.chain[2]
+        moved.reply_to = other
+        moved.save()
+        self.assertEqual(Reply.objects.get(pk=self.chain[-1].pk).tree_path[:14], other.tree_path + moved.tree_path[7:14])
+        self.assertEqual(list(self.chain[0].get_descendants()), [self.chain[1]])
+        self.assertEqual(Reply.objects.get(pk=self.chain[-1].pk).depth, 3)
+
+    def test_rebuild_command(self):
+        from django.core.management import call_command
+        expected = dict(Reply.objects.values_list('pk', 'tree_path'))
+        Reply.objects.update(tree_path='', depth=0)
+        # 引用主键更大的回复
+        Reply.objects.filter(pk=self.chain[0].pk).update(reply_to=self.chain[-1].pk + 1)
+        call_command('rebuild_reply_tree', batch_size=3, stdout=six.StringIO())
+        paths = dict(Reply.objects.values_list('pk', 'tree_path'))
+        self.assertEqual(paths[self.chain[-1].pk], expected[self.chain[-1].pk + 1] + expected[self.chain[-1].pk])
+        del paths[self.chain[0].pk], expected[self.chain[0].pk]
+        for reply in self.chain:
+            paths.pop(reply.pk, None), expected.pop(reply.pk, None)
+        self.assertEqual(paths, expected)
+
+    def test_empty_path(self):
+        # 还没有运行rebuild_reply_tree的旧回复
+        Reply.objects.filter(pk=self.chain[2].pk).update(tree_path='', depth=0)
+        legacy = Reply.objects.get(pk=self.chain[2].pk)
+        self.assertEqual(list(legacy.get_conversation()), [legacy])
+        self.assertEqual(list(legacy.get_descendants()), [])
+        self.assertEqual(list(legacy.get_ancestors()), [])
+        response = self.client.get('/forum/reply/{0}/conversation/'.format(legacy.pk))
+        self.assertEqual(list(response.context['object_list']), [legacy])
+
+    def test_conversation_view(self):
+        response = self.client.get('/forum/reply/{0}/conversation/'.format(self.chain[2].pk))
+        self.assertEqual(list(response.context['object_list']), self.chain)
+        self.assertContains(response, 'margin-left: 80px')
+        self.assertContains(self.client.get('/forum/thread/{0}/'.format(self.thread.pk)),
+                            '/forum/reply/{0}/conversation/'.format(self.chain[2].pk))
+
+
+class RendererTest(TestCase):
+
+    def test_highlight_cache(self):
+        from . import renderer
+        renderer.highlight_cache.clear()
+        text = 'quoted:\n\n```python\nprint 1\n```\n\n    :::python\n    print 2'
+        html = renderer.render(text)
+        # 输出CSS类名而不是内联样式
+        self.assertIn('<span class="mi">1</span>', html)
+        self.assertNotIn('style=', html)
+        self.assertEqual(len(renderer.highlight_cache), 2)
+
+        # 同样的代码在另一篇内容中直接使用缓存
+        for key in list(renderer.highlight_cache.data):
+            renderer.highlight_cache.set(key, '<div>cached</div>')
+        self.assertIn('<div>cached</div>', renderer.render('```python\nprint 1\n```'))
+        self.assertIn('<span class="mi">3</span>', renderer.render('```python\nprint 3\n```'))
+        self.assertEqual(len(renderer.highlight_cache), 3)
+
+    def test_skip_unchanged_content(self):
+        from .renderer import RENDERER_VERSION
+        node = NodeTag.objects.create(name='Node', slug='node')
+        post = Post.objects.create(title='T', content='**bold**', node=node)
+        self.assertEqual(post.renderer_version, RENDERER_VERSION)
+        # 内容没有变化时不重新渲染
+        Post.objects.filter(pk=post.pk).update(content_md='<p>sentinel</p>')
+        post = Post.objects.get(pk=post.pk)
+        post.title = 'New title'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).content_md, '<p>sentinel</p>')
+
+        post.content = '*em*'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).content_md, '<p><em>em</em></p>')
+
+    def test_version_bump_rerenders(self):
+        from django.core.management import call_command
+        from .renderer import RENDERER_VERSION
+        node = NodeTag.objects.create(name='Node', slug='node')
+        stale, current = [Post.objects.create(title='T', content='**bold**', node=node) for i in range(2)]
+        Post.objects.filter(pk=stale.pk).update(content_md='<p>old</p>', renderer_version=RENDERER_VERSION - 1)
+        Post.objects.filter(pk=current.pk).update(content_md='<p>sentinel</p>')
+
+        # 保存时发现版本过期，内容没变也重新渲染
+        post = Post.objects.get(pk=stale.pk)
+        post.save()
+        self.assertEqual(Post.objects.get(pk=stale.pk).content_md, '<p><strong>bold</strong></p>')
+
+        # rerender_markdown只渲染版本过期的内容
+        Post.objects.filter(pk=stale.pk).update(content_md='<p>old</p>', renderer_version=RENDERER_VERSION - 1)
+        call_command('rerender_markdown', processes=1, stdout=six.StringIO())
+        self.assertEqual(list(Post.objects.filter(pk__in=[stale.pk, current.pk]).order_by('pk')
+                              .values_list('content_md', 'renderer_version')),
+                         [('<p><strong>bold</strong></p>', RENDERER_VERSION), ('<p>sentinel</p>', RENDERER_VERSION)])
+
+
+class HotThreadTest(ForumTestData, TestCase):
+
+    def test_ranking(self):
+        from django.core.management import call_command
+        from django.utils import timezone
+        from .models import HotThread
+        from . import ranking
+        # 45个回复都集中在一个主题上
+        top = list(HotThread.objects.top(3))
+        self.assertEqual(top[0].post, self.thread)
+        self.assertAlmostEqual(top[0].heat, 46, places=1)
+        self.assertAlmostEqual(top[1].heat, 1, places=1)
+
+        # 一天前的两次活动等于现在的一次
+        old = timezone.now() - timezone.timedelta(seconds=ranking.get_half_life())
+        HotThread.objects.record(self.posts[0].pk, old)
+        HotThread.objects.record(self.posts[0].pk, old)
+        self.assertAlmostEqual(HotThread.objects.get(post=self.posts[0]).heat, 2, places=2)
+
+        Reply.objects.create(title='Re', content='hot', post_node=self.posts[1])
+        with self.assertNumQueries(1):
+            self.assertEqual([h.post for h in HotThread.objects.top(2)], [self.thread, self.posts[1]])
+
+        # 热度衰减到很低的主题被删除，其余的按最近的活动重新计算结果相同
+        HotThread.objects.filter(post=self.posts[2]).update(score=ranking.time_score(old) - 10)
+        scores = dict(HotThread.objects.values_list('post', 'score'))
+        call_command('compact_hot_threads', stdout=six.StringIO())
+        self.assertFalse(HotThread.objects.filter(post=self.posts[2]).exists())
+        call_command('compact_hot_threads', rebuild=True, stdout=six.StringIO())
+        rebuilt = dict(HotThread.objects.values_list('post', 'score'))
+        self.assertAlmostEqual(rebuilt[self.thread.pk], scores[self.thread.pk])
+        self.assertEqual(len(rebuilt), 30)
+
+    def test_views(self):
+        response = self.client.get('/forum/hot/')
+        self.assertEqual(response.context['hot_threads'][0].post, self.thread)
+        with self.assertNumQueries(0):
+            response = self.client.get('/forum/hot/')
+        self.assertContains(self.client.get('/'), '/forum/hot/')
+
+
+class NodeStatsTest(ForumTestData, TestCase):
+
+    def assertNodeStats(self, node, count, latest):
+        node = NodeTag.objects.get(pk=node.pk)
+        self.assertEqual((node.post_count, node.latest_post), (count, latest))
+
+    def test_counters(self):
+        self.assertNodeStats(self.nodes[2], 10, self.thread)
+        self.assertEqual(NodeTag.objects.get(pk=self.nodes[2].pk).last_active_at,
+                         Reply.objects.order_by('-pk').first().created)
+
+        self.thread.node = self.nodes[0]
+        self.thread.save()
+        self.assertNodeStats(self.nodes[2], 9, self.posts[26])
+        self.assertNodeStats(self.nodes[0], 11, self.thread)
+
+        Post.objects.filter(pk__in=[self.thread.pk, self.posts[27].pk]).delete()
+        self.assertNodeStats(self.nodes[0], 9, self.posts[24])
+
+        NodeTag.objects.update(post_count=0, latest_post=None)
+        from django.core.management import call_command
+        call_command('repair_thread_counters', stdout=six.StringIO())
+        self.assertNodeStats(self.nodes[0], 9, self.posts[24])
+        self.assertNodeStats(self.nodes[1], 10, self.posts[28])
+
+    def test_node_pages(self):
+        # 节点只查询一次并被缓存，分页使用节点的计数
+        with self.assertNumQueries(2):
+            response = self.client.get('/forum/node/node1/?p=last')
+        self.assertEqual(response.context['paginator'].num_pages, 1)
+        with self.assertNumQueries(1):
+            self.client.get('/forum/node/node1/')
+
+        post = Post.objects.create(title='new', node=self.nodes[1])
+        self.assertEqual(self.client.get('/forum/node/node1/').context['paginator'].count, 11)
+        self.assertEqual(self.client.get('/forum/node/missing/').status_code, 404)
+
+        response = self.client.get('/forum/node/')
+        self.assertContains(response, '11个主题')
+        self.assertContains(response, '/forum/thread/{0}/'.format(post.pk))
+
+
+class PaginatorCountTest(ForumTestData, TestCase):
+
+    def test_thread_list_count(self):
+        self.client.get('/forum/')
+        # 总数已经缓存，只需要取出这一页
+        with self.assertNumQueries(1):
+            response = self.client.get('/forum/?p=last')
+        self.assertEqual(len(response.context['post_list']), 5)
+
+        Post.objects.create(title='new', node=self.nodes[0])
+        response = self.client.get('/forum/?p=last')
+        self.assertEqual((response.context['paginator'].count, len(response.context['post_list'])), (31, 6))
+        self.posts[0].delete()
+        self.assertEqual(self.client.get('/forum/').context['paginator'].count, 30)
+
+    def test_thread_detail_count(self):
+        url = '/forum/thread/{0}/?p=last'.format(self.thread.pk)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertFalse([q for q in queries.captured_queries if 'COUNT(' in q['sql']])
+        self.assertEqual(len(response.context['page_obj'].object_list), 5)
+        Reply.objects.create(title='Re', content='last', post_node=self.thread)
+        response = self.client.get(url)
+        self.assertEqual(response.context['paginator'].num_pages, 3)
+        self.assertContains(response, 'last')
+
+    def test_attachment_counts(self):
+        self.assertEqual(self.client.get('/attachments/').context['paginator'].count, 20)
+        with self.assertNumQueries(1):
+            self.client.get('/attachments/?p=2')
+        self.assertEqual(self.client.get('/attachments/?user=user1').context['paginator'].count, 7)
+        Attachment.objects.filter(user=self.users[1]).first().delete()
+        self.assertEqual(self.client.get('/attachments/?user=user1').context['paginator'].count, 6)
+        self.assertEqual(self.client.get('/attachments/').context['paginator'].count, 19)
+
+
+class NotificationDigestTest(ForumTestData, TestCase):
+
+    def setUp(self):
+        super(NotificationDigestTest, self).setUp()
+        from .models import NotificationPreference
+        Post.objects.filter(pk=self.thread.pk).update(need_notification=True)
+        Reply.objects.filter(post_node=self.thread).update(need_notification=True)
+        self.thread = Post.objects.get(pk=self.thread.pk)
+        self.replies = list(Reply.objects.filter(post_node=self.thread).order_by('pk'))
+        # 主题作者是user2，回复#1是游客guest1
+        NotificationPreference.objects.create(email='user2@example.com', mode=NotificationPreference.MODE_DIGEST)
+
+    def reply(self, reply_to=None):
+        return Reply.objects.create(title='Re', content='digest me', post_node=self.thread, reply_to=reply_to,
+                                    author=self.users[0])
+
+    def test_digest(self):
+        from django.core import mail
+        from django.core.management import call_command
+        from .models import OutboxMail, PendingNotification
+        Reply.objects.filter(pk=self.replies[1].pk).update(guest_email='guest1@example.com')
+        self.reply()
+        self.reply(Reply.objects.get(pk=self.replies[1].pk))
+        self.reply()
+        # 游客即时通知，主题作者的三条进入汇总
+        self.assertEqual(list(OutboxMail.objects.values_list('recipient', flat=True)), ['guest1@example.com'])
+        self.assertEqual(PendingNotification.objects.count(), 3)
+
+        call_command('send_digests', stdout=six.StringIO())
+        self.assertEqual(PendingNotification.objects.count(), 0)
+        digests = [m for m in mail.outbox if m.to == ['user2@example.com']]
+        self.assertEqual(len(digests), 1)
+        self.assertIn('3条新回复', digests[0].subject)
+        self.assertEqual(digests[0].body.count(self.thread.title), 1)
+
+        # 间隔之内不会再次发送
+        self.reply()
+        call_command('send_digests', stdout=six.StringIO())
+        self.assertEqual(PendingNotification.objects.count(), 1)
+
+    def test_same_recipient_once(self):
+        from .models import NotificationPreference
+        # 引用主题作者自己的回复时只通知一次
+        cited = Reply.objects.get(pk=self.replies[2].pk)
+        self.assertEqual(cited.get_author_info()[1], 'user2@example.com')
+        NotificationPreference.objects.all().delete()
+        reply = self.reply(cited)
+        self.assertEqual(len(reply.get_notification_mails()), 1)
+
+    def test_settings_view(self):
+        from .models import NotificationPreference
+        url = six.moves.urllib.parse.urlparse(NotificationPreference.get_settings_url('Guest@Example.com')).path
+        self.assertEqual(self.client.get(url).context['email'], 'guest@example.com')
+        self.client.post(url, {'mode': NotificationPreference.MODE_NONE})
+        self.assertEqual(NotificationPreference.objects.get(email='guest@example.com').mode,
+                         NotificationPreference.MODE_NONE)
+        self.assertEqual(self.client.get(url[:-3] + 'xx/').status_code, 404)
+        self.assertEqual(self.client.get('/auth/notifications/').status_code, 302)
+
+
+class DatabaseRoutingTest(TestCase):
+
+    def test_router(self):
+        from django.test import RequestFactory
+        from django.http import HttpResponse
+        from .db import ForumRouter, ReplicaRoutingMiddleware, PIN_COOKIE
+        router, middleware, factory = ForumRouter(), ReplicaRoutingMiddleware(), RequestFactory()
+        with override_settings(FORUM_DB_REPLICAS=('replica', )):
+            # 请求之外(管理命令等)读主库
+            self.assertEqual(router.db_for_read(Post), 'default')
+
+            request = self.route(middleware, factory.get('/forum/'))
+            self.assertEqual(router.db_for_read(Post), 'replica')
+            self.assertIsNone(router.db_for_read(User))
+            response = middleware.process_response(request, HttpResponse())
+            self.assertNotIn(PIN_COOKIE, response.cookies)
+
+            # 写入之后本请求和之后的请求都读主库
+            request = self.route(middleware, factory.post('/forum/thread/1/reply/'))
+            self.assertEqual(router.db_for_read(Post), 'default')
+            self.assertEqual(router.db_for_write(Reply), 'default')
+            response = middleware.process_response(request, HttpResponse())
+            self.assertIn(PIN_COOKIE, response.cookies)
+
+            request = factory.get('/forum/')
+            request.COOKIES[PIN_COOKIE] = '1'
+            self.route(middleware, request)
+            self.assertEqual(router.db_for_read(Post), 'default')
+            middleware.process_response(request, HttpResponse())
+
+            # 没有列在FORUM_DB_REPLICA_VIEWS中的页面读主库
+            request = self.route(middleware, factory.get('/auth/notifications/'))
+            self.assertEqual(router.db_for_read(Post), 'default')
+            middleware.process_response(request, HttpResponse())
+            self.route(middleware, factory.get('/sitemap.xml'))
+            self.assertEqual(router.db_for_read(Post), 'replica')
+            middleware.process_response(request, HttpResponse())
+            self.assertFalse(router.allow_migrate('replica', 'forum'))
+
+    def route(self, middleware, request):
+        from django.core.urlresolvers import resolve
+        middleware.process_request(request)
+        request.resolver_match = resolve(request.path_info)
+        middleware.process_view(request, request.resolver_match.func, (), {})
+        return request
 
-# Create your tests here.
+    @skipUnless(connection.vendor == 'sqlite', "SQLite only")
+    def test_sqlite_pragmas(self):
+        connection.close()
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
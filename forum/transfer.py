@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+论坛内容的导入导出(JSONL)，见export_forum和import_forum命令
+
+每行一条记录，"type"为node、post、reply或attachment，"id"为导出时的主键，
+外键保存导出时的主键(用户保存用户名)，导入时重新分配主键并把外键映射到新的主键。
+导出的顺序保证被引用的记录总在引用它的记录之前(回复只能引用更早的回复)。
+附件只导出元数据，文件需要另外复制(按内容存储的路径在两边是一样的)。
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import NodeTag, Post, Reply, Attachment
+
+DATETIME_FIELDS = ('created', 'last_edited')
+POST_FIELDS = ('title', 'content', 'bygod', 'guest_name', 'guest_email', 'ip_addr', 'need_notification')
+
+# (type, model, 直接复制的字段, 外键: {字段: 引用的type})
+RECORD_TYPES = (
+    ('node', NodeTag, ('name', 'slug', 'description'), {}),
+    ('post', Post, POST_FIELDS, {'node': 'node'}),
+    ('reply', Reply, POST_FIELDS, {'post_node': 'post', 'reply_to': 'reply'}),
+    ('attachment', Attachment, ('remark', 'attachment', 'digest', 'original_name', 'size', 'content_type',
+                                'is_image', 'width', 'height', 'image_format'), {}),
+)
+USER_FIELDS = {
+    'post': 'author',
+    'reply': 'author',
+    'attachment': 'user',
+}
+
+
+def iter_records(batch_size=500):
+    """
+    按主键分批读取，内存占用与数据量无关
+    """
+    for record_type, model, fields, foreign_keys in RECORD_TYPES:
+        columns = ('pk', ) + fields + DATETIME_FIELDS + tuple(fk + '_id' for fk in foreign_keys)
+        user_field = USER_FIELDS.get(record_type)
+        if user_field:
+            columns += (user_field + '__username', )
+
+        last_pk = 0
+        while True:
+            rows = list(model.objects.filter(pk__gt=last_pk).order_by('pk').values(*columns)[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1]['pk']
+            for row in rows:
+                record = {'type': record_type, 'id': row['pk']}
+                for field in fields:
+                    record[field] = row[field]
+                for field in DATETIME_FIELDS:
+                    record[field] = row[field].isoformat() if row[field] else None
+                for fk in foreign_keys:
+                    record[fk] = row[fk + '_id']
+                if user_field:
+                    record[user_field] = row[user_field + '__username']
+                yield record
+
+
+def build_instance(record, pk, id_map, users):
+    """
+    根据一条记录生成未保存的实例，主键为pk。返回(实例, 还没有导入的外键列表)
+    """
+    for record_type, model, fields, foreign_keys in RECORD_TYPES:
+        if record_type == record['type']:
+            break
+    else:
+        raise ValueError("Unknown record type: {0}".format(record['type']))
+
+    instance = model(pk=pk, **dict((field, record.get(field)) for field in fields))
+    for field in DATETIME_FIELDS:
+        setattr(instance, field, parse_datetime(record[field]) if record.get(field) else timezone.now())
+
+    pending = []
+    for fk, target_type in foreign_keys.items():
+        old_id = record.get(fk)
+        if old_id is None:
+            continue
+        new_id = id_map[target_type].get(old_id)
+        if new_id is None:
+            pending.append((fk, target_type, old_id))
+        setattr(instance, fk + '_id', new_id)
+
+    user_field = USER_FIELDS.get(record['type'])
+    if user_field and record.get(user_field):
+        setattr(instance, user_field + '_id', users.get(record[user_field]))
+    return instance, pending
+
+
+@contextmanager
+def keep_timestamps(*models):
+    """
+    bulk_create时auto_now/auto_now_add会覆盖导入的时间，暂时关闭
+    """
+    saved = []
+    for model in models:
+        for field in model._meta.fields:
+            if field.name in DATETIME_FIELDS:
+                saved.append((field, field.auto_now, field.auto_now_add))
+                field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
@@ -4,45 +4,30 @@ from django.conf.urls import url
 from django.views.generic import ListView, DetailView
 from django.conf import settings
 from django.conf.urls.static import static
-from django.contrib.sitemaps import GenericSitemap
-from django.contrib.sitemaps.views import sitemap
+from django.contrib.sitemaps import views as sitemap_views
 
 from . import models
 from . import views
 from . import rss
-
-sitemap_thread_by_admin = {
-    'queryset': models.Post.objects.filter(bygod=True),
-    'date_field': 'last_edited'
-}
-
-sitemap_threads = {
-    'queryset': models.Post.objects.filter(bygod=False),
-    'date_field': 'last_edited'
-}
-
-sitemaps = {
-    'thread_by_admin': GenericSitemap(sitemap_thread_by_admin, priority=0.7),
-    'threads': GenericSitemap(sitemap_threads, priority=0.5),
-}
+from .sitemaps import sitemaps
 
 urlpatterns = [
     # 网站首页
     url(r'^$', views.IndexView.as_view(), name='index'),
     # 论坛首页
-    url(r'^forum/$', ListView.as_view(
-        model=models.Post,
-        template_name='forum/post/list.html',
-        paginate_by=25,
-        page_kwarg='p'
-    ), name='forum-index'),
+    url(r'^forum/$', views.ThreadList.as_view(), name='forum-index'),
+    url(r'^forum/hot/$', views.HotThreadList.as_view(), name='forum-hot'),
     # 帖子相关页面
     url(r'^forum/thread/(?P<pk>\d+)/$', views.ThreadDetail.as_view(), name='post-detail'),
     url(r'^forum/thread/(?P<pk>\d+)/reply/$', views.ReplyToPost.as_view(), name='post-reply'),
     url(r'^forum/thread/(?P<pk>\d+)/reply/(?P<reply_pk>\d+)/$', views.ReplyToPost.as_view(), name='post-reply-cited'),
+    url(r'^forum/reply/(?P<pk>\d+)/conversation/$', views.ReplyConversation.as_view(), name='reply-conversation'),
+    url(r'^forum/search/$', views.SearchView.as_view(), name='forum-search'),
+    url(r'^forum/stats/$', views.PerformanceStats.as_view(), name='forum-stats'),
     # 节点相关页面
     url(r'^forum/node/$', ListView.as_view(
-        model=models.NodeTag,
+        queryset=models.NodeTag.objects.select_related('latest_post').defer(
+            'latest_post__content', 'latest_post__content_md'),
         template_name='forum/nodetag/list.html'
     ), name='nodetag-list'),
     url(r'^forum/node/(?P<slug>\w+)/$', views.NodetagDetail.as_view(), name='nodetag-detail'),
@@ -53,20 +38,20 @@ urlpatterns = [
         'template_name': 'forum/auth/login.html'
     }, name='user-login'),
     url(r'^auth/logout/$', 'django.contrib.auth.views.logout_then_login', name='user-logout'),
+    url(r'^auth/notifications/$', views.NotificationSettings.as_view(), name='notification-settings'),
+    url(r'^auth/notifications/(?P<token>[-\w.:]+)/$', views.NotificationSettings.as_view(),
+        name='notification-settings-token'),
     # 附件相关页面
     url(r'^upload/$', views.UploadView.as_view(), name='upload-view'),
+    url(r'^attachment/(?P<pk>\d+)/download/$', views.AttachmentDownload.as_view(), name='attachment-download'),
     url(r'^attachment/(?P<pk>\d+)/', DetailView.as_view(
-        model=models.Attachment,
+        queryset=models.Attachment.objects.select_related('user'),
         template_name='forum/attachment.html'
     ), name='attachment-detail'),
-    url(r'^attachments/$', ListView.as_view(
-        model=models.Attachment,
-        template_name='forum/attachments.html',
-        paginate_by=15,
-        page_kwarg='p'
-    ), name='attachment-list'),
+    url(r'^attachments/$', views.AttachmentList.as_view(), name='attachment-list'),
     # 其它
-    url(r'^sitemap\.xml$', sitemap, {'sitemaps': sitemaps},
+    url(r'^sitemap\.xml$', sitemap_views.index, {'sitemaps': sitemaps}),
+    url(r'^sitemap-(?P<section>\w+)\.xml$', sitemap_views.sitemap, {'sitemaps': sitemaps},
         name='django.contrib.sitemaps.views.sitemap'),
     url(r'(?i)^rss/$', rss.PostsByAdminFeed(), name='rss'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+import bisect
 import datetime
+import re
+import threading
+from collections import OrderedDict
 
 
 def get_client_ip(request):
@@ -28,6 +32,29 @@ WIDTHS = [
     (120831, 1), (262141, 2), (1114109, 1),
 ]
 
+# 由WIDTHS预先生成的BMP(0~0xFFFF)字符宽度表，BMP以外的字符用二分查找
+WIDTH_BOUNDS = [num for num, wid in WIDTHS]
+BMP_WIDTHS = bytearray()
+for num, wid in WIDTHS:
+    if len(BMP_WIDTHS) <= min(num, 65535):
+        BMP_WIDTHS.extend(bytearray([wid]) * (min(num, 65535) + 1 - len(BMP_WIDTHS)))
+BMP_WIDTHS[0xe] = BMP_WIDTHS[0xf] = 0
+
+# 不包含这些字符的字符串每个字符的宽度都是1
+NOT_NARROW_RE = re.compile(u'[^\x00-\x0d\x10-\x7e]')
+
+
+def get_char_width(char):
+    """
+    获取单个字符的宽度
+    """
+    code = ord(char)
+    if code < 65536:
+        return BMP_WIDTHS[code]
+    index = bisect.bisect_left(WIDTH_BOUNDS, code)
+    return WIDTHS[index][1] if index < len(WIDTHS) else 1
+
+
 def get_screen_width(input_str, max_width=None, tail='.', tail_length=3):
     """
     获取输入字符串input_str在屏幕上的显示宽度，全角字符宽度计算为2，半角字符宽度计算为1
@@ -43,20 +70,6 @@ def get_screen_width(input_str, max_width=None, tail='.', tail_length=3):
     u"测..."
     """
 
-    def get_char_width(char):
-        """
-        查表(WIDTHS)获取单个字符的宽度
-        """
-        char = ord(char)
-        if char == 0xe or char == 0xf:
-            return 0
-
-        for num, wid in WIDTHS:
-            if char <= num:
-                return wid
-
-        return 1
-
     if max_width and max_width > tail_length*get_char_width(tail):
         # 最大宽度应该至少和表示省略的字符串一样长
         # str_max_width和max_width的区别在于：
@@ -70,14 +83,23 @@ def get_screen_width(input_str, max_width=None, tail='.', tail_length=3):
         # 如果出现提供了最大宽度但最大宽度还不如结尾表示省略的字符宽度大的时候就抛出异常
         raise AttributeError
 
+    if not NOT_NARROW_RE.search(input_str):
+        # 纯半角字符串(绝大部分英文标题)，宽度就是长度
+        if not max_width:
+            return len(input_str)
+        if len(input_str) < str_max_width:
+            return input_str
+        return input_str[0:str_max_width] + tail*tail_length
+
+    if not max_width:
+        return sum(BMP_WIDTHS[ord(char)] if ord(char) < 65536 else get_char_width(char) for char in input_str)
+
     total_width = 0
     result = input_str
 
-    for i in range(0, len(input_str)):
-        total_width += get_char_width(input_str[i])
-
-        if not max_width:
-            continue
+    for i, char in enumerate(input_str):
+        code = ord(char)
+        total_width += BMP_WIDTHS[code] if code < 65536 else get_char_width(char)
 
         # 当接近str_max_width时有几种情况：
         # 一种最离str_max_width还有一个半角字符，这种情况就继续循环
@@ -96,4 +118,38 @@ def get_screen_width(input_str, max_width=None, tail='.', tail_length=3):
             result = input_str[0:i+1] + tail*(tail_length-1)
             break
 
-    return result if max_width else total_width
\ No newline at end of file
+    return result
+
+
+class LRUCache(object):
+    """
+    线程安全的定长LRU缓存，超过max_size时淘汰最久没有使用的项
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
@@ -1,68 +1,261 @@
 # -*- coding: utf-8 -*-
-from django.http import HttpResponseRedirect
+import hashlib
+
+from django.conf import settings
+from django.http import HttpResponseRedirect, Http404, JsonResponse
 from django.shortcuts import get_object_or_404
-from django.views.generic import ListView, CreateView, FormView, TemplateView
+from django.views.generic import View, ListView, CreateView, FormView, TemplateView, UpdateView
 from django.contrib.auth import authenticate, login
+from django.contrib.auth.views import redirect_to_login
+from django.contrib.admin.views.decorators import staff_member_required
 from django.forms.models import modelform_factory
 from django.forms.widgets import PasswordInput
 from django.utils.six import BytesIO
+from django.utils.decorators import method_decorator
+from django.utils.http import urlencode
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_cookie
+from django.template.loader import render_to_string
 
 from .models import *
+from . import cache
 from .utility import get_client_ip
+from .paginator import KeysetPaginationMixin
+from .search import SearchResults
+from .sendfile import serve_attachment
+from .ratelimit import ratelimit
+from .instrumentation import registry, timer
 
 
 class IndexView(TemplateView):
     template_name = 'forum/index.html'
 
     def get_context_data(self, **kwargs):
-        posts = Post.objects.all()
-        replies = Reply.objects.all()
-        # 这里和下面的headline那里加的这个判断是为了空数据库的时候出现IndexError
-        admin_post = posts.filter(bygod=1) or [None, ]
+        # 首页只用到标题，不需要读取正文
+        posts = Post.objects.select_related('node').defer('content', 'content_md')
+        replies = Reply.objects.defer('content')
+        # 头条和站长发布一起查询，最多只需要7篇。各个块都缓存起来，由forum/signals.py在数据变化时失效
+        admin_post = cache.cached_block(cache.INDEX_ADMIN_POSTS, lambda: list(posts.filter(bygod=True)[:7]))
         return {
-            'post_latest': posts[:10],
-            'reply_latest': replies[:10],
+            'post_latest': cache.cached_block(cache.INDEX_LATEST_POSTS, lambda: list(posts[:10])),
+            'reply_latest': cache.cached_block(cache.INDEX_LATEST_REPLIES, lambda: list(replies[:10])),
             'admin_post_latest': admin_post[1:7],
             'admin_reply_latest': replies.filter(bygod=1)[:5],
-            'headline': admin_post[0] or []
+            'hot_threads': get_hot_threads()[:10],
+            # 这里加的这个判断是为了空数据库的时候出现IndexError
+            'headline': admin_post[0] if admin_post else []
         }
 
 
-class NodetagDetail(ListView):
+class ThreadList(KeysetPaginationMixin, ListView):
+    model = Post
+    template_name = 'forum/post/list.html'
+    paginate_by = 25
+    page_kwarg = 'p'
+    # ?sort=active 按最后回复时间排序，使用Post.last_reply_at上的索引
+    sort_orderings = {
+        'latest': ['-pk'],
+        'active': ['-last_reply_at', '-pk'],
+    }
+
+    def get_sort(self):
+        sort = self.request.GET.get('sort')
+        return sort if sort in self.sort_orderings else 'latest'
+
+    def get_ordering(self):
+        return self.sort_orderings[self.get_sort()]
+
+    def get_count(self, queryset):
+        return cache.cached_count(cache.POST_COUNT, queryset)
+
+    def get_queryset(self):
+        queryset = super(ThreadList, self).get_queryset()
+        return queryset.select_related('author', 'node').defer('content', 'content_md')
+
+    def get_context_data(self, **kwargs):
+        context = super(ThreadList, self).get_context_data(**kwargs)
+        context['sort'] = self.get_sort()
+        return context
+
+
+def get_hot_threads():
+    """
+    热门主题，直接按HotThread.score的索引取前FORUM_HOT_SIZE个，首页和热门主题页面共用一份缓存
+    """
+    limit = getattr(settings, 'FORUM_HOT_SIZE', 50)
+    return cache.cached_block(cache.HOT_THREADS, lambda: list(HotThread.objects.top(limit)))
+
+
+class HotThreadList(ListView):
+    template_name = 'forum/post/hot.html'
+    context_object_name = 'hot_threads'
+
+    def get_queryset(self):
+        return get_hot_threads()
+
+
+class NodetagDetail(KeysetPaginationMixin, ListView):
     model = Post
     template_name = 'forum/nodetag/detail.html'
     paginate_by = 25
     page_kwarg = 'p'
 
+    node = None
+
+    def get_node(self):
+        if self.node is None:
+            self.node = cache.get_node(self.kwargs['slug'])
+            if self.node is None:
+                raise Http404("No NodeTag matches the given query.")
+        return self.node
+
     def get_queryset(self):
-        node = get_object_or_404(NodeTag, slug=self.kwargs['slug'])
         all_posts = super(NodetagDetail, self).get_queryset()
-        posts_belong_to_this_node = all_posts.filter(node=node)
+        posts_belong_to_this_node = all_posts.filter(node=self.get_node()).select_related('author')
+        posts_belong_to_this_node = posts_belong_to_this_node.defer('content', 'content_md')
         return posts_belong_to_this_node
 
+    def get_count(self, queryset):
+        return self.get_node().post_count
+
     def get_context_data(self, **kwargs):
         context = super(NodetagDetail, self).get_context_data(**kwargs)
-        context['nodetag'] = get_object_or_404(NodeTag, slug=self.kwargs['slug'])
+        context['nodetag'] = self.get_node()
         return context
 
 
-class ThreadDetail(ListView):
+def thread_etag(request, pk):
+    """
+    ETag由主题的版本号、页码和登录状态决定(页面顶部显示了当前用户)，缓存命中时不访问数据库。
+    不使用Last-Modified，因为If-Modified-Since无法区分登录前后的页面
+    """
+    state = cache.get_thread_state(pk)
+    if state is None:
+        return None
+    page_query = ThreadDetail.get_page_query(request)
+    session = request.COOKIES.get(settings.SESSION_COOKIE_NAME, '')
+    return hashlib.md5('{0}:{1}:{2}:{3}'.format(
+        state, cache.get_version(cache.THREAD_PAGES), page_query, session
+    )).hexdigest()
+
+
+class ThreadDetail(KeysetPaginationMixin, ListView):
     model = Reply
     template_name = 'forum/post/detail.html'
+    body_template_name = 'forum/post/detail_body.html'
     paginate_by = 20
     page_kwarg = 'p'
+    post_node = None
+
+    @method_decorator(vary_on_cookie)
+    @method_decorator(condition(etag_func=thread_etag))
+    def dispatch(self, request, *args, **kwargs):
+        return super(ThreadDetail, self).dispatch(request, *args, **kwargs)
+
+    @classmethod
+    def get_page_query(cls, request):
+        return urlencode(sorted((k, request.GET[k]) for k in (cls.page_kwarg, 'after', 'before') if k in request.GET))
+
+    def get(self, request, *args, **kwargs):
+        # 缓存渲染好的主题和回复列表，主题或回复被修改后版本号变化，旧的缓存自然失效
+        state = cache.get_thread_state(self.kwargs['pk'])
+        if state is None:
+            raise Http404("No Post matches the given query.")
+        key = 'thread_page:{0}:{1}:{2}:{3}'.format(
+            self.kwargs['pk'], state, cache.get_version(cache.THREAD_PAGES), self.get_page_query(request)
+        )
+        self.object_list = None
+        page = cache.cached(key, self.render_page, getattr(settings, 'FORUM_THREAD_CACHE_TIMEOUT', 3600))
+        return self.render_to_response(page)
+
+    def render_page(self):
+        self.object_list = self.get_queryset()
+        context = self.get_context_data()
+        with timer('template'):
+            thread_body = render_to_string(self.body_template_name, context)
+        return {
+            'post': context['post'],
+            'thread_body': thread_body,
+        }
+
+    def get_post_node(self):
+        if self.post_node is None:
+            self.post_node = get_object_or_404(Post.objects.select_related('author', 'node'), pk=self.kwargs['pk'])
+        return self.post_node
 
     def get_queryset(self):
         all_replies = super(ThreadDetail, self).get_queryset()
-        replies_belong_to_this_post = all_replies.filter(post_node=self.kwargs['pk']).order_by('pk')
+        replies_belong_to_this_post = all_replies.filter(post_node=self.kwargs['pk']).select_related('author')
+        replies_belong_to_this_post = replies_belong_to_this_post.defer('content').order_by('pk')
         return replies_belong_to_this_post
 
+    def get_count(self, queryset):
+        return self.get_post_node().reply_count
+
     def get_context_data(self, **kwargs):
         context = super(ThreadDetail, self).get_context_data(**kwargs)
-        context['post'] = get_object_or_404(Post, pk=self.kwargs['pk'])
+        context['post'] = self.get_post_node()
+        return context
+
+
+class ReplyConversation(ListView):
+    """
+    一个回复所在的整个引用对话，按引用关系缩进显示，用tree_path的一次范围查询取出
+    """
+    template_name = 'forum/post/conversation.html'
+    paginate_by = 50
+    page_kwarg = 'p'
+
+    def get_reply(self):
+        if not hasattr(self, 'reply'):
+            self.reply = get_object_or_404(Reply.objects.select_related('post_node').defer('content', 'content_md'),
+                                           pk=self.kwargs['pk'])
+        return self.reply
+
+    def get_queryset(self):
+        return self.get_reply().get_conversation().select_related('author').defer('content')
+
+    def get_context_data(self, **kwargs):
+        context = super(ReplyConversation, self).get_context_data(**kwargs)
+        context['reply'] = self.get_reply()
+        context['post'] = self.get_reply().post_node
         return context
 
 
+class SearchView(ListView):
+    template_name = 'forum/search.html'
+    paginate_by = 20
+    page_kwarg = 'p'
+    context_object_name = 'results'
+
+    def get_search_query(self):
+        return self.request.GET.get('q', '').strip()[:100]
+
+    def get_queryset(self):
+        return SearchResults(self.get_search_query())
+
+    def get_context_data(self, **kwargs):
+        context = super(SearchView, self).get_context_data(**kwargs)
+        context['query'] = self.get_search_query()
+        return context
+
+
+class PerformanceStats(View):
+    """
+    当前进程中各个视图的耗时统计，?reset=1 清空
+    """
+
+    @method_decorator(staff_member_required)
+    def dispatch(self, request, *args, **kwargs):
+        return super(PerformanceStats, self).dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        stats = registry.snapshot()
+        if request.GET.get('reset'):
+            registry.reset()
+        return JsonResponse(stats)
+
+
 class ReplyToPost(CreateView):
     model = Reply
     fields = ['content', 'guest_name', 'guest_email', 'need_notification']
@@ -70,6 +263,10 @@ class ReplyToPost(CreateView):
     post_node = None
     cited_reply = None
 
+    @method_decorator(ratelimit('reply'))
+    def dispatch(self, request, *args, **kwargs):
+        return super(ReplyToPost, self).dispatch(request, *args, **kwargs)
+
     def get_initial(self):
         if 'reply_pk' in self.kwargs.keys():
             cited_reply = self.get_cited_reply()
@@ -120,17 +317,25 @@ class ReplyToPost(CreateView):
         return super(ReplyToPost, self).get_form_class()
 
     def get_post_node(self):
-        return self.post_node or get_object_or_404(Post, pk=self.kwargs['pk'])
+        if self.post_node is None:
+            self.post_node = get_object_or_404(Post, pk=self.kwargs['pk'])
+        return self.post_node
 
     def get_cited_reply(self):
-        return self.cited_reply or get_object_or_404(Reply, pk=self.kwargs['reply_pk'])
+        if self.cited_reply is None:
+            self.cited_reply = get_object_or_404(Reply, pk=self.kwargs['reply_pk'])
+        return self.cited_reply
 
 
 class CreatePost(CreateView):
     model = Post
     fields = ['title', 'content', 'guest_name', 'guest_email', 'need_notification']
     template_name = 'forum/post.html'
-    node = None  # node可能可以用@property解决
+    node = None
+
+    @method_decorator(ratelimit('post'))
+    def dispatch(self, request, *args, **kwargs):
+        return super(CreatePost, self).dispatch(request, *args, **kwargs)
 
     def form_valid(self, form):
         form.instance.author = self.request.user if self.request.user.is_authenticated() else None
@@ -167,12 +372,20 @@ class CreatePost(CreateView):
         return super(CreatePost, self).get_form_class()
 
     def get_node(self):
-        return self.node or get_object_or_404(NodeTag, slug=self.kwargs['slug'])
+        if self.node is None:
+            self.node = cache.get_node(self.kwargs['slug'])
+            if self.node is None:
+                raise Http404("No NodeTag matches the given query.")
+        return self.node
 
 
 class RegView(FormView):
     template_name = 'forum/auth/reg.html'
 
+    @method_decorator(ratelimit('register'))
+    def dispatch(self, request, *args, **kwargs):
+        return super(RegView, self).dispatch(request, *args, **kwargs)
+
     def post(self, request, *args, **kwargs):
         form_class = self.get_form_class()
         form = self.get_form(form_class)
@@ -217,11 +430,115 @@ class RegView(FormView):
         )
 
 
+class NotificationSettings(UpdateView):
+    """
+    回复通知方式。登录用户设置自己的邮箱，游客通过通知邮件中带签名的链接设置
+    """
+    model = NotificationPreference
+    fields = ['mode']
+    template_name = 'forum/notifications.html'
+
+    def dispatch(self, request, *args, **kwargs):
+        if 'token' in kwargs:
+            self.email = NotificationPreference.check_token(kwargs['token'])
+            if not self.email:
+                raise Http404("Invalid token")
+        elif request.user.is_authenticated() and request.user.email:
+            self.email = request.user.email.lower()
+        elif request.user.is_authenticated():
+            self.email = None
+        else:
+            return redirect_to_login(request.get_full_path())
+        return super(NotificationSettings, self).dispatch(request, *args, **kwargs)
+
+    def get_object(self, queryset=None):
+        if not self.email:
+            return None
+        return NotificationPreference.objects.filter(email=self.email).first() or \
+            NotificationPreference(email=self.email)
+
+    def post(self, request, *args, **kwargs):
+        if not self.email:
+            raise Http404("No email address")
+        return super(NotificationSettings, self).post(request, *args, **kwargs)
+
+    def get_success_url(self):
+        return self.request.path + '?saved=1'
+
+    def get_context_data(self, **kwargs):
+        context = super(NotificationSettings, self).get_context_data(**kwargs)
+        context['email'] = self.email
+        context['saved'] = 'saved' in self.request.GET
+        return context
+
+
+class AttachmentList(KeysetPaginationMixin, ListView):
+    template_name = 'forum/attachments.html'
+    paginate_by = 15
+    page_kwarg = 'p'
+    # ?type=image|file 和 ?user=用户名 筛选，使用Attachment.Meta.index_together中的索引
+    type_filters = {
+        'image': True,
+        'file': False,
+    }
+
+    def get_filters(self):
+        filters = []
+        if self.request.GET.get('type') in self.type_filters:
+            filters.append(('type', self.request.GET['type']))
+        if self.request.GET.get('user'):
+            filters.append(('user', self.request.GET['user']))
+        return filters
+
+    def get_queryset(self):
+        # 文件是否存在由reconcile_attachments命令记录，这里不访问文件系统
+        queryset = Attachment.objects.filter(missing=False)
+        for name, value in self.get_filters():
+            if name == 'type':
+                queryset = queryset.filter(is_image=self.type_filters[value])
+            else:
+                queryset = queryset.filter(user__username=value)
+        return queryset
+
+    def get_filter_query(self):
+        return urlencode([(k, v.encode('utf-8')) for k, v in self.get_filters()])
+
+    def get_count(self, queryset):
+        return cache.cached_count(cache.ATTACHMENT_COUNT, queryset, self.get_filter_query())
+
+    def get_context_data(self, **kwargs):
+        context = super(AttachmentList, self).get_context_data(**kwargs)
+        filters = dict(self.get_filters())
+        context['type'] = filters.get('type')
+        context['user_filter'] = filters.get('user')
+        context['filter_query'] = self.get_filter_query()
+        return context
+
+
+class AttachmentDownload(View):
+
+    def get(self, request, *args, **kwargs):
+        attachment = get_object_or_404(Attachment, pk=kwargs['pk'], missing=False)
+        if not attachment.attachment:
+            raise Http404
+        try:
+            return serve_attachment(request, attachment)
+        except (IOError, OSError):
+            # 记录下来，列表中不再显示
+            Attachment.objects.filter(pk=attachment.pk).update(missing=True)
+            cache.bump(cache.ATTACHMENT_COUNT)
+            raise Http404("File not found")
+
+
 class UploadView(CreateView):
     template_name = 'forum/upload.html'
     fields = ['attachment', 'remark']
     model = Attachment
 
+    @method_decorator(ratelimit('upload'))
+    def dispatch(self, request, *args, **kwargs):
+        return super(UploadView, self).dispatch(request, *args, **kwargs)
+
     def form_valid(self, form):
         form.instance.user = self.request.user if self.request.user.is_authenticated() else None
         return super(UploadView, self).form_valid(form)
@@ -41,15 +41,16 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
-    'django.middleware.cache.UpdateCacheMiddleware',
+    'forum.instrumentation.PerformanceMiddleware',
+    'forum.db.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'forum.ratelimit.RateLimitMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
 )
 
 ROOT_URLCONF = 'lcforum.urls'
@@ -64,9 +65,37 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        # Keep connections open between requests; wait up to 20s for a lock.
+        'CONN_MAX_AGE': 60,
+        'OPTIONS': {'timeout': 20},
+    },
+    # A read replica is configured like 'default' and listed in
+    # FORUM_DB_REPLICAS, e.g.
+    # 'replica': {'ENGINE': ..., 'NAME': ..., 'TEST': {'MIRROR': 'default'}},
 }
 
+# forum.db.ForumRouter sends reads of GET requests for the URL names in
+# FORUM_DB_REPLICA_VIEWS to a random replica and everything else to 'default';
+# after writing, a user reads from 'default' for FORUM_DB_PIN_SECONDS.
+DATABASE_ROUTERS = ['forum.db.ForumRouter']
+FORUM_DB_REPLICAS = ()
+FORUM_DB_REPLICA_VIEWS = (
+    'index', 'forum-index', 'forum-hot', 'post-detail', 'reply-conversation',
+    'nodetag-list', 'nodetag-detail', 'attachment-list', 'attachment-detail', 'rss',
+    'django.contrib.sitemaps.views.index', 'django.contrib.sitemaps.views.sitemap',
+)
+FORUM_DB_PIN_SECONDS = 10
+
+# Executed on every new SQLite connection. WAL lets readers run while a write
+# is in progress; synchronous=NORMAL is safe in WAL mode; cache_size is in KiB
+# when negative. Compare with `python manage.py bench_db`.
+FORUM_SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -20000),
+    ('temp_store', 'MEMORY'),
+)
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -102,12 +131,30 @@ TEMPLATES = [
     },
 ]
 
+# The forum caches page blocks under versioned keys and invalidates them from
+# model signals (see forum/cache.py). The local-memory cache is per process, so
+# when running several worker processes switch to a shared backend, e.g.
+# 'django.core.cache.backends.filebased.FileBasedCache' with
+# 'LOCATION': os.path.join(BASE_DIR, 'cache').
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'lcforum',
     }
 }
 
+# Upper bound (seconds) on how long a cached block may be served, in case an
+# invalidation is missed by another process.
+FORUM_BLOCK_CACHE_TIMEOUT = 300
+# Rendered thread pages are keyed by the thread version, so they can be kept
+# longer; the timeout only limits memory use.
+FORUM_THREAD_CACHE_TIMEOUT = 3600
+# Cached row counts for paginators; invalidated by signals, the timeout covers
+# bulk updates that send none.
+FORUM_COUNT_CACHE_TIMEOUT = 60
+# Number of highlighted code blocks kept in each process (see forum/renderer.py).
+FORUM_HIGHLIGHT_CACHE_SIZE = 512
+
 LOGIN_REDIRECT_URL = '/'
 LOGIN_URL = '/auth/login/'
 LOGOUT_URL = '/auth/logout/'
@@ -118,5 +165,75 @@ MEDIA_URL = '/upload/'
 # MAIL SETTINGS
 EMAIL_SUBJECT_PREFIX = u"[lcfcn.com]"
 DEFAULT_FROM_EMAIL = "me@lcfcn.com"
-
-ABSOLUTE_URL_PREFIX = "http://lcfcn.com"
\ No newline at end of file
+# Reply notifications are queued in the outbox and delivered by
+# `python manage.py send_outbox --loop`. Use `--backend console` or
+# `--backend file --file-path /tmp/mail` when testing.
+FORUM_OUTBOX_MAX_ATTEMPTS = 5
+FORUM_OUTBOX_RETRY_DELAY = 60  # seconds, doubled after each failure
+# Minimum time (seconds) between two digests to the same recipient; run
+# `manage.py send_digests` from cron at least this often.
+FORUM_DIGEST_INTERVAL = 24 * 3600
+
+ABSOLUTE_URL_PREFIX = "http://lcfcn.com"
+
+# Image attachments get resized, EXIF-stripped copies at these widths, generated
+# by `python manage.py process_images --loop`. WebP copies are only generated
+# when enabled and Pillow was built with WebP support.
+FORUM_IMAGE_VARIANT_WIDTHS = (240, 640, 1280)
+FORUM_IMAGE_WEBP = False
+
+# How /attachment/<pk>/download/ sends files: 'django' streams them in
+# FORUM_ATTACHMENT_CHUNK_SIZE chunks, 'sendfile' sets X-Sendfile for Apache or
+# lighttpd, 'accel' sets X-Accel-Redirect for an nginx internal location
+# (FORUM_ATTACHMENT_ACCEL_PREFIX) that points at MEDIA_ROOT.
+FORUM_ATTACHMENT_SERVE = 'django'
+FORUM_ATTACHMENT_CHUNK_SIZE = 64 * 1024
+FORUM_ATTACHMENT_ACCEL_PREFIX = '/protected/'
+
+# Each sitemap section covers this many consecutive post ids.
+FORUM_SITEMAP_SECTION_SIZE = 5000
+
+# Hot threads: every reply adds 1 to a thread's heat, which halves every
+# FORUM_HOT_HALF_LIFE seconds. compact_hot_threads drops threads below
+# FORUM_HOT_MIN_HEAT and keeps at most FORUM_HOT_KEEP rows; /forum/hot/ lists
+# the top FORUM_HOT_SIZE.
+FORUM_HOT_HALF_LIFE = 24 * 3600
+FORUM_HOT_MIN_HEAT = 0.05
+FORUM_HOT_KEEP = 1000
+FORUM_HOT_SIZE = 50
+
+# Token-bucket limits for anonymous IPs and logged-in users on write views,
+# as "count/period" (period in s/m/h/d or seconds); None disables a scope.
+# Use the 'cache' backend when running several worker processes.
+# Scopes missing here are not limited.
+FORUM_RATELIMITS = {
+    'post': '5/m',
+    'reply': '10/m',
+    'register': '5/h',
+    'upload': '20/h',
+}
+FORUM_RATELIMIT_BACKEND = 'memory'
+
+# Per-view timing histograms are served at /forum/stats/ (staff only).
+# Requests slower than FORUM_SLOW_REQUEST_MS are logged to 'forum.slow'
+# together with their slowest SQL statements. Off unless DEBUG; in
+# production enable it with a FORUM_PERF_SAMPLE_RATE below 1 to time only
+# a fraction of requests.
+FORUM_PERF_ENABLED = DEBUG
+FORUM_PERF_SAMPLE_RATE = 1.0
+FORUM_SLOW_REQUEST_MS = 1000
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'forum.slow': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+    },
+}